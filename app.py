@@ -1,30 +1,80 @@
-from flask import Flask, render_template, request, redirect, url_for, session, jsonify
+from flask import Flask, Request, render_template, request, redirect, url_for, session, jsonify, Response, stream_with_context, send_file, send_from_directory, abort
 import os
 import json
-from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_sqlalchemy import SQLAlchemy
 from werkzeug.utils import secure_filename
-import base64
-from flask_session import Session
-
-# Import different Mistral client files
-from models.mistral_client_radiologist import get_mistral_response as get_mistral_response_radiologist
-from models.mistral_client_mental_health import get_mistral_response as get_mistral_response_mental_health
-from models.mistral_client_report_explainer import get_mistral_response as get_mistral_response_report_explainer
-from models.mistral_client_general_doctor import get_mistral_response as get_mistral_response_general_doctor
-from models.mistral_client_dietitian import get_mistral_response as get_mistral_response_dietitian
+import time
+from jinja2 import FileSystemBytecodeCache
+from session_backend import SQLiteSessionInterface, load_secret_key
+from image_pipeline import preprocess_image, encode_base64, make_thumbnail, sniff_mime_type, THUMBNAIL_SIZE
+import blob_store
+import static_assets
+import compression
+import dicom_pipeline
+import conversation_store
+import metrics
+import tracing
+from job_queue import JobQueue, FINISHED
+from batch_upload import BatchError, batch_contents, store_batch, analyze_batch
+from models.response_cache import UNCACHEABLE_RESPONSES, response_cache
+from models.singleflight import upstream_calls
+from models.context_builder import context_stats
+from models import resilience
+from models.scheduler import current_user, upstream_scheduler, UpstreamRejected, IMAGE_COST
+
+# Personas, their prompts and model settings come from the registry in models/personas.json
+from models.persona_engine import PERSONAS
+
+class UploadRequest(Request):
+    """Writes uploaded files straight into the blob store while the body is parsed."""
+
+    upload_allowance = None  # bytes the user may still upload, set before the body is read
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.incoming = []
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        limit = self.upload_allowance
+        if limit is not None:
+            limit -= sum(blob.size for blob in self.incoming)
+        blob = blob_store.IncomingBlob(limit)
+        self.incoming.append(blob)
+        return blob
+
+    def close(self):
+        super().close()
+        # Parts of a body that failed to parse never make it into request.files
+        for blob in self.incoming:
+            blob.close()
 
 app = Flask(__name__)
-app.secret_key = os.urandom(24)  # Use a secure random key
-app.config['SESSION_TYPE'] = 'filesystem'  # Store sessions on the filesystem
+app.request_class = UploadRequest
+tracing.install_logging()  # log lines carry the id of the request they belong to
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
 app.config['UPLOAD_FOLDER'] = 'static/uploads'
 app.config['SESSION_PERMANENT'] = False
-app.config['SESSION_USE_SIGNER'] = True
+app.config['IMAGE_CACHE_MAX_AGE'] = 365 * 24 * 3600  # Blobs are immutable, their URL is their content hash
+app.config['STATIC_CACHE_MAX_AGE'] = 365 * 24 * 3600  # Built assets too, their names carry a content hash
+app.config['MAX_CONTENT_LENGTH'] = 256 * 1024 * 1024  # per request; a zipped CT series is the largest upload
+# Overrides from a JSON file named by PIXTALOGY_CONFIG, then from PIXTALOGY_* variables (e.g. PIXTALOGY_SECRET_KEY)
+if os.getenv('PIXTALOGY_CONFIG'):
+    app.config.from_file(os.path.abspath(os.environ['PIXTALOGY_CONFIG']), load=json.load)
+app.config.from_prefixed_env('PIXTALOGY')
+# A stable key, so sessions survive restarts and are valid in every worker process
+if not app.config.get('SECRET_KEY'):
+    app.secret_key = load_secret_key(os.getenv('SECRET_KEY_FILE', os.path.join(app.instance_path, 'secret_key')))
+
+# Compiled templates are kept on disk, so new worker processes do not compile them again
+os.makedirs(os.path.join(app.instance_path, 'jinja_cache'), exist_ok=True)
+app.jinja_options = {**app.jinja_options, 'bytecode_cache': FileSystemBytecodeCache(os.path.join(app.instance_path, 'jinja_cache'))}
 
 db = SQLAlchemy(app)
-Session(app)  # Initialize Flask-Session
+# Server-side sessions in SQLite; conversation history is stored per turn, not in the session blob
+app.session_interface = SQLiteSessionInterface(os.path.join(app.instance_path, 'sessions.db'))
+# Image analyses requested with ?async=true run on background workers
+jobs = JobQueue(os.path.join(app.instance_path, 'jobs.db'))
 
 # Ensure upload folder exists
 if not os.path.exists(app.config['UPLOAD_FOLDER']):
@@ -40,14 +90,89 @@ class User(db.Model):
 with app.app_context():
     db.create_all()
 
+# Upstream calls are scheduled fairly per user, so tag each request with its user
+@app.before_request
+def set_current_user():
+    current_user.set(session.get('user'))
+
+# Request and stage timings for /metrics, labelled by route template
+@app.before_request
+def start_request_timer():
+    request.started_at = time.perf_counter()
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    metrics.current_route.set(route)
+    if hasattr(session, 'load_seconds'):
+        metrics.STAGE_SECONDS.observe(session.load_seconds, route, 'session_load')
+    # A trace id from the proxy in front is kept, so log lines can be matched up
+    trace_id = request.headers.get('X-Request-ID', '')
+    request.trace = tracing.start(route, trace_id if trace_id.replace('-', '').isalnum() and len(trace_id) <= 64 else None, method=request.method)
+
+@app.after_request
+def record_request_time(response):
+    started_at = getattr(request, 'started_at', None)
+    if started_at is not None:
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - started_at, metrics.current_route.get(), request.method, str(response.status_code))
+    trace = getattr(request, 'trace', None)
+    if trace is not None:
+        trace.attributes['status'] = response.status_code
+        response.headers['X-Request-ID'] = trace.id
+        # Streamed responses are still being sent at this point, so the trace ends once the body is
+        response.call_on_close(lambda: tracing.finish(trace))
+    return response
+
+# HTML and JSON bodies are sent gzip or brotli compressed when the client accepts it
+@app.after_request
+def compress_response(response):
+    return compression.compress_response(response, request.accept_encodings)
+
+# Uploads over the user's quota are refused from their Content-Length, before the body is read
+@app.before_request
+def check_upload_quota():
+    if request.endpoint not in ('upload_file', 'upload_batch') or 'user' not in session:
+        return
+    remaining = blob_store.remaining_quota(session['user'])
+    if remaining is None:
+        return
+    if (request.content_length or 0) > remaining:
+        raise blob_store.QuotaExceeded(f"Upload quota of {blob_store.UPLOAD_QUOTA_BYTES} bytes exceeded")
+    # Chunked bodies have no Content-Length; they are cut off as they go past it
+    request.upload_allowance = remaining
+
+@app.errorhandler(blob_store.QuotaExceeded)
+def upload_quota_exceeded(e):
+    return jsonify({'error': str(e)}), 413
+
+@app.errorhandler(413)
+def upload_too_large(e):
+    return jsonify({'error': f"Uploads are limited to {app.config['MAX_CONTENT_LENGTH']} bytes per request"}), 413
+
+@app.errorhandler(UpstreamRejected)
+def upstream_rejected(e):
+    response = jsonify({'error': 'Too many requests, please try again shortly'})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(max(1, int(e.retry_after + 0.5)))
+    return response
+
 # Helper Functions
-def save_chat_log(user_email, content):
-    date_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    chat_folder = os.path.join('user_data', user_email, 'chat', date_time)
-    os.makedirs(chat_folder, exist_ok=True)
-    chat_file = os.path.join(chat_folder, 'chat_session.txt')
-    with open(chat_file, 'w') as f:
-        f.write(content)
+def save_chat_log(user_email, persona, message, response):
+    # Queued for the background writer, which appends to the user's conversation log
+    with metrics.stage('save_chat_log'):
+        conversation_store.append_message(user_email, persona, "user", message)
+        conversation_store.append_message(user_email, persona, "assistant", response)
+
+def get_conversation_history():
+    with metrics.stage('history_load'):
+        return app.session_interface.load_history(session.sid)
+
+def save_conversation_turn(message, response):
+    # Appends just the new turn; the rest of the session is not rewritten
+    with metrics.stage('session_write'):
+        app.session_interface.append_turn(session.sid, "user", message)
+        app.session_interface.append_turn(session.sid, "assistant", response)
+
+def sse_event(data, event=None):
+    message = f"event: {event}\n" if event else ""
+    return message + f"data: {json.dumps(data)}\n\n"
 
 def create_user_folder(email, name, dob, gender, weight):
     user_folder = os.path.join('user_data', email)
@@ -74,7 +199,8 @@ def signup():
         gender = request.form['gender']
         weight = request.form['weight']
         
-        hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
+        with tracing.span('password_hash'):
+            hashed_password = generate_password_hash(password, method='pbkdf2:sha256')
         if User.query.filter_by(email=email).first():
             return "User already exists, please login."
         
@@ -92,9 +218,11 @@ def login():
         email = request.form['email']
         password = request.form['password']
         user = User.query.filter_by(email=email).first()
-        if user and check_password_hash(user.password, password):
+        with tracing.span('password_check'):
+            password_ok = user is not None and check_password_hash(user.password, password)
+        if password_ok:
             session['user'] = user.email
-            session['conversation_history'] = []  # Reset the conversation history on login
+            app.session_interface.clear_history(session.sid)  # Reset the conversation history on login
             return redirect(url_for('dashboard'))
     return render_template('login.html')
 
@@ -104,28 +232,17 @@ def dashboard():
         return redirect(url_for('login'))
     return render_template('dashboard.html')
 
-# Chat Routes
-@app.route('/radiologist_chat', methods=['GET', 'POST'])
-def radiologist_chat():
-    return handle_chat('Radiologist', get_mistral_response_radiologist)
-
-@app.route('/mental_health_chat', methods=['GET', 'POST'])
-def mental_health_chat():
-    return handle_chat('Mental Health Guide', get_mistral_response_mental_health)
-
-@app.route('/report_explainer_chat', methods=['GET', 'POST'])
-def report_explainer_chat():
-    return handle_chat('Report Explainer', get_mistral_response_report_explainer)
+# Chat Routes, one per persona in the registry
+def chat_view(persona):
+    def view():
+        return handle_chat(persona)
+    view.__name__ = f'{persona.name}_chat'
+    return view
 
-@app.route('/general_doctor_chat', methods=['GET', 'POST'])
-def general_doctor_chat():
-    return handle_chat('General Doctor', get_mistral_response_general_doctor)
+for persona in PERSONAS.values():
+    app.add_url_rule(f'/{persona.name}_chat', view_func=chat_view(persona), methods=['GET', 'POST'])
 
-@app.route('/dietitian_chat', methods=['GET', 'POST'])
-def dietitian_chat():
-    return handle_chat('Dietitian', get_mistral_response_dietitian)
-
-def handle_chat(chat_type, get_mistral_response):
+def handle_chat(persona):
     if 'user' not in session:
         return redirect(url_for('login'))
 
@@ -136,20 +253,102 @@ def handle_chat(chat_type, get_mistral_response):
         if not message:
             return jsonify({'error': 'No message provided'}), 400
 
-        conversation_history = session.get('conversation_history', [])
+        conversation_history = get_conversation_history()
         conversation_history.append({"role": "user", "content": message})
 
+        if request.args.get('stream') == 'true' or data.get('stream'):
+            return stream_chat(user_email, persona.name, message, conversation_history, persona.stream_mistral_response)
+
         # Get response from LLM and prevent re-uploading image
-        response = get_mistral_response(message, conversation_history=conversation_history)
+        with metrics.stage('upstream'):
+            response = persona.get_mistral_response(message, conversation_history=conversation_history)
         if response:
-            save_chat_log(user_email, f"User: {message}\nLLM: {response}")
-            conversation_history.append({"role": "assistant", "content": response})
-            session['conversation_history'] = conversation_history
+            save_chat_log(user_email, persona.name, message, response)
+            save_conversation_turn(message, response)
             return jsonify({'response': response})
         else:
             return jsonify({'error': 'No response from LLM'}), 500
 
-    return render_template(f'{chat_type.lower().replace(" ", "_")}_chat.html', user_email=user_email)
+    return render_template(persona.template, persona=persona, personas=PERSONAS.values(), user_email=user_email)
+
+def stream_chat(user_email, persona, message, conversation_history, stream_mistral_response):
+    # Start the stream before sending headers, so a rejected call still gets its 429
+    stream = stream_mistral_response(message, conversation_history=conversation_history)
+    first_token = next(stream, None)
+
+    def generate():
+        tokens = []
+        try:
+            if first_token is not None:
+                tokens.append(first_token)
+                yield sse_event({'token': first_token})
+            for token in stream:
+                tokens.append(token)
+                yield sse_event({'token': token})
+        finally:
+            stream.close()  # frees the upstream slot if the client goes away mid-stream
+
+        response = ''.join(tokens)
+        if not response:
+            yield sse_event({'error': 'No response from LLM'}, event='error')
+            return
+
+        # Persist the finished turn exactly like the non-streaming path
+        save_chat_log(user_email, persona, message, response)
+        save_conversation_turn(message, response)
+        yield sse_event({'response': response}, event='done')
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers=headers)
+
+def analyze_image(user, sha256, file_path, chat_type, conversation_history, reuse=True):
+    """Return (response, processed image) for an uploaded image; image is None when reused."""
+    # Re-uploads of a scan reuse the user's earlier analysis instead of another paid call
+    response = blob_store.get_analysis(user, sha256, chat_type) if reuse else None
+    if response:
+        return response, None
+    # Downscale and re-encode before sending, the raw upload can be several MB
+    with metrics.stage('preprocess'):
+        image = preprocess_image(file_path)
+    return request_analysis(user, sha256, chat_type, image, conversation_history), image
+
+def request_analysis(user, sha256, chat_type, image, conversation_history):
+    with metrics.stage('base64_encode'):
+        encoded_string = encode_base64(image)
+    # Get response from LLM based on the uploaded image
+    with metrics.stage('upstream'):
+        response = PERSONAS[chat_type].get_mistral_response(content=encoded_string, is_image=True, conversation_history=conversation_history, mime_type=image.mime_type)
+    if response not in UNCACHEABLE_RESPONSES:
+        blob_store.save_analysis(user, sha256, chat_type, response)
+    return response
+
+def run_analysis_job(job):
+    # Runs on a job worker, outside any request
+    with tracing.trace('job', job_id=job.id, persona=job.persona):
+        return analyze_job(job)
+
+def analyze_job(job):
+    current_user.set(job.user)
+    history = app.session_interface.load_history(job.sid) if job.sid else None
+    response, _ = analyze_image(job.user, job.sha256, blob_store.blob_path(job.sha256), job.persona, history)
+    if response in UNCACHEABLE_RESPONSES:
+        raise RuntimeError(response or 'No response from LLM')
+
+    # Attach the finished analysis to the conversation the upload came from
+    message = f"Uploaded image: {job.filename}"
+    save_chat_log(job.user, job.persona, message, response)
+    if job.sid:
+        app.session_interface.append_turn(job.sid, "user", message)
+        app.session_interface.append_turn(job.sid, "assistant", response)
+    return response
+
+def job_payload(job):
+    payload = {'job_id': job.id, 'status': job.status}
+    if job.status == 'done':
+        payload['response'] = job.response
+    elif job.status == 'failed':
+        payload['error'] = job.error
+    return payload
 
 # Route for file upload based on chat type
 @app.route('/upload_file', methods=['POST'])
@@ -161,15 +360,9 @@ def upload_file():
     if not chat_type:
         return jsonify({'error': 'No chat type provided'}), 400
 
-    get_mistral_response = {
-        'radiologist': get_mistral_response_radiologist,
-        'mental_health': get_mistral_response_mental_health,
-        'report_explainer': get_mistral_response_report_explainer,
-        'general_doctor': get_mistral_response_general_doctor,
-        'dietitian': get_mistral_response_dietitian
-    }.get(chat_type)
+    persona = PERSONAS.get(chat_type)
 
-    if not get_mistral_response:
+    if not persona:
         return jsonify({'error': 'Invalid chat type'}), 400
 
     user_email = session['user']
@@ -181,41 +374,253 @@ def upload_file():
     if file.filename == '':
         return jsonify({'error': 'No selected file'}), 400
 
-    try:
-        user_upload_folder = os.path.join('user_data', user_email, 'upload')
-        if not os.path.exists(user_upload_folder):
-            os.makedirs(user_upload_folder)
+    filename = secure_filename(file.filename)
+    file_ext = os.path.splitext(filename)[1].lower()
+    image_extensions = ['.png', '.jpg', '.jpeg', '.gif']
+    # Sniffed from the first bytes as the body arrived; bytes that match no known format are refused too
+    sniffed_type = getattr(file.stream, 'content_type', None)
+    if file_ext in image_extensions and not (sniffed_type or '').startswith('image/'):
+        return jsonify({'error': 'The file is not a valid image'}), 415
 
-        filename = secure_filename(file.filename)
-        file_path = os.path.join(user_upload_folder, filename)
-        file.save(file_path)
-
-        file_ext = os.path.splitext(filename)[1].lower()
-        image_extensions = ['.png', '.jpg', '.jpeg', '.gif']
+    try:
+        # Content-addressed store: identical uploads share one blob on disk
+        with metrics.stage('file_save'):
+            upload = blob_store.save_upload(user_email, file)
+        metrics.UPLOAD_BYTES.observe(upload.size, metrics.current_route.get())
+        file_path = upload.path
+
+        study = None
+        if file_ext in dicom_pipeline.DICOM_EXTENSIONS:
+            if not dicom_pipeline.available():
+                return jsonify({'error': 'DICOM files are not supported on this server'}), 415
+            study = dicom_pipeline.study_metadata(dicom_pipeline.file_metadata(upload.sha256, file_path).get('StudyInstanceUID'))
+            # Key images rendered from the scan are analysed in place of the DICOM file
+            key_images = dicom_pipeline.expand_uploads(user_email, [upload])
+            if len(key_images) > 1:
+                conversation_history = get_conversation_history()
+                findings = [f"{image.filename}: {analyze_image(user_email, image.sha256, image.path, chat_type, conversation_history)[0]}" for image in key_images]
+                images = [{'image_url': url_for('serve_image', sha256=image.sha256), 'thumbnail_url': url_for('serve_thumbnail', sha256=image.sha256)} for image in key_images]
+                return jsonify({'response': "\n".join(findings), 'images': images, 'study': study})
+            upload = key_images[0]
+            filename, file_path, file_ext = upload.filename, upload.path, '.png'
 
         if file_ext in image_extensions:
-            with open(file_path, "rb") as image_file:
-                encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-            # Get response from LLM based on the uploaded image
-            response = get_mistral_response(content=encoded_string, is_image=True, conversation_history=session.get('conversation_history', []))
+            result = {
+                'image_url': url_for('serve_image', sha256=upload.sha256),
+                'thumbnail_url': url_for('serve_thumbnail', sha256=upload.sha256)
+            }
+            if study is not None:
+                result['study'] = study
+            if request.args.get('async') == 'true' and not (upload.duplicate and blob_store.get_analysis(user_email, upload.sha256, chat_type)):
+                # Answer right away; the analysis runs on a job worker
+                job_id = jobs.submit(user_email, session.sid, chat_type, upload.sha256, filename)
+                result.update(
+                    job_id=job_id,
+                    status='queued',
+                    status_url=url_for('job_status', job_id=job_id),
+                    events_url=url_for('job_events', job_id=job_id)
+                )
+                return jsonify(result), 202
+
+            response, image = analyze_image(user_email, upload.sha256, file_path, chat_type, get_conversation_history(), reuse=upload.duplicate)
+            if image is not None:
+                result.update(bytes_before=image.bytes_before, bytes_after=image.bytes_after)
             if response:
-                return jsonify({'response': response, 'image_data': f"data:image/png;base64,{encoded_string}"})
+                return jsonify({'response': response, **result})
             else:
                 return jsonify({'error': 'No response from LLM'}), 500
         else:
-            response = get_mistral_response(content=f"User uploaded a document: {filename}", is_image=False)
+            response = persona.get_mistral_response(content=f"User uploaded a document: {filename}", is_image=False)
             if response:
-                return jsonify({'response': response, 'file_path': f"/{file_path}"})
+                # No file_path: documents are not served back, and the blob path is the server's own
+                return jsonify({'response': response})
             else:
                 return jsonify({'error': 'No response from LLM'}), 500
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    except UpstreamRejected:
+        raise  # answered with a 429 by the error handler
+    except Exception:
+        # The details (blob paths among them) stay in the log
+        app.logger.exception(f"Upload of {filename} failed")
+        return jsonify({'error': 'The upload could not be processed'}), 500
     
+# Several images or a ZIP of a series in one request, analysed in parallel
+@app.route('/upload_batch', methods=['POST'])
+def upload_batch():
+    if 'user' not in session:
+        return jsonify({'error': 'User not logged in'}), 403
+
+    chat_type = request.args.get('chat_type')
+    if chat_type not in PERSONAS:
+        return jsonify({'error': 'Invalid chat type'}), 400
+
+    files = request.files.getlist('files') + request.files.getlist('file')
+    if not files:
+        return jsonify({'error': 'No file provided'}), 400
+
+    user_email = session['user']
+    try:
+        # The batch pays once when admitted, an image upload per image but never more than a full
+        # bucket, so a series is not refused part way through; its calls still queue fairly
+        upstream_scheduler.charge(user_email, batch_contents(files)[0] * IMAGE_COST)
+        with metrics.stage('file_save'):
+            uploads = store_batch(user_email, files)
+    except BatchError as e:
+        return jsonify({'error': str(e)}), 400
+
+    sid = session.sid
+    conversation_history = get_conversation_history()
+
+    def analyze(upload, image):
+        response = request_analysis(user_email, upload.sha256, chat_type, image, conversation_history)
+        if response in UNCACHEABLE_RESPONSES:
+            raise RuntimeError(response or 'No response from LLM')
+        return response
+
+    use_sse = request.args.get('format') == 'sse'
+
+    def generate():
+        # One line (or event) per image as it finishes, then the aggregate
+        for result in analyze_batch(uploads, chat_type, analyze):
+            if 'results' in result:
+                event = 'done'
+                findings = [f"{item['filename']}: {item['response']}" for item in result['results'] if 'response' in item]
+                if findings:
+                    message = f"Uploaded a series of {result['images']} images"
+                    response = "\n".join(findings)
+                    save_chat_log(user_email, chat_type, message, response)
+                    app.session_interface.append_turn(sid, "user", message)
+                    app.session_interface.append_turn(sid, "assistant", response)
+            else:
+                event = 'image'
+                result.update(
+                    image_url=url_for('serve_image', sha256=result['sha256']),
+                    thumbnail_url=url_for('serve_thumbnail', sha256=result['sha256'])
+                )
+            yield sse_event(result, event=event) if use_sse else json.dumps(dict(result, event=event)) + "\n"
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    mimetype = 'text/event-stream' if use_sse else 'application/x-ndjson'
+    return Response(stream_with_context(generate()), mimetype=mimetype, headers=headers)
+
+# Status of an async analysis job, for polling
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    return jsonify(job_payload(get_user_job(job_id)))
+
+# Server-Sent Events for an async analysis job; the last event is "done" or "failed"
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    job = get_user_job(job_id)
+
+    def generate(job):
+        yield sse_event(job_payload(job), event=job.status)
+        while job.status not in FINISHED:
+            status = job.status
+            job = jobs.wait(job.id, status, timeout=15)
+            if job.status == status:
+                yield ": keep-alive\n\n"
+            else:
+                yield sse_event(job_payload(job), event=job.status)
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return Response(stream_with_context(generate(job)), mimetype='text/event-stream', headers=headers)
+
+def get_user_job(job_id):
+    if 'user' not in session:
+        abort(403)
+    job = jobs.get(job_id)
+    if job is None or job.user != session['user']:
+        abort(404)
+    return job
+
+# Uploaded images by content hash, so browsers can cache them forever
+@app.route('/images/<sha256>')
+def serve_image(sha256):
+    return send_blob_image(sha256, thumbnail=False)
+
+@app.route('/images/<sha256>/thumbnail')
+def serve_thumbnail(sha256):
+    return send_blob_image(sha256, thumbnail=True)
+
+def send_blob_image(sha256, thumbnail):
+    if 'user' not in session:
+        abort(403)
+    if len(sha256) != 64 or not all(c in '0123456789abcdef' for c in sha256):
+        abort(404)
+    blob = blob_store.get_blob(sha256, user=session['user'])
+    if blob is None:
+        abort(404)
+
+    path = blob_store.blob_path(sha256)
+    if thumbnail:
+        path = make_thumbnail(path, blob_store.thumbnail_path(sha256, THUMBNAIL_SIZE))
+        mimetype, etag = 'image/jpeg', f"{sha256}-{THUMBNAIL_SIZE}"
+    else:
+        mimetype, etag = blob[1] or sniff_mime_type(path), sha256
+
+    # send_file answers If-None-Match / If-Modified-Since with a 304
+    response = send_file(path, mimetype=mimetype, etag=etag, conditional=True, max_age=app.config['IMAGE_CACHE_MAX_AGE'])
+    response.cache_control.private = True
+    response.cache_control.public = False
+    response.cache_control.immutable = True
+    return response
+
+# Fingerprinted assets from `python static_assets.py build`; without a build static/ is served as is
+static_manifest = static_assets.load_manifest(app.static_folder)
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # url_for('static', filename='logo3.png') points at the built copy, e.g. build/logo3.<hash>.png
+    if endpoint == 'static' and values.get('filename') in static_manifest['files']:
+        values['filename'] = static_manifest['files'][values['filename']]
+
+def serve_static(filename):
+    asset = static_manifest['assets'].get(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+    # The smallest copy the client can take: AVIF/WebP for images, brotli/gzip for text
+    path, mimetype, encoding = static_assets.negotiate(asset, request.accept_mimetypes, request.accept_encodings)
+    response = send_from_directory(app.static_folder, path, mimetype=mimetype, conditional=True, max_age=app.config['STATIC_CACHE_MAX_AGE'])
+    if encoding:
+        response.content_encoding = encoding
+    if asset['variants']:
+        response.vary.add('Accept')
+    if asset['encodings']:
+        response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+app.view_functions['static'] = serve_static
+
+# Cache, queue and upstream counters, read on every scrape
+def collect_stats():
+    yield metrics.stats_family('pixtalogy_response_cache', 'Response cache counters', response_cache.stats())
+    yield metrics.stats_family('pixtalogy_singleflight', 'Coalesced upstream calls', upstream_calls.stats())
+    yield metrics.stats_family('pixtalogy_scheduler', 'Upstream scheduler state and waits', upstream_scheduler.stats())
+    upstream_stats = resilience.upstream.stats()
+    yield metrics.stats_family('pixtalogy_upstream_calls', 'Retries, failures and breaker of Mistral calls', upstream_stats,
+                               labels={'breaker_state': upstream_stats['breaker_state']})
+    yield 'pixtalogy_jobs', 'gauge', 'Image analysis jobs by status', [({'status': status}, count) for status, count in jobs.stats().items()]
+    yield ('pixtalogy_context', 'gauge', 'Prompt context counters per persona',
+           [sample for persona, stats in context_stats.snapshot().items() for sample in metrics.stats_samples(stats, {'persona': persona})])
+
+metrics.register_collector(collect_stats)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    if metrics.METRICS_TOKEN and request.headers.get('Authorization') != f'Bearer {metrics.METRICS_TOKEN}':
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/logout', methods=['POST'])
 def logout():
+    app.session_interface.clear_history(session.sid)
     session.clear()  # Clear the session data
     return jsonify({'success': True})  # Return a success response
 
+# Also picks up jobs left unfinished by the previous run (serve.py requeues those once, in its master process)
+jobs.start(run_analysis_job, recover=os.getenv('JOB_RECOVER', '1') == '1')
 
 if __name__ == '__main__':
     app.run(debug=True)
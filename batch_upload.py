@@ -0,0 +1,191 @@
+import os
+import time
+import logging
+import zipfile
+import threading
+import contextvars
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import blob_store
+import dicom_pipeline
+from image_pipeline import preprocess_image
+from models.scheduler import prepaid
+
+# Batch settings, overridable from the environment
+MAX_IMAGES = int(os.getenv("BATCH_MAX_IMAGES", 200))  # images accepted per batch
+MAX_IMAGE_BYTES = int(os.getenv("BATCH_MAX_IMAGE_BYTES", 64 * 1024 * 1024))  # uncompressed size per archive member
+PREPROCESS_WORKERS = int(os.getenv("BATCH_PREPROCESS_WORKERS", os.cpu_count() or 1))  # processes, 0 runs them in threads
+UPSTREAM_CONCURRENCY = int(os.getenv("BATCH_UPSTREAM_CONCURRENCY", 4))  # parallel model calls per batch
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif')
+
+_process_pool = None
+_pool_lock = threading.Lock()
+
+
+class BatchError(Exception):
+    """Raised for a batch that cannot be accepted; maps to HTTP 400."""
+
+
+def _preprocess_pool():
+    # Preprocessing is CPU bound Pillow work, so it runs outside the web workers' GIL
+    global _process_pool
+    if _process_pool is None:
+        with _pool_lock:
+            if _process_pool is None:
+                if PREPROCESS_WORKERS:
+                    _process_pool = ProcessPoolExecutor(max_workers=PREPROCESS_WORKERS)
+                else:
+                    _process_pool = ThreadPoolExecutor(max_workers=os.cpu_count() or 1, thread_name_prefix="preprocess")
+    return _process_pool
+
+
+def _prepaid_context():
+    context = contextvars.copy_context()
+    context.run(prepaid.set, True)
+    return context
+
+
+def _is_image(name):
+    base = os.path.basename(name)
+    return base.lower().endswith(IMAGE_EXTENSIONS + dicom_pipeline.DICOM_EXTENSIONS) and not base.startswith('.') and '__MACOSX' not in name
+
+
+def iter_images(files):
+    """Yield (filename, stream) for every image in the uploaded files and ZIP archives.
+
+    Archive members are read straight from the spooled upload one at a time,
+    so an archive is never held in memory as a whole.
+    """
+    count = 0
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            try:
+                archive = zipfile.ZipFile(file.stream)
+            except zipfile.BadZipFile:
+                raise BatchError(f"{file.filename} is not a valid ZIP archive")
+            with archive:
+                # Sorted, so a CT series keeps its slice order
+                for member in sorted(archive.infolist(), key=lambda member: member.filename):
+                    if member.is_dir() or not _is_image(member.filename):
+                        continue
+                    if member.file_size > MAX_IMAGE_BYTES:
+                        raise BatchError(f"{member.filename} is larger than {MAX_IMAGE_BYTES} bytes")
+                    count += 1
+                    if count > MAX_IMAGES:
+                        raise BatchError(f"A batch can hold at most {MAX_IMAGES} images")
+                    with archive.open(member) as stream:
+                        yield os.path.basename(member.filename), stream
+        elif _is_image(file.filename):
+            count += 1
+            if count > MAX_IMAGES:
+                raise BatchError(f"A batch can hold at most {MAX_IMAGES} images")
+            yield file.filename, file.stream
+
+
+def batch_contents(files):
+    """(images, bytes) of a batch before it is stored, archive members at their uncompressed size."""
+    images = total = 0
+    for file in files:
+        if file.filename.lower().endswith('.zip'):
+            try:
+                # Closing the ZipFile leaves the upload stream open for iter_images
+                with zipfile.ZipFile(file.stream) as archive:
+                    members = [member for member in archive.infolist() if not member.is_dir() and _is_image(member.filename)]
+            except zipfile.BadZipFile:
+                raise BatchError(f"{file.filename} is not a valid ZIP archive")
+            images += len(members)
+            total += sum(member.file_size for member in members)
+        elif _is_image(file.filename):
+            file.stream.seek(0, os.SEEK_END)
+            images += 1
+            total += file.stream.tell()
+            file.stream.seek(0)
+    return images, total
+
+
+def store_batch(user, files):
+    """Stream every image of the batch into the blob store; returns the uploads to analyse in order.
+
+    DICOM files are grouped by series and stand in for the few key images
+    rendered from each series. Raises QuotaExceeded before anything is
+    stored if the extracted images would take the user past their quota.
+    """
+    remaining = blob_store.remaining_quota(user)
+    # The request size was checked against the quota already, but archives grow when extracted
+    if remaining is not None and batch_contents(files)[1] > remaining:
+        raise blob_store.QuotaExceeded(f"Upload quota of {blob_store.UPLOAD_QUOTA_BYTES} bytes exceeded")
+    uploads = [blob_store.save_stream(user, filename, stream) for filename, stream in iter_images(files)]
+    if not uploads:
+        raise BatchError("No images found in the upload")
+    if any(dicom_pipeline.is_dicom_name(upload.filename) for upload in uploads):
+        if not dicom_pipeline.available():
+            raise BatchError("DICOM files are not supported on this server")
+        uploads = dicom_pipeline.expand_uploads(user, uploads)
+    return uploads
+
+
+def analyze_batch(uploads, chat_type, analyze, concurrency=UPSTREAM_CONCURRENCY):
+    """Analyse uploaded images in parallel, yielding one result dict per image as it finishes.
+
+    All images are preprocessed in the process pool up front; at most
+    concurrency of them are with the model at any time. analyze(upload,
+    image) makes the model call for one preprocessed image. The last item
+    yielded is the aggregate with counts and throughput.
+
+    The caller charges the user's rate limit for the whole batch when it is
+    admitted; the model calls are not charged again but still take their
+    turn in the scheduler's fair queue, so a large batch cannot starve
+    other users.
+    """
+    started = time.monotonic()
+    results = [None] * len(uploads)
+    pending = []
+    for index, upload in enumerate(uploads):
+        # Images analysed before (e.g. a re-sent series) are answered from the store
+        response = blob_store.get_analysis(upload.user, upload.sha256, chat_type)
+        if response:
+            results[index] = {'index': index, 'filename': upload.filename, 'sha256': upload.sha256, 'response': response, 'cached': True}
+            yield results[index]
+        else:
+            pending.append(index)
+
+    pool = _preprocess_pool()
+    preprocessed = {index: pool.submit(preprocess_image, uploads[index].path) for index in pending}
+
+    def run(index):
+        image = preprocessed[index].result()
+        return analyze(uploads[index], image)
+
+    upstream = ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch-upstream")
+    try:
+        # Each call runs in a copy of the request context, so the scheduler still sees the user
+        futures = {upstream.submit(_prepaid_context().run, run, index): index for index in pending}
+        for future in as_completed(futures):
+            index = futures[future]
+            upload = uploads[index]
+            result = {'index': index, 'filename': upload.filename, 'sha256': upload.sha256}
+            try:
+                result['response'] = future.result()
+            except Exception as e:
+                logging.error(f"Batch analysis of {upload.filename} failed: {e}")
+                result['error'] = str(e)
+            results[index] = result
+            yield result
+    finally:
+        # If the client went away, drop the images that have not been sent yet
+        upstream.shutdown(wait=False, cancel_futures=True)
+        for future in preprocessed.values():
+            future.cancel()
+
+    seconds = time.monotonic() - started
+    failed = sum(1 for result in results if 'error' in result)
+    throughput = len(uploads) / seconds if seconds else float(len(uploads))
+    logging.info(f"Analysed a batch of {len(uploads)} images in {seconds:.1f}s ({throughput:.2f} images/sec, {len(pending)} sent to the model)")
+    yield {
+        'images': len(uploads),
+        'succeeded': len(uploads) - failed,
+        'failed': failed,
+        'cached': len(uploads) - len(pending),
+        'seconds': round(seconds, 3),
+        'images_per_second': round(throughput, 3),
+        'results': results,
+    }
@@ -0,0 +1,415 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import logging
+import argparse
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Local stand-in for the Mistral chat completions endpoint, for load tests that cost nothing.
+# Point the app at it with MISTRAL_SERVER_URL=http://127.0.0.1:<port>
+CHAT_PATH = "/v1/chat/completions"
+WORDS = ("the", "scan", "shows", "no", "acute", "findings", "normal", "follow", "up", "with", "your", "doctor")
+REAL_API_URL = "https://api.mistral.ai"
+
+
+def parse_latency(spec):
+    """Return a sampler for a latency spec in seconds.
+
+    fixed:0.5, uniform:0.2,1.5, normal:0.8,0.2 (mean, sd) or
+    lognormal:0.8,0.5 (median, sigma). A bare number is fixed.
+    """
+    kind, _, params = spec.partition(":")
+    if not params:
+        kind, params = "fixed", kind
+    values = [float(value) for value in params.split(",")]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(0.0, random.gauss(values[0], values[1]))
+    if kind == "lognormal":
+        median, sigma = values
+        return lambda: random.lognormvariate(0, sigma) * median
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+def request_key(body):
+    """Key a chat request by model and messages; image data is reduced to its digest."""
+    messages = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if isinstance(content, list):
+            content = [_image_digest(part) if part.get("type") == "image_url" else part for part in content]
+        messages.append([message.get("role"), content])
+    data = json.dumps([body.get("model"), messages], sort_keys=True).encode()
+    return hashlib.sha256(data).hexdigest()
+
+
+def _image_url(part):
+    url = part.get("image_url")
+    return url.get("url", "") if isinstance(url, dict) else url or ""
+
+
+def _image_digest(part):
+    return {"type": "image_url", "sha256": hashlib.sha256(_image_url(part).encode()).hexdigest()}
+
+
+def image_parts(body):
+    """Return the decoded byte size of every image in the request."""
+    sizes = []
+    for message in body.get("messages", []):
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        for part in content:
+            if part.get("type") == "image_url":
+                data = _image_url(part).partition("base64,")[2]
+                sizes.append(len(data) * 3 // 4 if data else 0)
+    return sizes
+
+
+class Recordings:
+    """Recorded upstream responses, replayed by request key or in turn when the key is unknown."""
+
+    def __init__(self, path):
+        self._by_key = {}
+        self._all = []
+        self._next = 0
+        self._lock = threading.Lock()
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    self._by_key.setdefault(record["key"], []).append(record)
+                    self._all.append(record)
+        if not self._all:
+            raise ValueError(f"No recordings in {path}")
+
+    def __len__(self):
+        return len(self._all)
+
+    def lookup(self, key):
+        """Return (record, matched)."""
+        with self._lock:
+            records = self._by_key.get(key)
+            if records:
+                record = records.pop(0)
+                records.append(record)
+                return record, True
+            record = self._all[self._next % len(self._all)]
+            self._next += 1
+            return record, False
+
+
+class FakeMistral:
+    """Behaviour and counters of the fake server.
+
+    latency is the time to a complete response, or to the first token when
+    streaming; image_latency is added per image in the request. error_rate of
+    the requests fail with a status drawn from error_codes. With record set,
+    requests are proxied to the real API and appended to that JSONL file; with
+    replay set, recorded responses and their latencies are played back.
+    """
+
+    def __init__(self, latency="fixed:0.2", image_latency=0.0, token_interval=0.02, tokens=24,
+                 error_rate=0.0, error_codes=(429, 500, 503), record=None, upstream=REAL_API_URL,
+                 api_key=None, replay=None, replay_speed=1.0, seed=None):
+        self.latency = parse_latency(latency)
+        self.image_latency = image_latency
+        self.token_interval = token_interval
+        self.tokens = tokens
+        self.error_rate = error_rate
+        self.error_codes = tuple(error_codes)
+        self.record = record
+        self.upstream = upstream.rstrip("/")
+        self.api_key = api_key or os.getenv("MISTRAL_API_KEY")
+        self.recordings = Recordings(replay) if replay else None
+        self.replay_speed = replay_speed
+        self._record_lock = threading.Lock()
+        self._lock = threading.Lock()
+        if seed is not None:
+            random.seed(seed)
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # Requests still being answered stay counted, or they would take in_flight below zero
+            in_flight = self._stats["in_flight"] if hasattr(self, "_stats") else 0
+            self._stats = {
+                "requests": 0,
+                "streamed": 0,
+                "errors": {},
+                "images": 0,
+                "image_bytes": 0,
+                "max_images_per_request": 0,
+                "prompt_chars": 0,
+                "completion_tokens": 0,
+                "replay_matched": 0,
+                "replay_unmatched": 0,
+                "recorded": 0,
+                "in_flight": in_flight,
+                "max_in_flight": in_flight,
+            }
+
+    def stats(self):
+        with self._lock:
+            return json.loads(json.dumps(self._stats))
+
+    def _count(self, **deltas):
+        with self._lock:
+            for name, delta in deltas.items():
+                self._stats[name] += delta
+            self._stats["max_in_flight"] = max(self._stats["max_in_flight"], self._stats["in_flight"])
+
+    def _count_error(self, status):
+        with self._lock:
+            self._stats["errors"][str(status)] = self._stats["errors"].get(str(status), 0) + 1
+
+    def account(self, body):
+        """Count a request's prompt text and image payload."""
+        sizes = image_parts(body)
+        text = sum(len(message["content"]) for message in body.get("messages", []) if isinstance(message.get("content"), str))
+        with self._lock:
+            self._stats["requests"] += 1
+            self._stats["streamed"] += bool(body.get("stream"))
+            self._stats["images"] += len(sizes)
+            self._stats["image_bytes"] += sum(sizes)
+            self._stats["max_images_per_request"] = max(self._stats["max_images_per_request"], len(sizes))
+            self._stats["prompt_chars"] += text
+        return sizes
+
+    def completion_text(self):
+        return " ".join(random.choice(WORDS) for _ in range(self.tokens))
+
+    def injected_error(self):
+        if self.error_rate and random.random() < self.error_rate:
+            return random.choice(self.error_codes)
+        return None
+
+
+def completion_body(model, content, finish_reason="stop"):
+    return {
+        "id": f"fake-{random.getrandbits(48):x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+        "usage": {"prompt_tokens": 0, "completion_tokens": len(content.split()), "total_tokens": len(content.split())},
+    }
+
+
+def chunk_body(chunk_id, model, content=None, finish_reason=None):
+    delta = {"content": content} if content is not None else {}
+    return {
+        "id": chunk_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    fake = None  # set by serve()
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+    def _send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            return self._send_json(200, self.fake.stats())
+        self._send_json(404, {"message": "Not found"})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        raw = self.rfile.read(length)
+        if self.path == "/reset":
+            self.fake.reset()
+            return self._send_json(200, {"reset": True})
+        if self.path != CHAT_PATH:
+            return self._send_json(404, {"message": "Not found"})
+
+        body = json.loads(raw or b"{}")
+        fake = self.fake
+        sizes = fake.account(body)
+        fake._count(in_flight=1)
+        try:
+            if fake.record:
+                return self._proxy(body, raw)
+            if fake.recordings:
+                return self._replay(body)
+            self._synthesize(body, sizes)
+        finally:
+            fake._count(in_flight=-1)
+
+    def _synthesize(self, body, sizes):
+        fake = self.fake
+        time.sleep(fake.latency() + fake.image_latency * len(sizes))
+        status = fake.injected_error()
+        if status:
+            fake._count_error(status)
+            headers = {"Retry-After": "1"} if status == 429 else None
+            return self._send_json(status, {"object": "error", "message": "Injected failure", "code": status}, headers)
+        content = fake.completion_text()
+        fake._count(completion_tokens=fake.tokens)
+        self._respond(body, content, fake.token_interval)
+
+    def _replay(self, body):
+        fake = self.fake
+        record, matched = fake.recordings.lookup(request_key(body))
+        fake._count(replay_matched=int(matched), replay_unmatched=int(not matched))
+        speed = fake.replay_speed or 1.0
+        time.sleep(record.get("first_byte", record["latency"]) / speed)
+        if record["status"] != 200:
+            fake._count_error(record["status"])
+            return self._send_json(record["status"], record.get("error") or {"message": "Recorded failure"})
+        content = record["content"]
+        words = max(1, len(content.split()))
+        interval = max(0.0, record["latency"] - record.get("first_byte", record["latency"])) / words / speed
+        fake._count(completion_tokens=words)
+        self._respond(body, content, interval)
+
+    def _respond(self, body, content, token_interval):
+        model = body.get("model", "fake")
+        if not body.get("stream"):
+            return self._send_json(200, completion_body(model, content))
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        chunk_id = f"fake-{random.getrandbits(48):x}"
+        words = content.split(" ")
+        for i, word in enumerate(words):
+            token = word if i == 0 else " " + word
+            self.wfile.write(f"data: {json.dumps(chunk_body(chunk_id, model, token))}\n\n".encode())
+            self.wfile.flush()
+            if token_interval:
+                time.sleep(token_interval)
+        self.wfile.write(f"data: {json.dumps(chunk_body(chunk_id, model, '', 'stop'))}\n\n".encode())
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+
+    def _proxy(self, body, raw):
+        """Forward the request to the real API, relay the answer and record it."""
+        import httpx
+
+        fake = self.fake
+        headers = {"Authorization": f"Bearer {fake.api_key}", "Content-Type": "application/json"}
+        if body.get("stream"):
+            headers["Accept"] = "text/event-stream"
+        started = time.monotonic()
+        record = {"key": request_key(body), "model": body.get("model"), "stream": bool(body.get("stream")), "images": image_parts(body)}
+        with httpx.Client(timeout=120) as client:
+            with client.stream("POST", fake.upstream + CHAT_PATH, content=raw, headers=headers) as upstream:
+                record["status"] = upstream.status_code
+                if upstream.status_code != 200:
+                    data = upstream.read()
+                    record["latency"] = time.monotonic() - started
+                    record["error"] = json.loads(data or b"{}")
+                    fake._count_error(upstream.status_code)
+                    self._send_json(upstream.status_code, record["error"])
+                elif body.get("stream"):
+                    self.send_response(200)
+                    self.send_header("Content-Type", "text/event-stream")
+                    self.send_header("Connection", "close")
+                    self.end_headers()
+                    self.close_connection = True
+                    tokens = []
+                    for line in upstream.iter_lines():
+                        if line.startswith("data: ") and line != "data: [DONE]":
+                            record.setdefault("first_byte", time.monotonic() - started)
+                            delta = json.loads(line[6:])["choices"][0]["delta"]
+                            tokens.append(delta.get("content") or "")
+                        self.wfile.write(line.encode() + b"\n")
+                        self.wfile.flush()
+                    record["content"] = "".join(tokens)
+                    record["latency"] = time.monotonic() - started
+                else:
+                    data = json.loads(upstream.read())
+                    record["latency"] = time.monotonic() - started
+                    record["content"] = data["choices"][0]["message"]["content"]
+                    self._send_json(200, data)
+
+        with fake._record_lock, open(fake.record, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record) + "\n")
+        fake._count(recorded=1)
+
+
+def serve(fake, host="127.0.0.1", port=0):
+    """Start the fake server on a background thread; returns the server, with its URL in server.url."""
+    handler = type("FakeMistralHandler", (Handler,), {"fake": fake})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.url = f"http://{host}:{server.server_port}"
+    server.fake = fake
+    threading.Thread(target=server.serve_forever, name="fake-mistral", daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    """Fake server options, shared with load_test.py."""
+    parser.add_argument("--latency", default="lognormal:0.6,0.4", help="time to answer: fixed:S, uniform:A,B, normal:MEAN,SD or lognormal:MEDIAN,SIGMA")
+    parser.add_argument("--image-latency", type=float, default=0.5, help="extra seconds per image in the request")
+    parser.add_argument("--token-interval", type=float, default=0.02, help="seconds between streamed tokens")
+    parser.add_argument("--tokens", type=int, default=24, help="words per synthesized answer")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-codes", default="429,500,503", help="statuses drawn for injected failures")
+    parser.add_argument("--record", help="proxy to the real API and append each exchange to this JSONL file")
+    parser.add_argument("--upstream", default=REAL_API_URL, help="API proxied to when recording")
+    parser.add_argument("--replay", help="answer with the exchanges recorded in this JSONL file")
+    parser.add_argument("--replay-speed", type=float, default=1.0, help="replay recorded latencies this many times faster")
+    parser.add_argument("--seed", type=int, help="seed for repeatable latencies and failures")
+
+
+def from_arguments(args):
+    return FakeMistral(
+        latency=args.latency,
+        image_latency=args.image_latency,
+        token_interval=args.token_interval,
+        tokens=args.tokens,
+        error_rate=args.error_rate,
+        error_codes=[int(code) for code in args.error_codes.split(",") if code],
+        record=args.record,
+        upstream=args.upstream,
+        replay=args.replay,
+        replay_speed=args.replay_speed,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake Mistral chat completions server for load tests")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.record and not os.getenv("MISTRAL_API_KEY"):
+        sys.exit("Recording needs MISTRAL_API_KEY for the real API")
+    server = serve(from_arguments(args), args.host, args.port)
+    print(f"Fake Mistral listening on {server.url}, set MISTRAL_SERVER_URL={server.url}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,329 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timezone
+
+import httpx
+
+import fake_mistral
+
+# Drives login, chat, streaming chat and upload flows against app.py at a set concurrency.
+# By default the app is started in a subprocess against an in-process fake Mistral server:
+#   python benchmarks/load_test.py --concurrency 16 --duration 60 --output results.json
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_IMAGES = os.path.join(REPO_ROOT, "demonstration")
+DEFAULT_PERSONAS = "radiologist,mental_health,report_explainer,general_doctor,dietitian"
+MESSAGES = (
+    "What does a hairline fracture look like?",
+    "Is a resting heart rate of 95 normal?",
+    "How much protein should I eat per day?",
+    "What does an elevated ALT mean on my blood report?",
+    "I have trouble sleeping before exams, any advice?",
+)
+PASSWORD = "load-test-password"
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def summarize(samples, seconds):
+    """Latency percentiles, throughput and error rate of a list of (latency, ok) samples."""
+    latencies = sorted(latency for latency, _ in samples)
+    errors = sum(1 for _, ok in samples if not ok)
+    return {
+        "requests": len(samples),
+        "errors": errors,
+        "error_rate": round(errors / len(samples), 4) if samples else 0.0,
+        "throughput_rps": round(len(samples) / seconds, 3) if seconds else 0.0,
+        "latency_mean": round(sum(latencies) / len(latencies), 4) if latencies else 0.0,
+        "latency_p50": round(percentile(latencies, 0.50), 4),
+        "latency_p95": round(percentile(latencies, 0.95), 4),
+        "latency_p99": round(percentile(latencies, 0.99), 4),
+        "latency_max": round(latencies[-1], 4) if latencies else 0.0,
+    }
+
+
+class Results:
+    """Thread-safe samples per flow."""
+
+    def __init__(self):
+        self._samples = {}
+        self._failures = {}
+        self._lock = threading.Lock()
+
+    def add(self, flow, latency, ok, failure=None):
+        with self._lock:
+            self._samples.setdefault(flow, []).append((latency, ok))
+            if failure:
+                key = f"{flow}: {failure}"
+                self._failures[key] = self._failures.get(key, 0) + 1
+
+    def report(self, seconds):
+        with self._lock:
+            flows = {flow: summarize(samples, seconds) for flow, samples in sorted(self._samples.items())}
+            everything = [sample for samples in self._samples.values() for sample in samples]
+            return {"overall": summarize(everything, seconds), "flows": flows, "failures": dict(self._failures)}
+
+
+class VirtualUser:
+    """One signed-up user with its own session cookie, running flows in a loop."""
+
+    def __init__(self, base_url, email, personas, images, results, unique_uploads=True, timeout=120):
+        self.client = httpx.Client(base_url=base_url, timeout=timeout, follow_redirects=False)
+        self.email = email
+        self.personas = personas
+        self.images = images
+        self.results = results
+        self.unique_uploads = unique_uploads
+
+    def timed(self, flow, call):
+        started = time.perf_counter()
+        try:
+            failure = call()
+        except httpx.HTTPError as e:
+            failure = type(e).__name__
+        self.results.add(flow, time.perf_counter() - started, failure is None, failure)
+
+    def signup(self):
+        form = {"email": self.email, "password": PASSWORD, "name": "Load Test", "dob": "1990-01-01", "gender": "other", "weight": "70"}
+        response = self.client.post("/signup", data=form)
+        return None if response.status_code in (200, 302) else f"HTTP {response.status_code}"
+
+    def login(self):
+        response = self.client.post("/login", data={"email": self.email, "password": PASSWORD})
+        # A successful login redirects to the dashboard, a failed one renders the form again
+        if response.status_code != 302:
+            return f"HTTP {response.status_code}"
+        return None
+
+    def chat(self):
+        persona = random.choice(self.personas)
+        response = self.client.post(f"/{persona}_chat", json={"message": random.choice(MESSAGES)})
+        if response.status_code != 200:
+            return f"HTTP {response.status_code}"
+        return None if response.json().get("response") else "empty response"
+
+    def stream(self):
+        persona = random.choice(self.personas)
+        started = time.perf_counter()
+        first_token = None
+        event = None
+        with self.client.stream("POST", f"/{persona}_chat?stream=true", json={"message": random.choice(MESSAGES)}) as response:
+            if response.status_code != 200:
+                return f"HTTP {response.status_code}"
+            for line in response.iter_lines():
+                if line.startswith("event: "):
+                    event = line[7:]
+                elif line.startswith("data: ") and first_token is None:
+                    first_token = time.perf_counter() - started
+        if first_token is not None:
+            self.results.add("stream_first_token", first_token, True)
+        return None if event == "done" else f"stream ended with {event or 'no event'}"
+
+    def upload(self):
+        persona = random.choice(self.personas)
+        path = random.choice(self.images)
+        with open(path, "rb") as f:
+            data = f.read()
+        if self.unique_uploads:
+            # Trailing bytes change the hash, so the app cannot answer from its analysis store
+            data += os.urandom(16)
+        files = {"file": (os.path.basename(path), data)}
+        response = self.client.post(f"/upload_file?chat_type={persona}", files=files)
+        if response.status_code != 200:
+            return f"HTTP {response.status_code}"
+        return None if response.json().get("response") else "empty response"
+
+    def run(self, flows, weights, deadline, remaining):
+        self.timed("signup", self.signup)
+        self.timed("login", self.login)
+        while time.monotonic() < deadline and remaining():
+            flow = random.choices(flows, weights)[0]
+            self.timed(flow, getattr(self, flow))
+        self.client.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_app(mistral_url, port, workdir, command=None, env=None):
+    """Start app.py in a subprocess against mistral_url; returns the process once it answers.
+
+    env adds to (or overrides) the environment the app is started with.
+    """
+    env = dict(os.environ, MISTRAL_SERVER_URL=mistral_url, PYTHONPATH=REPO_ROOT, PORT=str(port), **(env or {}))
+    env.setdefault("MISTRAL_API_KEY", "load-test")
+    if command is None:
+        command = [sys.executable, "-c", f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    log = open(os.path.join(workdir, "app.log"), "ab")
+    process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError(f"The app exited with {process.returncode}, see {log.name}")
+        try:
+            httpx.get(base_url + "/", timeout=1)
+            return process, base_url
+        except httpx.HTTPError:
+            time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError(f"The app did not start, see {log.name}")
+
+
+def parse_mix(mix):
+    """'chat=5,stream=3,upload=1' -> (flows, weights)."""
+    flows, weights = [], []
+    for item in mix.split(","):
+        flow, _, weight = item.partition("=")
+        if flow not in ("chat", "stream", "upload"):
+            raise ValueError(f"Unknown flow: {flow}")
+        flows.append(flow)
+        weights.append(float(weight or 1))
+    return flows, weights
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(report, baseline_path):
+    """Print the change in p95 latency and error rate per flow against an earlier result file."""
+    with open(baseline_path, encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\nAgainst {baseline_path} ({baseline.get('revision')}):")
+    for flow, stats in report["flows"].items():
+        before = baseline["flows"].get(flow)
+        if not before:
+            continue
+        change = (stats["latency_p95"] - before["latency_p95"]) / before["latency_p95"] * 100 if before["latency_p95"] else 0.0
+        print(f"  {flow:20} p95 {before['latency_p95']:.3f}s -> {stats['latency_p95']:.3f}s ({change:+.1f}%), "
+              f"errors {before['error_rate']:.2%} -> {stats['error_rate']:.2%}")
+
+
+def print_report(report):
+    print(f"{'flow':20} {'requests':>9} {'err%':>7} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for flow, stats in list(report["flows"].items()) + [("overall", report["overall"])]:
+        print(f"{flow:20} {stats['requests']:>9} {stats['error_rate']:>7.2%} {stats['throughput_rps']:>8.2f} "
+              f"{stats['latency_p50']:>8.3f} {stats['latency_p95']:>8.3f} {stats['latency_p99']:>8.3f}")
+    for failure, count in sorted(report["failures"].items()):
+        print(f"  {count} x {failure}")
+
+
+def run(args):
+    flows, weights = parse_mix(args.mix)
+    personas = args.personas.split(",")
+    images = sorted(os.path.join(args.images, name) for name in os.listdir(args.images)
+                    if name.lower().endswith((".png", ".jpg", ".jpeg", ".gif", ".dcm")))
+    if "upload" in flows and not images:
+        raise SystemExit(f"No images in {args.images}")
+
+    fake_server = None
+    mistral_url = args.mistral_url
+    if not mistral_url and not args.base_url:
+        fake_server = fake_mistral.serve(fake_mistral.from_arguments(args))
+        mistral_url = fake_server.url
+        logging.info(f"Fake Mistral server on {mistral_url}")
+
+    app_process = None
+    base_url = args.base_url
+    if not base_url:
+        workdir = args.workdir or tempfile.mkdtemp(prefix="pixtalogy-load-")
+        os.makedirs(workdir, exist_ok=True)
+        port = args.port or free_port()
+        command = args.app_command.format(port=port).split() if args.app_command else None
+        app_process, base_url = start_app(mistral_url, port, workdir, command)
+        logging.info(f"App on {base_url}, working directory {workdir}")
+
+    results = Results()
+    run_id = f"{int(time.time())}-{os.getpid()}"
+    deadline = time.monotonic() + args.duration
+    issued = [0]
+    issued_lock = threading.Lock()
+
+    def remaining():
+        # With --requests, stop once that many flows have been started across all users
+        if not args.requests:
+            return True
+        with issued_lock:
+            issued[0] += 1
+            return issued[0] <= args.requests
+
+    users = [VirtualUser(base_url, f"load-{run_id}-{i}@example.com", personas, images, results, not args.repeat_uploads, args.timeout)
+             for i in range(args.concurrency)]
+    threads = [threading.Thread(target=user.run, args=(flows, weights, deadline, remaining), name=f"user-{i}") for i, user in enumerate(users)]
+    started = time.monotonic()
+    try:
+        for thread in threads:
+            thread.start()
+            if args.ramp_up:
+                time.sleep(args.ramp_up / len(threads))
+        for thread in threads:
+            thread.join()
+    finally:
+        seconds = time.monotonic() - started
+        if app_process:
+            app_process.terminate()
+            app_process.wait(timeout=10)
+
+    report = results.report(seconds)
+    report.update(
+        started_at=datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        revision=git_revision(),
+        seconds=round(seconds, 3),
+        settings={name: value for name, value in vars(args).items() if name not in ("output", "compare")},
+        fake_mistral=fake_server.fake.stats() if fake_server else None,
+    )
+    if fake_server:
+        fake_server.shutdown()
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test app.py against a fake or recorded Mistral API")
+    parser.add_argument("--concurrency", type=int, default=8, help="virtual users, each with its own session")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run")
+    parser.add_argument("--requests", type=int, default=0, help="stop after this many flows in total (0 runs for --duration)")
+    parser.add_argument("--ramp-up", type=float, default=0, help="seconds over which users are started")
+    parser.add_argument("--mix", default="chat=5,stream=3,upload=2", help="flow weights")
+    parser.add_argument("--personas", default=DEFAULT_PERSONAS)
+    parser.add_argument("--images", default=DEFAULT_IMAGES, help="directory of images to upload")
+    parser.add_argument("--repeat-uploads", action="store_true", help="upload the images unchanged, so repeats hit the analysis store")
+    parser.add_argument("--timeout", type=float, default=120, help="client timeout per request")
+    parser.add_argument("--base-url", help="test an already running app instead of starting one")
+    parser.add_argument("--mistral-url", help="Mistral API the started app uses instead of the in-process fake")
+    parser.add_argument("--app-command", help="command that starts the app, {port} is substituted")
+    parser.add_argument("--port", type=int, help="port for the started app")
+    parser.add_argument("--workdir", help="working directory of the started app (default: a new temporary directory)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    parser.add_argument("--compare", help="earlier results file to compare against")
+    fake_mistral.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)  # one line per request drowns the report
+    report = run(args)
+    print_report(report)
+    if args.compare:
+        compare(report, args.compare)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
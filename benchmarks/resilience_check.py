@@ -0,0 +1,200 @@
+import os
+import re
+import sys
+import json
+import uuid
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+import fake_mistral
+from load_test import MESSAGES, Results, VirtualUser, free_port, start_app, git_revision
+
+# Injects slow and failing upstream responses through the fake Mistral server and checks that the
+# app's resilience layer reacts: a call stops at its deadline, hedges fire for slow calls without
+# going past the in-flight cap, failed attempts are retried, client errors neither open the circuit
+# breaker nor reset its failure count, and once it is open calls are refused without reaching upstream.
+#   python benchmarks/resilience_check.py --output resilience.json
+# Exits with status 1 if a check fails.
+# A failed chat makes two failed attempts, so the second failed chat is the one that opens the breaker
+MAX_ATTEMPTS = 2
+BREAKER_FAILURES = 3
+_SAMPLE = re.compile(r'^pixtalogy_upstream_calls\{(.*)\} (\S+)$')
+_LABEL = re.compile(r'(\w+)="([^"]*)"')
+
+
+def upstream_stats(client):
+    """The app's upstream call counters and breaker state, read from /metrics."""
+    stats = {}
+    for line in client.get("/metrics").text.splitlines():
+        match = _SAMPLE.match(line)
+        if match:
+            labels = dict(_LABEL.findall(match.group(1)))
+            stats["breaker_state"] = labels.get("breaker_state")
+            stats[labels["field"]] = float(match.group(2))
+    return stats
+
+
+def chat(user, persona):
+    # A new message every time, so neither the response cache nor coalescing answers it
+    message = f"{random.choice(MESSAGES)} ({uuid.uuid4().hex[:8]})"
+    return user.client.post(f"/{persona}_chat", json={"message": message}).status_code
+
+
+def run_phase(users, persona, requests):
+    """Send requests chats spread over the users, each user one at a time; returns the status codes."""
+    statuses = []
+    lock = threading.Lock()
+
+    def work(user, count):
+        for _ in range(count):
+            status = chat(user, persona)
+            with lock:
+                statuses.append(status)
+
+    threads = [threading.Thread(target=work, args=(user, requests // len(users) + (i < requests % len(users))))
+               for i, user in enumerate(users)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses
+
+
+def run(args):
+    fake = fake_mistral.FakeMistral(latency="fixed:0.05", image_latency=0.0, seed=args.seed)
+    fake_server = fake_mistral.serve(fake)
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pixtalogy-resilience-")
+    os.makedirs(workdir, exist_ok=True)
+    env = {
+        "MISTRAL_CALL_DEADLINE": str(args.deadline),
+        "MISTRAL_HEDGE_AFTER": str(args.hedge_after),
+        "MISTRAL_BREAKER_FAILURES": str(BREAKER_FAILURES),
+        "MISTRAL_BREAKER_RESET": "600",  # stays open for the rest of the run
+        "MISTRAL_MAX_ATTEMPTS": str(MAX_ATTEMPTS),
+        "MISTRAL_BACKOFF_BASE": "0.05",
+        "MISTRAL_BACKOFF_MAX": "0.2",
+        "UPSTREAM_MAX_IN_FLIGHT": str(args.max_in_flight),
+        # Rate limits are not what is tested here
+        "UPSTREAM_USER_RATE": "1000",
+        "UPSTREAM_USER_BURST": "1000",
+    }
+    app_process, base_url = start_app(fake_server.url, free_port(), workdir, env=env)
+    logging.info(f"App on {base_url}, working directory {workdir}")
+
+    checks = []
+
+    def check(name, passed, **details):
+        checks.append({"check": name, "passed": bool(passed), **details})
+        logging.info(f"{'PASS' if passed else 'FAIL'} {name} {details}")
+
+    try:
+        users = [VirtualUser(base_url, f"resilience-{uuid.uuid4().hex[:8]}-{i}@example.com", [args.persona], [], Results())
+                 for i in range(args.max_in_flight * 3)]
+        for user in users:
+            if user.signup() or user.login():
+                raise SystemExit(f"Could not sign up, see {workdir}/app.log")
+        # The first chat builds the Mistral client, which would count against the timed call below
+        chat(users[0], args.persona)
+
+        # An upstream slower than the whole deadline: the call gives up in time
+        fake.latency = fake_mistral.parse_latency(f"fixed:{args.deadline * 2}")
+        before = upstream_stats(users[0].client)
+        started = time.monotonic()
+        chat(users[0], args.persona)
+        seconds = time.monotonic() - started
+        after = upstream_stats(users[0].client)
+        check("a call stops at its deadline", seconds < args.deadline + 1.5 and after["timeouts"] > before["timeouts"],
+              seconds=round(seconds, 2), deadline=args.deadline, timeouts=after["timeouts"] - before["timeouts"])
+
+        # Slow answers with free slots: hedges fire
+        fake.latency = fake_mistral.parse_latency(f"uniform:{args.hedge_after / 2},{args.hedge_after * 5}")
+        fake.reset()
+        before = upstream_stats(users[0].client)
+        run_phase(users[:1], args.persona, args.requests)
+        after = upstream_stats(users[0].client)
+        check("hedges fire for slow calls", after["hedges"] > before["hedges"],
+              hedges=after["hedges"] - before["hedges"], hedge_wins=after["hedge_wins"] - before["hedge_wins"])
+
+        # Slow answers with every slot busy: hedges do not take the app past its in-flight cap
+        fake.reset()
+        before = upstream_stats(users[0].client)
+        run_phase(users, args.persona, args.requests * 3)
+        after = upstream_stats(users[0].client)
+        check("upstream requests stay within the in-flight cap", fake.stats()["max_in_flight"] <= args.max_in_flight,
+              max_in_flight=fake.stats()["max_in_flight"], cap=args.max_in_flight,
+              hedges=after["hedges"] - before["hedges"], hedges_skipped=after["hedges_skipped"] - before["hedges_skipped"])
+
+        # Failures with client errors in between: a 4xx says nothing about upstream, so it
+        # neither opens the breaker nor resets its count of failures
+        fake.latency = fake_mistral.parse_latency("fixed:0.02")
+        fake.error_rate = 1.0
+        fake.error_codes = (503,)
+        before = upstream_stats(users[0].client)
+        chat(users[0], args.persona)
+        after = upstream_stats(users[0].client)
+        check("failed attempts are retried", after["retries"] - before["retries"] == MAX_ATTEMPTS - 1,
+              retries=after["retries"] - before["retries"], breaker_state=after["breaker_state"])
+        fake.error_codes = (422,)
+        run_phase(users[:1], args.persona, BREAKER_FAILURES * 2)
+        after = upstream_stats(users[0].client)
+        check("client errors leave the breaker closed", after["breaker_state"] == "closed", breaker_state=after["breaker_state"])
+        fake.error_codes = (503,)
+        fake.reset()
+        # Opens on this call's first attempt only if the client errors did not reset the count
+        chat(users[0], args.persona)
+        after = upstream_stats(users[0].client)
+        check("client errors do not reset the failure count", after["breaker_state"] == "open" and fake.stats()["requests"] == 1,
+              breaker_state=after["breaker_state"], upstream_requests=fake.stats()["requests"])
+
+        # Outage: with the breaker open, calls are refused without reaching upstream
+        fake.reset()
+        before = upstream_stats(users[0].client)
+        run_phase(users[:1], args.persona, args.requests)
+        after = upstream_stats(users[0].client)
+        check("an open breaker refuses calls without reaching upstream",
+              after["breaker_rejections"] - before["breaker_rejections"] == args.requests and fake.stats()["requests"] == 0,
+              breaker_rejections=after["breaker_rejections"] - before["breaker_rejections"], upstream_requests=fake.stats()["requests"])
+        for user in users:
+            user.client.close()
+    finally:
+        app_process.terminate()
+        app_process.wait(timeout=10)
+        fake_server.shutdown()
+
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "settings": env,
+        "checks": checks,
+        "passed": all(item["passed"] for item in checks),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check deadlines, retries, breaker and hedging against injected upstream faults")
+    parser.add_argument("--persona", default="general_doctor")
+    parser.add_argument("--requests", type=int, default=12, help="chats per phase")
+    parser.add_argument("--deadline", type=float, default=3, help="the app's time budget per upstream call, in seconds")
+    parser.add_argument("--hedge-after", type=float, default=0.3, help="seconds before a slow call is hedged")
+    parser.add_argument("--max-in-flight", type=int, default=2, help="the app's upstream in-flight cap")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="working directory of the started app (default: a new temporary directory)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    report = run(args)
+    for item in report["checks"]:
+        details = ", ".join(f"{name}={value}" for name, value in item.items() if name not in ("check", "passed"))
+        print(f"{'PASS' if item['passed'] else 'FAIL'}  {item['check']} ({details})")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    sys.exit(0 if report["passed"] else 1)
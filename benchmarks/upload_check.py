@@ -0,0 +1,129 @@
+import io
+import os
+import sys
+import json
+import random
+import zipfile
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timezone
+
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_pipeline
+import fake_mistral
+from load_test import Results, VirtualUser, free_port, start_app, git_revision
+
+# Checks on the upload path that are easy to get wrong with real scans:
+# 16-bit grayscale images (the usual X-ray export) keep their contrast when
+# converted to the 8-bit images sent to the model and shown as thumbnails,
+# and a series larger than a user's rate limit burst is analysed in full by
+# an app started against the fake Mistral server with its default limits.
+#   python benchmarks/upload_check.py --output upload_check.json
+# Exits with status 1 if a check fails.
+SATURATED_LIMIT = 0.05  # share of pixels at 255 still accepted; clipping puts most of them there
+
+
+def make_16bit_scan(path, side, depth, seed):
+    """Write a 16-bit grayscale PNG of noise using depth bits, like a 12-bit X-ray detector's export."""
+    rng = random.Random(seed)
+    values = [rng.randrange(2 ** depth) for _ in range(side * side)]
+    image = Image.frombytes("I;16", (side, side), b"".join(value.to_bytes(2, "little") for value in values))
+    image.save(path)
+    return path
+
+
+def saturated(image):
+    """Share of the pixels of an 8-bit grayscale image that are at 255."""
+    return image.histogram()[255] / (image.width * image.height)
+
+
+def check_16bit(workdir, check, seed):
+    path = make_16bit_scan(os.path.join(workdir, "scan-16bit.png"), 512, 12, seed)
+    processed = image_pipeline.preprocess_image(path)
+    with Image.open(io.BytesIO(processed.data) if processed.data is not None else path) as image:
+        mode = image.mode
+        share = saturated(image.convert("L")) if mode == "L" else 1.0
+    check("a 16-bit scan is rescaled, not clipped, for the model", mode == "L" and share <= SATURATED_LIMIT,
+          mode=mode, saturated=round(share, 4))
+    thumbnail = image_pipeline.make_thumbnail(path, os.path.join(workdir, "scan-16bit-thumbnail.jpg"))
+    with Image.open(thumbnail) as image:
+        share = saturated(image.convert("L"))
+    check("a 16-bit scan is rescaled, not clipped, in its thumbnail", share <= SATURATED_LIMIT, saturated=round(share, 4))
+
+
+def make_series(images, seed):
+    """A ZIP of small PNG slices, each different so none is answered from another's analysis."""
+    rng = random.Random(seed)
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w") as archive:
+        for index in range(images):
+            image = Image.frombytes("L", (64, 64), bytes(rng.randrange(256) for _ in range(64 * 64)))
+            data = io.BytesIO()
+            image.save(data, format="PNG")
+            archive.writestr(f"series/slice-{index:03d}.png", data.getvalue())
+    return buffer.getvalue()
+
+
+def check_batch(workdir, check, images, persona, seed):
+    fake = fake_mistral.FakeMistral(latency="fixed:0.05", image_latency=0.05, seed=seed)
+    fake_server = fake_mistral.serve(fake)
+    app_process, base_url = start_app(fake_server.url, free_port(), workdir)
+    try:
+        user = VirtualUser(base_url, f"upload-check-{seed}-{images}@example.com", [persona], [], Results())
+        if user.signup() or user.login():
+            raise SystemExit(f"Could not sign up, see {workdir}/app.log")
+        response = user.client.post(f"/upload_batch?chat_type={persona}",
+                                    files={"files": ("series.zip", make_series(images, seed), "application/zip")})
+        summary = json.loads(response.text.splitlines()[-1]) if response.status_code == 200 else {}
+        check(f"a series of {images} images, more than the rate limit burst, is analysed in full",
+              summary.get("succeeded") == images, status=response.status_code,
+              succeeded=summary.get("succeeded"), failed=summary.get("failed"))
+        user.client.close()
+    finally:
+        app_process.terminate()
+        app_process.wait(timeout=10)
+        fake_server.shutdown()
+
+
+def run(args):
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pixtalogy-upload-check-")
+    os.makedirs(workdir, exist_ok=True)
+    checks = []
+
+    def check(name, passed, **details):
+        checks.append({"check": name, "passed": bool(passed), **details})
+        logging.info(f"{'PASS' if passed else 'FAIL'} {name} {details}")
+
+    check_16bit(workdir, check, args.seed)
+    check_batch(workdir, check, args.batch_images, args.persona, args.seed)
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "checks": checks,
+        "passed": all(item["passed"] for item in checks),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check image conversion and batch uploads on the upload path")
+    parser.add_argument("--batch-images", type=int, default=12, help="images in the uploaded series")
+    parser.add_argument("--persona", default="radiologist")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--workdir", help="where test files are written and the app runs (default: a new temporary directory)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    report = run(args)
+    for item in report["checks"]:
+        details = ", ".join(f"{name}={value}" for name, value in item.items() if name not in ("check", "passed"))
+        print(f"{'PASS' if item['passed'] else 'FAIL'}  {item['check']} ({details})")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    sys.exit(0 if report["passed"] else 1)
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import logging
+import argparse
+import tempfile
+from datetime import datetime, timezone
+
+import fake_mistral
+from load_test import Results, VirtualUser, free_port, start_app, git_revision
+
+# Peak resident memory of the app per upload, by upload size. Linux only: the
+# peak is read from /proc/<pid>/status (VmHWM) and reset through clear_refs
+# before every upload.
+#   python benchmarks/upload_memory.py --kind document --sizes 8,32,128 --output memory.json
+MB = 1024 * 1024
+
+
+def memory(pid):
+    """(current, peak) resident set size of a process in bytes."""
+    values = {}
+    with open(f"/proc/{pid}/status", encoding="ascii") as f:
+        for line in f:
+            name, _, value = line.partition(":")
+            if name in ("VmRSS", "VmHWM"):
+                values[name] = int(value.split()[0]) * 1024
+    return values["VmRSS"], values["VmHWM"]
+
+
+def reset_peak(pid):
+    # Writing 5 sets VmHWM back to the current RSS
+    with open(f"/proc/{pid}/clear_refs", "w", encoding="ascii") as f:
+        f.write("5")
+
+
+def make_file(directory, kind, size):
+    """Write an upload of about size bytes; random content, so nothing compresses it away."""
+    if kind == "image":
+        from PIL import Image
+        side = max(1, int((size / 3) ** 0.5))
+        path = os.path.join(directory, f"noise-{size}.png")
+        Image.frombytes("RGB", (side, side), os.urandom(side * side * 3)).save(path, compress_level=1)
+    else:
+        path = os.path.join(directory, f"document-{size}.pdf")
+        with open(path, "wb") as f:
+            for _ in range(size // MB):
+                f.write(os.urandom(MB))
+            f.write(os.urandom(size % MB))
+    return path
+
+
+def upload(client, path, persona, timeout):
+    boundary = os.urandom(16).hex()
+    head = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"file\"; filename=\"{os.path.basename(path)}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    def content():
+        # Streamed from disk, so the client never holds the file either
+        yield head
+        with open(path, "rb") as f:
+            yield from iter(lambda: f.read(MB), b"")
+        yield tail
+
+    headers = {
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+        "Content-Length": str(len(head) + os.path.getsize(path) + len(tail)),
+    }
+    return client.post(f"/upload_file?chat_type={persona}", content=content(), headers=headers, timeout=timeout)
+
+
+def run(args):
+    if not os.path.exists("/proc/self/clear_refs"):
+        raise SystemExit("Peak RSS is read from /proc, this benchmark only runs on Linux")
+    fake_server = fake_mistral.serve(fake_mistral.from_arguments(args))
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pixtalogy-memory-")
+    os.makedirs(workdir, exist_ok=True)
+    app_process, base_url = start_app(fake_server.url, free_port(), workdir)
+    logging.info(f"App on {base_url}, working directory {workdir}")
+
+    uploads = []
+    try:
+        user = VirtualUser(base_url, f"memory-{int(time.time())}@example.com", [args.persona], [], Results(), timeout=args.timeout)
+        if user.signup() or user.login():
+            raise SystemExit(f"Could not sign up, see {workdir}/app.log")
+        # One small upload first, so imports and caches are not counted against the first size
+        warm_up = make_file(workdir, args.kind, 64 * 1024)
+        upload(user.client, warm_up, args.persona, args.timeout)
+
+        for size in [int(float(value) * MB) for value in args.sizes.split(",")]:
+            path = make_file(workdir, args.kind, size)
+            file_size = os.path.getsize(path)
+            samples = []
+            for _ in range(args.repeat):
+                reset_peak(app_process.pid)
+                before, _ = memory(app_process.pid)
+                started = time.perf_counter()
+                response = upload(user.client, path, args.persona, args.timeout)
+                seconds = time.perf_counter() - started
+                after, peak = memory(app_process.pid)
+                samples.append({
+                    "status": response.status_code,
+                    "seconds": round(seconds, 3),
+                    "rss_before": before,
+                    "rss_after": after,
+                    "peak_rss": peak,
+                    "peak_increase": peak - before,
+                })
+            worst = max(samples, key=lambda sample: sample["peak_increase"])
+            uploads.append(dict(worst, size=file_size, ratio=round(worst["peak_increase"] / file_size, 3), samples=samples))
+            os.remove(path)
+    finally:
+        app_process.terminate()
+        app_process.wait(timeout=10)
+        fake_server.shutdown()
+
+    return {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "revision": git_revision(),
+        "kind": args.kind,
+        "uploads": uploads,
+    }
+
+
+def print_report(report):
+    print(f"{report['kind']} uploads at {report['revision']}")
+    print(f"{'size MB':>9} {'status':>7} {'seconds':>8} {'peak +MB':>9} {'x size':>7}")
+    for item in report["uploads"]:
+        print(f"{item['size'] / MB:>9.1f} {item['status']:>7} {item['seconds']:>8.2f} "
+              f"{item['peak_increase'] / MB:>9.1f} {item['ratio']:>7.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the app's peak RSS per upload size")
+    parser.add_argument("--kind", choices=("document", "image"), default="document",
+                        help="random bytes sent as a PDF, or a noise PNG that goes through preprocessing and the model")
+    parser.add_argument("--sizes", default="1,8,32,128", help="upload sizes in MB")
+    parser.add_argument("--repeat", type=int, default=3, help="uploads per size; the worst peak is reported")
+    parser.add_argument("--persona", default="radiologist")
+    parser.add_argument("--timeout", type=float, default=300)
+    parser.add_argument("--workdir", help="working directory of the started app (default: a new temporary directory)")
+    parser.add_argument("--output", help="write the results as JSON to this file")
+    fake_mistral.add_arguments(parser)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("httpx").setLevel(logging.WARNING)
+    report = run(args)
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
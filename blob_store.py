@@ -0,0 +1,367 @@
+import os
+import sys
+import glob
+import time
+import hashlib
+import logging
+import sqlite3
+import argparse
+import tempfile
+import threading
+import weakref
+from collections import namedtuple
+
+# Content-addressed upload storage: user_data/blobs/<aa>/<bb>/<sha256>
+# Absolute, send_file would resolve a relative path against the app root instead of the working directory;
+# the index is resolved the same way, so it never ends up apart from the blobs it indexes
+BLOB_ROOT = os.path.abspath(os.getenv("BLOB_ROOT", os.path.join("user_data", "blobs")))
+INDEX_PATH = os.path.abspath(os.getenv("BLOB_INDEX_PATH", os.path.join("user_data", "uploads.db")))
+CHUNK_SIZE = 1024 * 1024
+UPLOAD_QUOTA_BYTES = int(os.getenv("UPLOAD_QUOTA_BYTES", 0))  # bytes each user may store, 0 for no limit
+
+# Leading bytes of the formats uploads come in; DICOM has its magic after a 128 byte preamble
+MAGIC_NUMBERS = (
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (128, b"DICM", "application/dicom"),
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"PK\x03\x04", "application/zip"),
+)
+SNIFF_BYTES = 132
+
+Upload = namedtuple("Upload", ["id", "user", "filename", "uploaded_at", "sha256", "size", "path", "duplicate"])
+
+_local = threading.local()
+
+
+class QuotaExceeded(Exception):
+    """Raised when an upload would take a user past UPLOAD_QUOTA_BYTES; maps to HTTP 413."""
+
+
+def _connection():
+    # One connection per thread, the index is shared by every worker process
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(INDEX_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(INDEX_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        if "user" not in [row[1] for row in conn.execute("PRAGMA table_info(analyses)")]:
+            # Analyses used to be shared by everyone with the same bytes, though each was written
+            # with its uploader's conversation history; they are dropped rather than handed out
+            conn.execute("DROP TABLE IF EXISTS analyses")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                sha256 TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                content_type TEXT,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                created_at REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS uploads (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user TEXT NOT NULL,
+                filename TEXT NOT NULL,
+                uploaded_at REAL NOT NULL,
+                sha256 TEXT NOT NULL REFERENCES blobs (sha256)
+            );
+            CREATE INDEX IF NOT EXISTS uploads_user ON uploads (user, uploaded_at);
+            CREATE TABLE IF NOT EXISTS analyses (
+                user TEXT NOT NULL,
+                sha256 TEXT NOT NULL,
+                persona TEXT NOT NULL,
+                response TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (user, sha256, persona)
+            );
+        """)
+        _local.conn = conn
+    return conn
+
+
+def blob_path(sha256):
+    """Return the sharded on-disk path of a blob."""
+    return os.path.join(BLOB_ROOT, sha256[:2], sha256[2:4], sha256)
+
+
+def thumbnail_path(sha256, size):
+    """Return where the cached thumbnail of a blob lives."""
+    return os.path.join(BLOB_ROOT, "thumbnails", sha256[:2], sha256[2:4], f"{sha256}-{size}.jpg")
+
+
+def _hash_stream(stream):
+    digest = hashlib.sha256()
+    size = 0
+    for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+        digest.update(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _write_temp(stream):
+    """Copy a stream into a temporary file inside the store, hashing as it goes."""
+    tmp_dir = os.path.join(BLOB_ROOT, "tmp")
+    os.makedirs(tmp_dir, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=tmp_dir)
+    with os.fdopen(fd, "wb") as f:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b""):
+            digest.update(chunk)
+            f.write(chunk)
+            size += len(chunk)
+    return tmp_path, digest.hexdigest(), size
+
+
+def sniff_content_type(head):
+    """Return the content type recognised from the first SNIFF_BYTES of a file, or None."""
+    for offset, magic, content_type in MAGIC_NUMBERS:
+        if head[offset:offset + len(magic)] == magic:
+            return content_type
+    return None
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class IncomingBlob:
+    """A file part of a request body, written into the store as it arrives.
+
+    Werkzeug's form parser writes the part here chunk by chunk (it is the
+    request's stream factory). Each chunk is hashed on the way through and
+    the first bytes are kept to sniff the content type, so save_stream only
+    has to move the finished file into place. Writing past limit bytes
+    raises QuotaExceeded while the rest of the body is still unread. The
+    temporary file is removed on close unless it was committed.
+    """
+
+    def __init__(self, limit=None):
+        tmp_dir = os.path.join(BLOB_ROOT, "tmp")
+        os.makedirs(tmp_dir, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=tmp_dir)
+        self.file = os.fdopen(fd, "w+b")
+        self.limit = limit
+        self.size = 0
+        self.head = b""
+        self._digest = hashlib.sha256()
+        self._remove = weakref.finalize(self, _remove_quietly, self.tmp_path)
+
+    def write(self, data):
+        self.size += len(data)
+        if self.limit is not None and self.size > self.limit:
+            raise QuotaExceeded(f"Upload quota of {UPLOAD_QUOTA_BYTES} bytes exceeded")
+        if len(self.head) < SNIFF_BYTES:
+            self.head += bytes(data[:SNIFF_BYTES - len(self.head)])
+        self._digest.update(data)
+        return self.file.write(data)
+
+    def __getattr__(self, name):
+        # read, seek, tell and the rest go to the temporary file
+        return getattr(self.file, name)
+
+    @property
+    def sha256(self):
+        return self._digest.hexdigest()
+
+    @property
+    def content_type(self):
+        return sniff_content_type(self.head)
+
+    def commit(self):
+        """Move the file to its blob path; returns (sha256, size, duplicate)."""
+        self.file.flush()
+        sha256 = self.sha256
+        duplicate = _blob_exists(sha256)
+        if not duplicate:
+            _commit_blob(self.tmp_path, sha256)
+            self._remove.detach()
+        return sha256, self.size, duplicate
+
+    def close(self):
+        self.file.close()
+        self._remove()
+
+
+def _blob_exists(sha256):
+    return os.path.exists(blob_path(sha256))
+
+
+def _commit_blob(tmp_path, sha256):
+    path = blob_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Atomic, so concurrent uploads of the same content cannot leave a partial blob
+    os.replace(tmp_path, path)
+
+
+def _add_reference(user, filename, sha256, size, content_type, uploaded_at):
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "INSERT INTO blobs (sha256, size, content_type, refcount, created_at) VALUES (?, ?, ?, 0, ?) "
+            "ON CONFLICT (sha256) DO NOTHING",
+            (sha256, size, content_type, uploaded_at),
+        )
+        conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = ?", (sha256,))
+        cursor = conn.execute(
+            "INSERT INTO uploads (user, filename, uploaded_at, sha256) VALUES (?, ?, ?, ?)",
+            (user, filename, uploaded_at, sha256),
+        )
+    return cursor.lastrowid
+
+
+def save_stream(user, filename, stream, content_type=None, uploaded_at=None):
+    """Store an upload stream and record it in the index.
+
+    An IncomingBlob is already hashed and on disk, it is only moved into
+    place. Other seekable streams are hashed first, so a duplicate upload
+    costs no write at all; the rest are hashed while they are copied into
+    the store.
+    """
+    uploaded_at = uploaded_at or time.time()
+    if isinstance(stream, IncomingBlob):
+        sha256, size, duplicate = stream.commit()
+        content_type = stream.content_type or content_type
+    elif stream.seekable():
+        start = stream.tell()
+        sha256, size = _hash_stream(stream)
+        duplicate = _blob_exists(sha256)
+        if not duplicate:
+            stream.seek(start)
+            tmp_path, sha256, size = _write_temp(stream)
+            _commit_blob(tmp_path, sha256)
+    else:
+        tmp_path, sha256, size = _write_temp(stream)
+        duplicate = _blob_exists(sha256)
+        if duplicate:
+            os.remove(tmp_path)
+        else:
+            _commit_blob(tmp_path, sha256)
+
+    upload_id = _add_reference(user, filename, sha256, size, content_type, uploaded_at)
+    logging.info(f"Stored upload {filename} for {user} as {sha256[:12]} ({'duplicate' if duplicate else 'new'}, {size} bytes)")
+    return Upload(upload_id, user, filename, uploaded_at, sha256, size, blob_path(sha256), duplicate)
+
+
+def save_upload(user, file):
+    """Store a Werkzeug FileStorage from request.files."""
+    return save_stream(user, file.filename, file.stream, content_type=file.mimetype)
+
+
+def used_bytes(user):
+    """Bytes stored for a user, counting every upload including duplicates."""
+    return _connection().execute(
+        "SELECT COALESCE(SUM(b.size), 0) FROM uploads u JOIN blobs b ON b.sha256 = u.sha256 WHERE u.user = ?",
+        (user,),
+    ).fetchone()[0]
+
+
+def remaining_quota(user):
+    """Bytes the user may still upload, or None when there is no quota."""
+    if not UPLOAD_QUOTA_BYTES:
+        return None
+    return max(0, UPLOAD_QUOTA_BYTES - used_bytes(user))
+
+
+def list_uploads(user):
+    rows = _connection().execute(
+        "SELECT u.id, u.user, u.filename, u.uploaded_at, u.sha256, b.size FROM uploads u "
+        "JOIN blobs b ON b.sha256 = u.sha256 WHERE u.user = ? ORDER BY u.uploaded_at",
+        (user,),
+    ).fetchall()
+    return [Upload(*row, blob_path(row[4]), False) for row in rows]
+
+
+def get_blob(sha256, user=None):
+    """Return (size, content_type) of a blob, optionally only if the user uploaded it."""
+    query = "SELECT b.size, b.content_type FROM blobs b WHERE b.sha256 = ?"
+    params = (sha256,)
+    if user is not None:
+        query += " AND EXISTS (SELECT 1 FROM uploads u WHERE u.sha256 = b.sha256 AND u.user = ?)"
+        params = (sha256, user)
+    return _connection().execute(query, params).fetchone()
+
+
+def delete_upload(upload_id):
+    """Drop one upload reference, deleting the blob when nothing else points at it."""
+    conn = _connection()
+    with conn:
+        row = conn.execute("SELECT sha256, user FROM uploads WHERE id = ?", (upload_id,)).fetchone()
+        if row is None:
+            return False
+        sha256, user = row
+        conn.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+        if not conn.execute("SELECT 1 FROM uploads WHERE user = ? AND sha256 = ?", (user, sha256)).fetchone():
+            conn.execute("DELETE FROM analyses WHERE user = ? AND sha256 = ?", (user, sha256))
+        conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = ?", (sha256,))
+        refcount = conn.execute("SELECT refcount FROM blobs WHERE sha256 = ?", (sha256,)).fetchone()[0]
+        if refcount <= 0:
+            conn.execute("DELETE FROM blobs WHERE sha256 = ?", (sha256,))
+            conn.execute("DELETE FROM analyses WHERE sha256 = ?", (sha256,))
+    if refcount <= 0:
+        for path in [blob_path(sha256)] + glob.glob(thumbnail_path(sha256, "*")):
+            if os.path.exists(path):
+                os.remove(path)
+    return True
+
+
+def get_analysis(user, sha256, persona):
+    """Return the LLM analysis of this blob recorded earlier for the user, if any.
+
+    Analyses are kept per user: each one was asked for with its user's
+    conversation history, which must not reach anyone else uploading the
+    same bytes.
+    """
+    row = _connection().execute(
+        "SELECT response FROM analyses WHERE user = ? AND sha256 = ? AND persona = ?", (user, sha256, persona)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def save_analysis(user, sha256, persona, response):
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO analyses (user, sha256, persona, response, created_at) VALUES (?, ?, ?, ?, ?)",
+            (user, sha256, persona, response, time.time()),
+        )
+
+
+def compact(user_data_root="user_data", keep=False):
+    """Move every legacy user_data/<email>/upload/<file> into the blob store."""
+    migrated = duplicates = 0
+    for user in sorted(os.listdir(user_data_root)):
+        upload_folder = os.path.join(user_data_root, user, "upload")
+        if not os.path.isdir(upload_folder):
+            continue
+        for filename in sorted(os.listdir(upload_folder)):
+            file_path = os.path.join(upload_folder, filename)
+            if not os.path.isfile(file_path) or filename.startswith("."):
+                continue
+            with open(file_path, "rb") as f:
+                upload = save_stream(user, filename, f, uploaded_at=os.path.getmtime(file_path))
+            migrated += 1
+            duplicates += int(upload.duplicate)
+            if not keep:
+                os.remove(file_path)
+    return migrated, duplicates
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Content-addressed upload store maintenance")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    compact_parser = subcommands.add_parser("compact", help="migrate user_data/<email>/upload into the blob store")
+    compact_parser.add_argument("--user-data", default="user_data")
+    compact_parser.add_argument("--keep", action="store_true", help="leave the original files in place")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "compact":
+        migrated, duplicates = compact(args.user_data, keep=args.keep)
+        print(f"Migrated {migrated} uploads ({duplicates} duplicates, {migrated - duplicates} blobs written)")
+        sys.exit(0)
@@ -0,0 +1,51 @@
+import os
+import gzip
+
+try:
+    import brotli
+except ImportError:  # optional, responses and assets are gzipped only without it
+    brotli = None
+
+# gzip/brotli for HTML and JSON responses, and the helpers the static asset build shares.
+COMPRESS_MIN_BYTES = int(os.getenv("COMPRESS_MIN_BYTES", 500))  # smaller bodies gain less than the headers cost
+COMPRESS_TYPES = ("text/html", "application/json", "text/plain", "text/css", "application/javascript", "image/svg+xml")
+# Fast levels for bodies compressed on every request; the asset build uses the smallest, slowest ones
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", 6))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", 4))
+
+
+def accepts(accept, value):
+    """Whether an Accept or Accept-Encoding header lists value; */* and * do not count."""
+    return any(item == value and quality > 0 for item, quality in accept)
+
+
+def available_encodings():
+    """Content encodings this process can produce, in order of preference."""
+    return ("br", "gzip") if brotli is not None else ("gzip",)
+
+
+def compress(data, encoding, level=None):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY if level is None else level)
+    # mtime=0 keeps the output the same for the same input
+    return gzip.compress(data, compresslevel=GZIP_LEVEL if level is None else level, mtime=0)
+
+
+def compress_response(response, accept_encodings):
+    """Compress a buffered HTML/JSON response in place, in the best encoding the client takes.
+
+    Streamed responses (SSE, NDJSON), files and bodies that are already
+    encoded are left alone.
+    """
+    if (response.direct_passthrough or response.is_streamed or response.status_code in (204, 206, 304)
+            or "Content-Encoding" in response.headers or response.mimetype not in COMPRESS_TYPES):
+        return response
+    # The body depends on Accept-Encoding, also when this one is sent as it is
+    response.vary.add("Accept-Encoding")
+    encoding = next((encoding for encoding in available_encodings() if accepts(accept_encodings, encoding)), None)
+    data = response.get_data()
+    if encoding is None or len(data) < COMPRESS_MIN_BYTES:
+        return response
+    response.set_data(compress(data, encoding))
+    response.content_encoding = encoding
+    return response
@@ -0,0 +1,227 @@
+import os
+import sys
+import json
+import time
+import queue
+import atexit
+import shutil
+import logging
+import argparse
+import threading
+from datetime import datetime
+
+# Per-user append-only conversation log: user_data/<email>/conversations/<segment>.jsonl
+USER_DATA_ROOT = "user_data"
+SEGMENT_MAX_BYTES = int(os.getenv("CONVERSATION_SEGMENT_MAX_BYTES", 4 * 1024 * 1024))
+FLUSH_INTERVAL = float(os.getenv("CONVERSATION_FLUSH_INTERVAL", 0.2))  # seconds between batched writes
+FSYNC_INTERVAL = float(os.getenv("CONVERSATION_FSYNC_INTERVAL", 2.0))  # seconds between fsyncs
+MAX_OPEN_FILES = 64
+MIGRATE_FLUSH_TIMEOUT = 60  # seconds the migration waits for a user's log to reach the disk
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for English text)."""
+    return max(1, len(text) // 4) if text else 0
+
+
+def conversation_folder(user_email):
+    return os.path.join(USER_DATA_ROOT, user_email, "conversations")
+
+
+def _segments(user_email):
+    folder = conversation_folder(user_email)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(os.path.join(folder, name) for name in os.listdir(folder) if name.endswith(".jsonl"))
+
+
+def _segment_for_append(user_email):
+    segments = _segments(user_email)
+    if segments and os.path.getsize(segments[-1]) < SEGMENT_MAX_BYTES:
+        return segments[-1]
+    os.makedirs(conversation_folder(user_email), exist_ok=True)
+    return os.path.join(conversation_folder(user_email), f"{len(segments) + 1:08d}.jsonl")
+
+
+class ConversationWriter:
+    """Background thread that batches conversation records and appends them to disk.
+
+    Records are queued by request threads and written at most every
+    FLUSH_INTERVAL seconds, one write per user per batch. Files are fsynced
+    every FSYNC_INTERVAL seconds rather than on each write.
+    """
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL, fsync_interval=FSYNC_INTERVAL):
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self._queue = queue.Queue()
+        self._files = {}
+        self._dirty = set()
+        self._last_fsync = time.monotonic()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="conversation-writer", daemon=True)
+                self._thread.start()
+
+    def append(self, user_email, record):
+        self.start()
+        self._queue.put((user_email, record))
+
+    def flush(self, timeout=None):
+        """Block until everything queued so far is written and fsynced.
+
+        Returns False if that did not happen within timeout or the write failed.
+        """
+        done = threading.Event()
+        done.error = None
+        self.append(None, done)
+        return done.wait(timeout) and done.error is None
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            # Collect whatever else arrives within the flush interval
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+                if isinstance(batch[-1][1], threading.Event):
+                    break
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                logging.error(f"Conversation log write failed: {e}")
+
+    def _write_batch(self, batch):
+        lines = {}
+        waiters = []
+        for user_email, record in batch:
+            if isinstance(record, threading.Event):
+                waiters.append(record)
+            else:
+                lines.setdefault(user_email, []).append(json.dumps(record) + "\n")
+
+        error = None
+        try:
+            for user_email, user_lines in lines.items():
+                f = self._file_for(user_email)
+                f.write("".join(user_lines))
+                f.flush()
+                self._dirty.add(user_email)
+
+            if waiters or time.monotonic() - self._last_fsync >= self.fsync_interval:
+                self._fsync()
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            # A failed write still wakes the flush() calls waiting on it, with the error
+            for waiter in waiters:
+                waiter.error = error
+                waiter.set()
+
+    def _file_for(self, user_email):
+        f = self._files.get(user_email)
+        if f is not None and f.tell() >= SEGMENT_MAX_BYTES:
+            self._close(user_email)
+            f = None
+        if f is None:
+            if len(self._files) >= MAX_OPEN_FILES:
+                self._close(next(iter(self._files)))
+            f = open(_segment_for_append(user_email), "a", encoding="utf-8")
+            self._files[user_email] = f
+        return f
+
+    def _close(self, user_email):
+        f = self._files.pop(user_email)
+        if user_email in self._dirty:
+            os.fsync(f.fileno())
+            self._dirty.discard(user_email)
+        f.close()
+
+    def _fsync(self):
+        for user_email in list(self._dirty):
+            f = self._files.get(user_email)
+            if f is not None:
+                os.fsync(f.fileno())
+        self._dirty.clear()
+        self._last_fsync = time.monotonic()
+
+
+writer = ConversationWriter()
+atexit.register(writer.flush, 5)
+
+
+def append_message(user_email, persona, role, content, tokens=None, timestamp=None):
+    """Queue one conversation message for the user's append-only log."""
+    writer.append(user_email, {
+        "ts": timestamp or time.time(),
+        "persona": persona,
+        "role": role,
+        "content": content,
+        "tokens": estimate_tokens(content) if tokens is None else tokens,
+    })
+
+
+def read_messages(user_email, persona=None):
+    """Yield the user's logged messages in write order, optionally for one persona."""
+    for segment in _segments(user_email):
+        with open(segment, encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # torn final line from a crash
+                record = json.loads(line)
+                if persona is None or record["persona"] == persona:
+                    yield record
+
+
+def migrate(keep=False):
+    """Import legacy user_data/<email>/chat/<timestamp>/chat_session.txt history."""
+    migrated = 0
+    for user_email in sorted(os.listdir(USER_DATA_ROOT)):
+        chat_folder = os.path.join(USER_DATA_ROOT, user_email, "chat")
+        if not os.path.isdir(chat_folder):
+            continue
+        for date_time in sorted(os.listdir(chat_folder)):
+            chat_file = os.path.join(chat_folder, date_time, "chat_session.txt")
+            if not os.path.isfile(chat_file):
+                continue
+            with open(chat_file, encoding="utf-8") as f:
+                content = f.read()
+            user_part, _, llm_part = content.partition("\nLLM: ")
+            user_part = user_part[len("User: "):] if user_part.startswith("User: ") else user_part
+            timestamp = datetime.strptime(date_time, "%Y-%m-%d_%H-%M-%S").timestamp()
+            # The legacy logs did not record which persona answered
+            append_message(user_email, "unknown", "user", user_part, timestamp=timestamp)
+            append_message(user_email, "unknown", "assistant", llm_part, timestamp=timestamp)
+            migrated += 1
+        # The originals are only removed once their copy is on disk
+        if not writer.flush(MIGRATE_FLUSH_TIMEOUT):
+            raise RuntimeError(f"Writing the conversation log of {user_email} failed, its chat folders were kept")
+        if not keep:
+            shutil.rmtree(chat_folder)
+            os.makedirs(chat_folder)
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append-only conversation log maintenance")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subcommands.add_parser("migrate", help="import user_data/<email>/chat/* into the conversation log")
+    migrate_parser.add_argument("--keep", action="store_true", help="leave the original chat folders in place")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "migrate":
+        migrated = migrate(keep=args.keep)
+        print(f"Imported {migrated} chat turns")
+        sys.exit(0)
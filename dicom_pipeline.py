@@ -0,0 +1,354 @@
+import io
+import os
+import json
+import math
+import mmap
+import time
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from PIL import Image, ImageDraw, ImageOps
+import blob_store
+
+try:
+    import numpy as np
+    import pydicom
+except ImportError:  # optional, DICOM uploads are refused without it
+    pydicom = None
+
+# DICOM settings, overridable from the environment
+DICOM_EXTENSIONS = ('.dcm', '.dicom')
+SELECTION = os.getenv("DICOM_SELECTION", "montage")  # "montage": one tiled image per series, "slices": one image per key slice
+KEY_SLICES = int(os.getenv("DICOM_KEY_SLICES", 4))  # key slices picked per series
+MONTAGE_SIDE = int(os.getenv("DICOM_MONTAGE_SIDE", 1024))  # pixels, matches IMAGE_MAX_SIDE
+METADATA_PATH = os.getenv("DICOM_METADATA_PATH", os.path.join("user_data", "dicom.db"))
+SCORE_SIDE = 64  # frames are scored on a subsampled grid of about this many pixels a side
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# Technical fields only; nothing that identifies the patient is kept
+STUDY_FIELDS = ("StudyInstanceUID", "StudyDescription", "Modality", "BodyPartExamined")
+SERIES_FIELDS = ("SeriesInstanceUID", "SeriesDescription", "Modality", "SliceThickness")
+
+Frame = namedtuple("Frame", ["sha256", "path", "index", "position"])  # one 2-D image inside a DICOM file
+RenderedImage = namedtuple("RenderedImage", ["label", "data", "series_uid", "frames"])
+
+_local = threading.local()
+
+
+def available():
+    return pydicom is not None
+
+
+def is_dicom_name(filename):
+    return filename.lower().endswith(DICOM_EXTENSIONS)
+
+
+def _connection():
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        os.makedirs(os.path.dirname(METADATA_PATH) or ".", exist_ok=True)
+        conn = sqlite3.connect(METADATA_PATH, timeout=10)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS dicom_files (
+                sha256 TEXT PRIMARY KEY,
+                study_uid TEXT,
+                series_uid TEXT,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS dicom_studies (
+                study_uid TEXT PRIMARY KEY,
+                metadata TEXT NOT NULL,
+                updated_at REAL NOT NULL
+            );
+        """)
+        _local.conn = conn
+    return conn
+
+
+def _value(dataset, name, default=None):
+    value = dataset.get(name, default)
+    if isinstance(value, pydicom.multival.MultiValue):
+        value = value[0] if value else default
+    if isinstance(value, (pydicom.valuerep.DSfloat, pydicom.valuerep.IS)):
+        return float(value)
+    if isinstance(value, (str, int, float)) or value is None:
+        return value
+    return str(value)
+
+
+def _read_metadata(path):
+    # Defer the pixel data, so only the header is parsed; its offset is kept for memory-mapping
+    dataset = pydicom.dcmread(path, defer_size=1024)
+    syntax = dataset.file_meta.TransferSyntaxUID
+    pixels = dataset.get_item(0x7FE00010, keep_deferred=True)
+    position = dataset.get("ImagePositionPatient")
+    metadata = {name: _value(dataset, name) for name in STUDY_FIELDS + SERIES_FIELDS}
+    metadata.update(
+        rows=int(dataset.Rows),
+        columns=int(dataset.Columns),
+        frames=int(_value(dataset, "NumberOfFrames", 1) or 1),
+        samples=int(_value(dataset, "SamplesPerPixel", 1)),
+        planar=int(_value(dataset, "PlanarConfiguration", 0) or 0),
+        bits_allocated=int(dataset.BitsAllocated),
+        bits_stored=int(_value(dataset, "BitsStored", dataset.BitsAllocated)),
+        signed=bool(_value(dataset, "PixelRepresentation", 0)),
+        photometric=_value(dataset, "PhotometricInterpretation", "MONOCHROME2"),
+        slope=float(_value(dataset, "RescaleSlope", 1.0) or 1.0),
+        intercept=float(_value(dataset, "RescaleIntercept", 0.0) or 0.0),
+        window_center=_value(dataset, "WindowCenter"),
+        window_width=_value(dataset, "WindowWidth"),
+        instance=_value(dataset, "InstanceNumber"),
+        # Slices are ordered along the patient axis when the position is known
+        position=float(position[2]) if position and len(position) == 3 else _value(dataset, "SliceLocation"),
+        little_endian=bool(syntax.is_little_endian),
+        pixel_offset=None,
+    )
+    native = not syntax.is_compressed and pixels is not None and hasattr(pixels, "value_tell")
+    if native and pixels.length != UNDEFINED_LENGTH:
+        metadata["pixel_offset"] = pixels.value_tell
+    return metadata
+
+
+def file_metadata(sha256, path):
+    """Return the cached header summary of a DICOM blob, parsing it on first use."""
+    row = _connection().execute("SELECT metadata FROM dicom_files WHERE sha256 = ?", (sha256,)).fetchone()
+    if row:
+        return json.loads(row[0])
+    metadata = _read_metadata(path)
+    _remember(sha256, metadata)
+    return metadata
+
+
+def _remember(sha256, metadata):
+    study_uid = metadata.get("StudyInstanceUID")
+    series_uid = metadata.get("SeriesInstanceUID")
+    conn = _connection()
+    with conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO dicom_files (sha256, study_uid, series_uid, metadata) VALUES (?, ?, ?, ?)",
+            (sha256, study_uid, series_uid, json.dumps(metadata)),
+        )
+        if not study_uid:
+            return
+        row = conn.execute("SELECT metadata FROM dicom_studies WHERE study_uid = ?", (study_uid,)).fetchone()
+        study = json.loads(row[0]) if row else {name: metadata.get(name) for name in STUDY_FIELDS}
+        study.setdefault("series", {})
+        series = study["series"].setdefault(series_uid or "unknown", {name: metadata.get(name) for name in SERIES_FIELDS})
+        series["files"] = series.get("files", 0) + 1
+        series["frames"] = series.get("frames", 0) + metadata["frames"]
+        conn.execute(
+            "INSERT OR REPLACE INTO dicom_studies (study_uid, metadata, updated_at) VALUES (?, ?, ?)",
+            (study_uid, json.dumps(study), time.time()),
+        )
+
+
+def study_metadata(study_uid):
+    """Return what is known about a study: description, modality and its series."""
+    row = _connection().execute("SELECT metadata FROM dicom_studies WHERE study_uid = ?", (study_uid,)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+class DicomFile:
+    """Frames of one DICOM file, decoded one at a time from a memory map.
+
+    Uncompressed pixel data is viewed in place through numpy, so only the
+    pages of the frames (and rows) that are actually read get loaded.
+    Compressed transfer syntaxes fall back to pydicom's decoders.
+    """
+
+    def __init__(self, path, metadata):
+        self.path = path
+        self.metadata = metadata
+        self._file = None
+        self._map = None
+        self._decoded = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._file.close()
+            self._map = self._file = None
+
+    def _dtype(self):
+        meta = self.metadata
+        kind = "i" if meta["signed"] else "u"
+        return np.dtype(f"{'<' if meta['little_endian'] else '>'}{kind}{meta['bits_allocated'] // 8}")
+
+    def frame(self, index, step=1):
+        """Return frame index in modality units (rescale applied), every step-th pixel."""
+        meta = self.metadata
+        if meta["pixel_offset"] is not None and meta["bits_allocated"] in (8, 16, 32):
+            if self._map is None:
+                self._file = open(self.path, "rb")
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            shape = (meta["rows"], meta["columns"], meta["samples"])
+            dtype = self._dtype()
+            frame_bytes = math.prod(shape) * dtype.itemsize
+            pixels = np.frombuffer(self._map, dtype=dtype, count=math.prod(shape), offset=meta["pixel_offset"] + index * frame_bytes)
+            if meta["samples"] > 1 and meta["planar"]:
+                pixels = pixels.reshape(meta["samples"], meta["rows"], meta["columns"]).transpose(1, 2, 0)
+            else:
+                pixels = pixels.reshape(shape)
+            pixels = pixels[::step, ::step]
+        else:
+            if self._decoded is None:
+                self._decoded = pydicom.dcmread(self.path).pixel_array
+            pixels = self._decoded[index] if meta["frames"] > 1 else self._decoded
+            pixels = pixels[::step, ::step]
+        if pixels.ndim == 3 and pixels.shape[2] == 1:
+            pixels = pixels[:, :, 0]
+        if meta["samples"] > 1:
+            return pixels.copy()  # colour images are rendered as they are; the copy releases the map
+        if not meta["signed"] and meta["bits_stored"] < meta["bits_allocated"]:
+            pixels = pixels & ((1 << meta["bits_stored"]) - 1)
+        return pixels.astype(np.float32) * meta["slope"] + meta["intercept"]
+
+
+def window_to_8bit(values, center, width, invert=False):
+    """Apply a linear DICOM window (PS3.3 C.11.2.1.2) and return 8-bit pixels."""
+    if values.ndim == 3:
+        return np.clip(values, 0, 255).astype(np.uint8)
+    width = max(float(width), 1.0)
+    low = center - 0.5 - (width - 1) / 2
+    scaled = np.clip((values - low) / max(width - 1, 1.0), 0.0, 1.0) * 255
+    if invert:
+        scaled = 255 - scaled
+    return scaled.astype(np.uint8)
+
+
+def _entropy(pixels):
+    histogram = np.bincount(pixels.ravel(), minlength=256).astype(np.float64)
+    histogram = histogram[histogram > 0] / pixels.size
+    return float(-(histogram * np.log2(histogram)).sum())
+
+
+def select_key_frames(scores, count):
+    """Pick the best scored frame in each of count equal runs of the series.
+
+    Splitting the series first keeps the picks spread from top to bottom
+    instead of clustering on the busiest few slices.
+    """
+    if len(scores) <= count:
+        return list(range(len(scores)))
+    picks = []
+    for segment in range(count):
+        start = segment * len(scores) // count
+        end = (segment + 1) * len(scores) // count
+        picks.append(max(range(start, end), key=scores.__getitem__))
+    return picks
+
+
+def _series_frames(uploads):
+    series = {}
+    for upload in uploads:
+        metadata = file_metadata(upload.sha256, upload.path)
+        for index in range(metadata["frames"]):
+            position = metadata["position"] if metadata["frames"] == 1 else index
+            order = (position if position is not None else metadata.get("instance") or 0, upload.filename, index)
+            series.setdefault(metadata.get("SeriesInstanceUID") or upload.sha256, []).append((order, Frame(upload.sha256, upload.path, index, order[0])))
+    return {uid: [frame for _, frame in sorted(frames, key=lambda item: item[0])] for uid, frames in series.items()}
+
+
+def _window(metadata, samples):
+    if metadata["window_center"] is not None and metadata["window_width"]:
+        return float(metadata["window_center"]), float(metadata["window_width"])
+    # No stored window: span the 0.5-99.5 percentile of the sampled pixels
+    low, high = np.percentile(np.concatenate([sample.ravel() for sample in samples]), [0.5, 99.5])
+    return (low + high) / 2, max(high - low, 1.0)
+
+
+def render_series(uploads, selection=SELECTION, key_slices=KEY_SLICES):
+    """Turn DICOM uploads into a few 8-bit PNG images for the vision model.
+
+    Frames are grouped by series and ordered along the patient axis. Every
+    frame is scored on a subsampled grid (histogram entropy plus contrast),
+    the key slices are picked across the series, and they are rendered at
+    full resolution either one image each or tiled into one montage.
+    """
+    if not available():
+        raise RuntimeError("DICOM support needs the optional pydicom package")
+
+    rendered = []
+    for series_uid, frames in _series_frames(uploads).items():
+        metadata = {frame.sha256: file_metadata(frame.sha256, frame.path) for frame in frames}
+        first = metadata[frames[0].sha256]
+        step = max(1, max(first["rows"], first["columns"]) // SCORE_SIDE)
+        invert = first["photometric"] == "MONOCHROME1"
+
+        samples = []
+        open_files = {}
+        try:
+            for frame in frames:
+                if frame.sha256 not in open_files:
+                    open_files[frame.sha256] = DicomFile(frame.path, metadata[frame.sha256])
+                samples.append(open_files[frame.sha256].frame(frame.index, step))
+            center, width = _window(first, samples)
+            scores = []
+            for sample in samples:
+                pixels = window_to_8bit(sample, center, width, invert)
+                scores.append(_entropy(pixels) + float(pixels.std()) / 64)
+            picks = select_key_frames(scores, key_slices)
+            images = [
+                Image.fromarray(window_to_8bit(open_files[frames[i].sha256].frame(frames[i].index), center, width, invert))
+                for i in picks
+            ]
+        finally:
+            for dicom_file in open_files.values():
+                dicom_file.close()
+
+        labels = [f"slice {i + 1}/{len(frames)}" for i in picks]
+        logging.info(f"Selected {len(picks)} of {len(frames)} frames from series {series_uid}")
+        if selection == "montage" and len(images) > 1:
+            rendered.append(RenderedImage("montage", _encode(_montage(images, labels)), series_uid, labels))
+        else:
+            rendered.extend(RenderedImage(label, _encode(image), series_uid, [label]) for label, image in zip(labels, images))
+    return rendered
+
+
+def _montage(images, labels, side=MONTAGE_SIDE):
+    columns = math.ceil(math.sqrt(len(images)))
+    rows = math.ceil(len(images) / columns)
+    tile = side // columns
+    mode = "RGB" if any(image.mode == "RGB" for image in images) else "L"
+    montage = Image.new(mode, (tile * columns, tile * rows))
+    draw = ImageDraw.Draw(montage)
+    for i, (image, label) in enumerate(zip(images, labels)):
+        # Scaled to fill the tile; small modalities (e.g. 256px MR) are enlarged
+        image = ImageOps.contain(image.convert(mode), (tile, tile), Image.LANCZOS)
+        x, y = (i % columns) * tile, (i // columns) * tile
+        montage.paste(image, (x + (tile - image.width) // 2, y + (tile - image.height) // 2))
+        # Label each tile, so answers can refer to a slice
+        draw.text((x + 4, y + 4), label, fill=255 if mode == "L" else (255, 255, 0))
+    return montage
+
+
+def _encode(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def expand_uploads(user, uploads):
+    """Replace the DICOM uploads in a list by uploads of their rendered key images.
+
+    Other uploads are kept as they are and in place; the rendered images are
+    stored like any other upload, so they get image and thumbnail URLs.
+    """
+    dicom_uploads = [upload for upload in uploads if is_dicom_name(upload.filename)]
+    if not dicom_uploads:
+        return uploads
+    rendered = [
+        blob_store.save_stream(user, f"{image.series_uid[-12:]}-{image.label.replace('/', '-').replace(' ', '_')}.png", io.BytesIO(image.data), content_type="image/png")
+        for image in render_series(dicom_uploads)
+    ]
+    first = uploads.index(dicom_uploads[0])
+    others = [upload for upload in uploads if not is_dicom_name(upload.filename)]
+    return others[:first] + rendered + others[first:]
@@ -1,76 +1,149 @@
-from PIL import Image
+import os
+import sys
+import glob
+import json
+import time
+import logging
+import argparse
+import torch
 from transformers import LlavaForConditionalGeneration, AutoProcessor
 from transformers import BitsAndBytesConfig
-import torch
-import matplotlib.pyplot as plt
-import json
-import glob
+from pixel_cache import DEFAULT_CACHE_DIR, PixelCache, data_loader, supports
+
+# Captions a folder of scans with the captioner model into a JSONL dataset, one {"image", "text"} per line.
+# Lines are appended as batches finish, and a rerun skips the images already in the file:
+#   python create_dataset.py --images '/home/admin/dataset/ct-scans/train_images/img/*.JPG' --batch-size 8
+# On CPU with a small checkpoint, for trying the pipeline out:
+#   python create_dataset.py --device cpu --model <tiny llava checkpoint> --limit 16 --batch-size 4
+DEFAULT_IMAGES = '/home/admin/dataset/ct-scans/train_images/img/*.JPG'
+DEFAULT_OUTPUT = '/home/admin/dataset.jsonl'
+MODEL_ID = "Ertugrul/Pixtral-12B-Captioner-Relaxed"
+PROMPT_TEXT = "You are an expert radiologist. Provide an evaluation for the chest X-Ray scan on the image.\n"
+GENERATION = {"max_new_tokens": 256, "do_sample": True, "temperature": 0.01, "top_k": 20, "use_cache": True}
+
+
+def build_prompt(processor, text=PROMPT_TEXT):
+    if getattr(processor, "chat_template", None) is None:
+        # Small test checkpoints often come without a chat template
+        return f"{processor.image_token}\n{text}"
+    conversation = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": text},
+                {"type": "image"},
+            ],
+        }
+    ]
+    return processor.apply_chat_template(conversation, add_generation_prompt=True)
+
+
+def load_model(model_id, device, load_in_4bit=False):
+    """Return (model, processor); bfloat16 on CUDA, float32 on CPU."""
+    options = {"torch_dtype": torch.bfloat16 if device == "cuda" else torch.float32}
+    if device == "cuda":
+        options["device_map"] = "auto"
+    if load_in_4bit:
+        options["quantization_config"] = BitsAndBytesConfig(
+            load_in_4bit=True,
+            bnb_4bit_compute_dtype=torch.bfloat16,
+            bnb_4bit_quant_type="nf4"
+        )
+    model = LlavaForConditionalGeneration.from_pretrained(model_id, **options).eval()
+    if device != "cuda":
+        model.to(device)
+    processor = AutoProcessor.from_pretrained(model_id)
+    processor.tokenizer.padding_side = "left"
+    if processor.tokenizer.pad_token is None:
+        processor.tokenizer.pad_token = processor.tokenizer.eos_token
+    return model, processor
+
+
+def completed_files(output_path):
+    """Images already captioned in the output file.
 
-files = glob.glob('/home/admin/dataset/ct-scans/train_images/img/*.JPG')
-quantization_config = BitsAndBytesConfig(
-    # load_in_8bit=True,
-    load_in_4bit=True,
-    bnb_4bit_compute_dtype=torch.bfloat16,
-    bnb_4bit_quant_type="nf4"
-    )
+    A last line cut short by a crash is removed, so appending continues on
+    a clean line.
+    """
+    if not os.path.exists(output_path):
+        return set()
+    with open(output_path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            logging.warning(f"Dropping an unfinished last line of {output_path}")
+            f.truncate(end)
+    return {json.loads(line)["image"] for line in data[:end].splitlines() if line.strip()}
 
-model_id = "Ertugrul/Pixtral-12B-Captioner-Relaxed"
-model = LlavaForConditionalGeneration.from_pretrained(model_id, device_map="auto", torch_dtype=torch.bfloat16)
-processor = AutoProcessor.from_pretrained(model_id)
 
-# for quantization just use this instead of previous load
-# model = LlavaForConditionalGeneration.from_pretrained(model_id, device_map="auto", torch_dtype=torch.bfloat16, quantization_config=quantization_config)
+def caption(files, output_path, model, processor, image_size=256, batch_size=8, workers=4, cache=None, log_every=10):
+    """Caption files in batches, appending a line per image; returns (captioned, failed, seconds).
 
-def resize_image(image, target_size=768):
-    """Resize the image to have the target size on the shortest side."""
-    width, height = image.size
-    if width < height:
-        new_width = target_size
-        new_height = int(height * (new_width / width))
-    else:
-        new_height = target_size
-        new_width = int(width * (new_height / height))
-    return image.resize((new_width, new_height), Image.LANCZOS)
+    With a PixelCache, images it has are mapped from it instead of decoded,
+    and the ones it does not have are added.
+    """
+    loader = data_loader(files, processor, build_prompt(processor), image_size, batch_size, workers,
+                         cache=cache, pin_memory=model.device.type == "cuda")
+    captioned = 0
+    started = time.perf_counter()
+    with open(output_path, "a", encoding="utf-8") as out:
+        for batch_number, (batch_files, inputs, fresh) in enumerate(loader, 1):
+            for pixels in fresh:
+                cache.put(pixels.key, pixels.values)
+            # Images that failed to decode were dropped from the batch by the collator
+            if not batch_files:
+                continue
+            # Only floating point tensors (pixel values) are cast to the model's dtype
+            inputs = inputs.to(model.device, dtype=model.dtype)
+            with torch.inference_mode():
+                generate_ids = model.generate(**inputs, **GENERATION)
+            captions = processor.batch_decode(generate_ids[:, inputs["input_ids"].shape[1]:], skip_special_tokens=True, clean_up_tokenization_spaces=True)
+            for file, text in zip(batch_files, captions):
+                out.write(json.dumps({"image": file, "text": text}) + "\n")
+            # Every finished batch is on disk before the next one starts
+            out.flush()
+            os.fsync(out.fileno())
+            captioned += len(batch_files)
+            if batch_number % log_every == 0:
+                seconds = time.perf_counter() - started
+                logging.info(f"{captioned}/{len(files)} images, {captioned / seconds:.2f} images/sec")
+    if cache is not None:
+        cache.flush()
+    return captioned, len(files) - captioned, time.perf_counter() - started
 
-conversation = [
-    {
-        "role": "user",
-        "content": [
-            
-            {"type": "text", "text": "You are an expert radiologist. Provide an evaluation for the chest X-Ray scan on the image.\n"},
-            {
-                "type": "image",
-            }
-        ],
-    }
-]
 
-PROMPT = processor.apply_chat_template(conversation, add_generation_prompt=True)
-data = []
-for file in files:
-    image = Image.open(file)
-    image = resize_image(image, 256)
-    inputs = processor(text=PROMPT, images=image, return_tensors="pt").to("cuda")
-    with torch.no_grad():
-        with torch.autocast(device_type="cuda", dtype=torch.bfloat16):
-            generate_ids = model.generate(**inputs, max_new_tokens=256, do_sample=True, temperature=0.01, use_cache=True, top_k=20)
-    output_text = processor.batch_decode(generate_ids[:, inputs.input_ids.shape[1]:], skip_special_tokens=True, clean_up_tokenization_spaces=True)[0]
-    data.append(
-            {   
-                "text": {output_text},
-                "image": {file}
-            })
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Caption images into a JSONL fine-tuning dataset")
+    parser.add_argument("--images", default=DEFAULT_IMAGES, help="glob of the images to caption")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="JSONL file; existing lines are kept and their images skipped")
+    parser.add_argument("--model", default=MODEL_ID)
+    parser.add_argument("--device", choices=("auto", "cuda", "cpu"), default="auto")
+    parser.add_argument("--load-in-4bit", action="store_true", help="quantize the model with bitsandbytes (CUDA only)")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--workers", type=int, default=min(8, os.cpu_count() or 1), help="DataLoader processes decoding and resizing")
+    parser.add_argument("--image-size", type=int, default=256, help="shortest side the images are resized to")
+    parser.add_argument("--limit", type=int, default=0, help="caption at most this many new images (0 for all)")
+    parser.add_argument("--pixel-cache", default=DEFAULT_CACHE_DIR, help="preprocessed image cache, shared with fine-tuning")
+    parser.add_argument("--no-pixel-cache", action="store_true", help="decode and preprocess every image")
+    args = parser.parse_args()
 
-def convert_sets(obj):
-    if isinstance(obj, set):
-        return list(obj)
-    elif isinstance(obj, dict):
-        return {k: convert_sets(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_sets(i) for i in obj]
-    else:
-        return obj
+    logging.basicConfig(level=logging.INFO)
+    device = args.device if args.device != "auto" else ("cuda" if torch.cuda.is_available() else "cpu")
+    files = sorted(glob.glob(args.images))
+    done = completed_files(args.output)
+    pending = [file for file in files if file not in done]
+    if args.limit:
+        pending = pending[:args.limit]
+    print(f"{len(files)} images, {len(done)} already captioned, {len(pending)} to go")
+    if not pending:
+        sys.exit(0)
 
-data_ser = convert_sets(data)
-with open('/home/admin/dataset.json', 'w') as json_file:
-    json.dump(data_ser, json_file, indent=4)
+    model, processor = load_model(args.model, device, load_in_4bit=args.load_in_4bit)
+    cache = None
+    if not args.no_pixel_cache and supports(processor):
+        # float16 keeps more precision than the bfloat16 the model runs in
+        cache = PixelCache(args.pixel_cache, processor, args.image_size, "float16" if model.dtype == torch.bfloat16 else "float32")
+    elif not args.no_pixel_cache:
+        logging.info(f"The {type(processor).__name__} of {args.model} cannot use the pixel cache, images are decoded on every run")
+    captioned, failed, seconds = caption(pending, args.output, model, processor, args.image_size, args.batch_size, args.workers, cache)
+    print(f"Captioned {captioned} images in {seconds:.1f}s ({captioned / seconds if seconds else 0:.2f} images/sec), {failed} failed, written to {args.output}")
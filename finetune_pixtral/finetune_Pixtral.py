@@ -4,6 +4,7 @@ import transformers
 from transformers import LlavaForConditionalGeneration, AutoProcessor
 from transformers import BitsAndBytesConfig
 from PIL import Image
+from pixel_cache import DEFAULT_CACHE_DIR, PixelCache, batch_inputs, check_batch_inputs, resize_image
 
 import os
 os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "1"
@@ -43,15 +44,19 @@ conversation = [
 PROMPT = processor.apply_chat_template(conversation, add_generation_prompt=True)
 
 class DataCollator:
-    def __init__(self, processor):
+    def __init__(self, processor, pixel_cache):
         self.processor = processor
+        self.pixel_cache = pixel_cache
         if self.processor.tokenizer.pad_token is None:
             self.processor.tokenizer.pad_token = self.processor.tokenizer.eos_token
 
     def __call__(self, examples):
         example = examples[0]
 
-        image = example["image"]
+        # Preprocessed once, later epochs read the pixel values from the cache
+        pixels = self.pixel_cache.get(example["image"])
+        if not pixels.cached:
+            self.pixel_cache.put(pixels.key, pixels.values)
 
         user_prompt = "Describe this image"
         answer = ",".join(example["clip_tags_ViT_L_14"])
@@ -60,7 +65,7 @@ class DataCollator:
         answer = f"{answer}<|end|>\n<|endoftext|>"
 
         # Tokenize input and ensure uniform padding
-        batch = self.processor(PROMPT, [image], return_tensors="pt", padding="max_length", max_length=256)
+        batch = batch_inputs(self.processor, [PROMPT], [pixels.values], padding="max_length", max_length=256)
 
         # Tokenize answer with consistent max length
         answer_input_ids = self.processor.tokenizer(answer, add_special_tokens=False, return_tensors="pt", padding="max_length", max_length=256)["input_ids"]
@@ -100,21 +105,16 @@ class DataCollator:
         #         batch[key] = value.clone().detach().requires_grad_(True)
         return batch
 
-data_collator = DataCollator(processor)
+# The collator builds batches from cached pixels instead of calling the processor, so check they agree
+mismatches = check_batch_inputs(processor, PROMPT)
+if mismatches:
+    raise SystemExit("Batches from the pixel cache do not match the processor: " + "; ".join(mismatches))
 
-image = Image.open(r"/home/admin/test_data/image/test_img_!.jpg")
-
-def resize_image(image, target_size=768):
-    """Resize the image to have the target size on the shortest side."""
-    width, height = image.size
-    if width < height:
-        new_width = target_size
-        new_height = int(height * (new_width / width))
-    else:
-        new_height = target_size
-        new_width = int(width * (new_height / height))
-    return image.resize((new_width, new_height), Image.LANCZOS)
+# float16 keeps more precision than the bfloat16 the model runs in
+pixel_cache = PixelCache(DEFAULT_CACHE_DIR, processor, dtype="float16")
+data_collator = DataCollator(processor, pixel_cache)
 
+image = Image.open(r"/home/admin/test_data/image/test_img_!.jpg")
 
 # you can try different resolutions or disable it completely
 image = resize_image(image, 256)
@@ -128,9 +128,13 @@ inputs = processor(text=PROMPT, images=image, return_tensors="pt").to("cuda")
 # output_text = processor.batch_decode(generate_ids[:, inputs.input_ids.shape[1]:], skip_special_tokens=True, clean_up_tokenization_spaces=True)[0]
 
 from datasets import load_dataset
+from datasets import Image as DatasetImage
 train_dataset = load_dataset("ct-scans/train_images/")
 train_dataset = train_dataset['train'].select(range(10))
 eval_dataset = load_dataset("ct-scans/train_images/")
+# Images stay encoded, the collator decodes the ones the pixel cache does not have yet
+train_dataset = train_dataset.cast_column("image", DatasetImage(decode=False))
+eval_dataset = eval_dataset.cast_column("image", DatasetImage(decode=False))
 
 from peft import LoraConfig
  
@@ -156,7 +160,17 @@ from peft import get_peft_model
 model = get_peft_model(model, lora_config)
 model.print_trainable_parameters()
 
-from transformers import TrainingArguments, Trainer
+from transformers import TrainingArguments, Trainer, TrainerCallback
+
+class FlushPixelCache(TrainerCallback):
+    """Writes the pixel values added during an epoch to disk when it ends, so a crash later loses at most one epoch."""
+
+    def __init__(self, pixel_cache):
+        self.pixel_cache = pixel_cache
+
+    def on_epoch_end(self, args, state, control, **kwargs):
+        self.pixel_cache.flush()
+
 epochs = 1
 lr = 3e-5
 schedule = "constant"
@@ -176,6 +190,9 @@ training_args = TrainingArguments(
     lr_scheduler_type=schedule,
     fp16=True,
     remove_unused_columns=False,
+    # The collator puts new pixel values into pixel_cache; in DataLoader workers they
+    # would go to copies of it that are never flushed, so batches are built in this process
+    dataloader_num_workers=0,
     report_to="tensorboard",
     run_name=run_name,
     logging_dir=f"./logs/{run_name}"
@@ -186,10 +203,12 @@ trainer = Trainer(
     args=training_args,
     data_collator=data_collator,
     train_dataset=train_dataset,
-    eval_dataset=eval_dataset['test']
+    eval_dataset=eval_dataset['test'],
+    callbacks=[FlushPixelCache(pixel_cache)]
 )
 
 trainer.train()
+pixel_cache.flush()
 trainer.save_model("/home/admin/checkpoint-1/")
 processor.save_pretrained("/home/admin/checkpoint-1/")
 
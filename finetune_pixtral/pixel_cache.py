@@ -0,0 +1,390 @@
+import io
+import os
+import sys
+import glob
+import json
+import math
+import time
+import uuid
+import shutil
+import hashlib
+import logging
+import argparse
+import tempfile
+from collections import namedtuple
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+from transformers import AutoProcessor, BatchFeature
+
+# On-disk cache of the processor's pixel values, so each image is decoded, resized and normalized
+# once instead of on every epoch and every captioning run. Values live in flat .npy shards that are
+# memory-mapped when read, and index.json maps each key to its place in a shard. A key is the
+# SHA-256 of the image file plus a fingerprint of the processor config, resize and stored dtype.
+#   python pixel_cache.py build --images '/home/admin/dataset/ct-scans/train_images/img/*.JPG'
+#   python pixel_cache.py benchmark --images '/home/admin/dataset/ct-scans/train_images/img/*.JPG' --limit 512
+# Check that batches built from cached pixels match the processor's own output, exiting 1 if not:
+#   python pixel_cache.py check --sizes 256x256,256x384,517x300
+DEFAULT_CACHE_DIR = os.getenv("PIXEL_CACHE_DIR", "/home/admin/pixel_cache")
+SHARD_BYTES = int(os.getenv("PIXEL_CACHE_SHARD_MB", 256)) * 1024 * 1024
+INDEX_NAME = "index.json"
+CACHE_FORMAT = 1  # part of every fingerprint, bump it when the stored layout changes
+MODEL_ID = "Ertugrul/Pixtral-12B-Captioner-Relaxed"
+
+Pixels = namedtuple("Pixels", "key values cached")
+
+
+def resize_image(image, target_size=768):
+    """Resize the image to have the target size on the shortest side."""
+    width, height = image.size
+    if width < height:
+        new_width = target_size
+        new_height = int(height * (new_width / width))
+    else:
+        new_height = target_size
+        new_width = int(width * (new_height / height))
+    return image.resize((new_width, new_height), Image.LANCZOS)
+
+
+def read_source(source):
+    """Bytes of an image given as a path, as bytes, or as a datasets Image(decode=False) dict."""
+    if isinstance(source, dict):
+        if source.get("bytes") is not None:
+            return source["bytes"]
+        source = source["path"]
+    if isinstance(source, (bytes, bytearray)):
+        return bytes(source)
+    with open(source, "rb") as f:
+        return f.read()
+
+
+def load_image(data, image_size=None):
+    with Image.open(io.BytesIO(data)) as image:
+        image = image.convert("RGB")
+    return resize_image(image, image_size) if image_size else image
+
+
+def supports(processor):
+    """Whether batches can be built from cached pixels: the processor has to expand image tokens like Pixtral's."""
+    return all(hasattr(processor, name) for name in ("image_token", "image_break_token", "image_end_token", "patch_size"))
+
+
+def processor_fingerprint(processor, image_size=None, dtype="float32"):
+    image_processor = getattr(processor, "image_processor", processor)
+    config = {
+        "format": CACHE_FORMAT,
+        "class": type(image_processor).__name__,
+        "config": image_processor.to_dict(),
+        "image_size": image_size,
+        "dtype": dtype,
+    }
+    return hashlib.sha256(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def expand_prompt(processor, prompt, image_size):
+    """The prompt with its image token expanded for an image of image_size, as PixtralProcessor does it."""
+    patch_size = processor.patch_size * getattr(processor, "spatial_merge_size", 1)
+    height, width = image_size
+    tokens = ([processor.image_token] * (width // patch_size) + [processor.image_break_token]) * (height // patch_size)
+    tokens[-1] = processor.image_end_token
+    return prompt.replace(processor.image_token, "".join(tokens), 1)
+
+
+def process_image(processor, image, dtype="float32"):
+    """The processor's pixel values for one image, unpadded: (channels, height, width)."""
+    image_processor = getattr(processor, "image_processor", processor)
+    values = np.asarray(image_processor(image, return_tensors="pt")["pixel_values"][0])
+    return np.ascontiguousarray(values[0] if values.ndim == 4 else values, dtype=dtype)
+
+
+def batch_inputs(processor, prompts, pixel_values, **text_kwargs):
+    """Model inputs for prompts with one cached image each, the same as processor(text=prompts, images=...)."""
+    sizes = [values.shape[-2:] for values in pixel_values]
+    text_inputs = processor.tokenizer([expand_prompt(processor, prompt, size) for prompt, size in zip(prompts, sizes)],
+                                      return_tensors="pt", **text_kwargs)
+    # Zero padded at the bottom and right, like the image processor pads a batch
+    batch = np.zeros((len(pixel_values), pixel_values[0].shape[0], max(h for h, _ in sizes), max(w for _, w in sizes)),
+                     dtype=pixel_values[0].dtype)
+    for row, values in zip(batch, pixel_values):
+        row[:, :values.shape[-2], :values.shape[-1]] = values  # the only copy out of a mapped shard
+    return BatchFeature({
+        **text_inputs,
+        "pixel_values": torch.from_numpy(batch),
+        "image_sizes": torch.tensor([list(size) for size in sizes]),
+    })
+
+
+def check_batch_inputs(processor, prompt, image_sizes=((256, 256), (256, 384))):
+    """Compare batch_inputs with processor(text=..., images=...) on a random image of each (height, width).
+
+    Returns a description of every input that differs, empty when they all match.
+    """
+    rng = np.random.default_rng(0)
+    mismatches = []
+    for height, width in image_sizes:
+        image = Image.fromarray(rng.integers(0, 256, (height, width, 3), dtype=np.uint8))
+        expected = processor(text=[prompt], images=[image], return_tensors="pt")
+        actual = batch_inputs(processor, [prompt], [process_image(processor, image)])
+        for name in ("input_ids", "attention_mask", "image_sizes"):
+            if name in expected and not torch.equal(torch.as_tensor(expected[name]), actual[name]):
+                mismatches.append(f"{name} differ for a {height}x{width} image")
+        if not torch.allclose(torch.as_tensor(expected["pixel_values"]).float(), actual["pixel_values"].float()):
+            mismatches.append(f"pixel_values differ for a {height}x{width} image")
+    return mismatches
+
+
+def _replace_json(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+class PixelCache:
+    """Pixel values by image content, in memory-mapped .npy shards under root.
+
+    Any process can read. Entries are added with put() and written to disk by
+    flush() in the process that owns the cache; DataLoader workers hand the
+    values they had to compute back to it.
+    """
+
+    def __init__(self, root, processor, image_size=None, dtype="float32"):
+        self.root = root
+        self.processor = processor
+        self.image_size = image_size
+        self.dtype = np.dtype(dtype)
+        self.fingerprint = processor_fingerprint(processor, image_size, self.dtype.name)
+        os.makedirs(root, exist_ok=True)
+        self.entries = self._read_index()
+        self._pending, self._pending_bytes = {}, 0
+        self._shards = {}
+
+    def __getstate__(self):
+        # Workers map the shards themselves and never write
+        state = self.__dict__.copy()
+        state.update(_pending={}, _pending_bytes=0, _shards={})
+        return state
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _read_index(self):
+        path = os.path.join(self.root, INDEX_NAME)
+        if not os.path.exists(path):
+            return {}
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)["entries"]
+
+    def _read(self, entry):
+        shard = entry["shard"]
+        if shard not in self._shards:
+            self._shards[shard] = np.load(os.path.join(self.root, shard), mmap_mode="r")
+        offset, shape = entry["offset"], entry["shape"]
+        return self._shards[shard][offset:offset + math.prod(shape)].reshape(shape)
+
+    def process(self, image):
+        """The processor's pixel values for one image, in the stored dtype."""
+        return process_image(self.processor, image, self.dtype)
+
+    def get(self, source):
+        """Pixels for an image, mapped from a shard when cached, otherwise decoded and processed now."""
+        data = read_source(source)
+        key = f"{self.fingerprint}-{hashlib.sha256(data).hexdigest()}"
+        if key in self.entries:
+            return Pixels(key, self._read(self.entries[key]), True)
+        if key in self._pending:
+            return Pixels(key, self._pending[key], True)
+        return Pixels(key, self.process(load_image(data, self.image_size)), False)
+
+    def put(self, key, values):
+        if key in self.entries or key in self._pending:
+            return
+        self._pending[key] = values
+        self._pending_bytes += values.nbytes
+        if self._pending_bytes >= SHARD_BYTES:
+            self.flush()
+
+    def flush(self):
+        """Write the values put since the last flush as a new shard and add them to the index."""
+        if not self._pending:
+            return
+        shard = f"shard-{uuid.uuid4().hex[:12]}.npy"
+        entries, offset = {}, 0
+        for key, values in self._pending.items():
+            entries[key] = {"shard": shard, "offset": offset, "shape": list(values.shape)}
+            offset += values.size
+        path = os.path.join(self.root, shard)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        # Filled in place, so a shard never has to fit in memory twice
+        out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=self.dtype, shape=(offset,))
+        for key, values in self._pending.items():
+            out[entries[key]["offset"]:entries[key]["offset"] + values.size] = values.ravel()
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        # Another run may have added entries since this one read the index
+        self.entries = {**self._read_index(), **self.entries, **entries}
+        _replace_json(os.path.join(self.root, INDEX_NAME), {"format": CACHE_FORMAT, "entries": self.entries})
+        logging.info(f"Wrote {len(entries)} images ({offset * self.dtype.itemsize / 1024 ** 2:.1f} MB) to {shard}")
+        self._pending, self._pending_bytes = {}, 0
+
+
+class ImageFiles(Dataset):
+    """One image per item, decoded and resized in the DataLoader workers, or mapped from the cache."""
+
+    def __init__(self, files, image_size=None, cache=None):
+        self.files = files
+        self.image_size = image_size
+        self.cache = cache
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, index):
+        file = self.files[index]
+        try:
+            if self.cache is not None:
+                return file, self.cache.get(file)
+            return file, load_image(read_source(file), self.image_size)
+        except OSError as e:
+            logging.warning(f"Skipping {file}: {e}")
+            return file, None
+
+
+class Collator:
+    """Turns a batch of images into model inputs, in the worker that loaded them.
+
+    Returns (files, inputs, pixels the cache did not have yet). Prompts are
+    padded on the left, so every row of the batch ends where generation starts.
+    """
+
+    def __init__(self, processor, prompt, cached=False):
+        self.processor = processor
+        self.prompt = prompt
+        self.cached = cached
+
+    def __call__(self, items):
+        items = [(file, image) for file, image in items if image is not None]
+        if not items:
+            return [], None, []
+        files, images = zip(*items)
+        prompts = [self.prompt] * len(images)
+        if not self.cached:
+            return list(files), self.processor(text=prompts, images=list(images), return_tensors="pt", padding=True), []
+        inputs = batch_inputs(self.processor, prompts, [pixels.values for pixels in images], padding=True)
+        return list(files), inputs, [pixels for pixels in images if not pixels.cached]
+
+
+def data_loader(files, processor, prompt, image_size=None, batch_size=8, workers=4, cache=None, pin_memory=False):
+    return DataLoader(
+        ImageFiles(files, image_size, cache),
+        batch_size=batch_size,
+        num_workers=workers,
+        collate_fn=Collator(processor, prompt, cached=cache is not None),
+        prefetch_factor=2 if workers else None,  # the next batches load while the current one is used
+        pin_memory=pin_memory,
+    )
+
+
+def run_epoch(loader, cache=None):
+    """Load every batch once, adding what the cache did not have; returns (images, seconds)."""
+    images = 0
+    started = time.perf_counter()
+    for files, _, fresh in loader:
+        for pixels in fresh:
+            cache.put(pixels.key, pixels.values)
+        images += len(files)
+    if cache is not None:
+        cache.flush()
+    return images, time.perf_counter() - started
+
+
+def benchmark(files, processor, image_size, batch_size, workers, epochs, dtype, workdir):
+    """Data loading time per epoch: without the cache, while filling it, and reading from it."""
+    prompt = f"{processor.image_token}\nDescribe the image."
+    cache = PixelCache(os.path.join(workdir, "pixel_cache"), processor, image_size, dtype)
+    runs = [("uncached", data_loader(files, processor, prompt, image_size, batch_size, workers), None)]
+    loader = data_loader(files, processor, prompt, image_size, batch_size, workers, cache=cache)
+    runs += [("cold", loader, cache)] + [(f"warm {epoch}", loader, cache) for epoch in range(1, epochs + 1)]
+    results = []
+    for name, run_loader, run_cache in runs:
+        images, seconds = run_epoch(run_loader, run_cache)
+        results.append({"epoch": name, "images": images, "seconds": round(seconds, 3), "images_per_sec": round(images / seconds, 2)})
+        logging.info(f"{name}: {images} images in {seconds:.2f}s")
+    shards = [name for name in os.listdir(cache.root) if name.endswith(".npy")]
+    return {
+        "images": len(files),
+        "batch_size": batch_size,
+        "workers": workers,
+        "image_size": image_size,
+        "dtype": dtype,
+        "cache_bytes": sum(os.path.getsize(os.path.join(cache.root, name)) for name in shards),
+        "epochs": results,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocessed pixel value cache")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    for name, description in (("build", "preprocess the images into the cache"),
+                       ("benchmark", "compare uncached, cold and warm epoch loading times")):
+        subparser = subcommands.add_parser(name, help=description)
+        subparser.add_argument("--images", required=True, help="glob of the images")
+        subparser.add_argument("--model", default=MODEL_ID, help="model whose processor prepares the images")
+        subparser.add_argument("--image-size", type=int, default=256, help="shortest side the images are resized to (0 to keep them)")
+        subparser.add_argument("--dtype", choices=("float32", "float16"), default="float32",
+                               help="stored precision; float16 loses nothing for a bfloat16 model")
+        subparser.add_argument("--batch-size", type=int, default=8)
+        subparser.add_argument("--workers", type=int, default=min(8, os.cpu_count() or 1))
+        subparser.add_argument("--limit", type=int, default=0, help="use at most this many images (0 for all)")
+    subcommands.choices["build"].add_argument("--cache", default=DEFAULT_CACHE_DIR)
+    subcommands.choices["benchmark"].add_argument("--epochs", type=int, default=2, help="warm epochs after the cold one")
+    subcommands.choices["benchmark"].add_argument("--workdir", help="where the benchmark cache is built (default: a new temporary directory, removed after)")
+    subcommands.choices["benchmark"].add_argument("--output", help="write the results as JSON to this file")
+    check_parser = subcommands.add_parser("check", help="compare batches built from cached pixels with the processor's output")
+    check_parser.add_argument("--model", default=MODEL_ID, help="model whose processor prepares the images")
+    check_parser.add_argument("--sizes", default="256x256,256x384", help="comma separated HEIGHTxWIDTH image sizes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    processor = AutoProcessor.from_pretrained(args.model)
+    if not supports(processor):
+        raise SystemExit(f"The {type(processor).__name__} of {args.model} does not expand image tokens like Pixtral's, it cannot use the cache")
+    processor.tokenizer.padding_side = "left"
+    if processor.tokenizer.pad_token is None:
+        processor.tokenizer.pad_token = processor.tokenizer.eos_token
+
+    if args.command == "check":
+        sizes = [tuple(int(side) for side in size.split("x")) for size in args.sizes.split(",")]
+        mismatches = check_batch_inputs(processor, f"{processor.image_token}\nDescribe the image.", sizes)
+        for mismatch in mismatches:
+            print(mismatch)
+        print(f"{len(sizes)} image sizes checked, {'no' if not mismatches else len(mismatches)} mismatches")
+        sys.exit(1 if mismatches else 0)
+
+    files = sorted(glob.glob(args.images))[:args.limit or None]
+    image_size = args.image_size or None
+
+    if args.command == "build":
+        cache = PixelCache(args.cache, processor, image_size, args.dtype)
+        loader = data_loader(files, processor, f"{processor.image_token}\n", image_size, args.batch_size, args.workers, cache=cache)
+        images, seconds = run_epoch(loader, cache)
+        print(f"{images} images in {seconds:.1f}s, {len(cache)} entries in {args.cache}")
+        sys.exit(0)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="pixel-cache-")
+    try:
+        report = benchmark(files, processor, image_size, args.batch_size, args.workers, args.epochs, args.dtype, workdir)
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    print(f"{report['images']} images, batch size {report['batch_size']}, {report['workers']} workers, "
+          f"cache {report['cache_bytes'] / 1024 ** 2:.1f} MB")
+    print(f"{'epoch':>9} {'seconds':>8} {'images/s':>9}")
+    for epoch in report["epochs"]:
+        print(f"{epoch['epoch']:>9} {epoch['seconds']:>8.2f} {epoch['images_per_sec']:>9.2f}")
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
@@ -0,0 +1,165 @@
+import io
+import os
+import mmap
+import base64
+import logging
+from collections import namedtuple
+from PIL import Image, ImageChops, ImageOps, ImageStat
+
+# Preprocessing settings, overridable from the environment
+MAX_SIDE = int(os.getenv("IMAGE_MAX_SIDE", 1024))  # cap on the longest side in pixels, 0 disables
+SHORTEST_SIDE = int(os.getenv("IMAGE_SHORTEST_SIDE", 0))  # target for the shortest side in pixels, 0 disables
+OUTPUT_FORMAT = os.getenv("IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+QUALITY = int(os.getenv("IMAGE_QUALITY", 85))
+THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", 256))
+GRAYSCALE_TOLERANCE = 3.0  # mean per-pixel channel difference still treated as grayscale
+BASE64_CHUNK = 3 * 256 * 1024  # bytes encoded at a time; a multiple of 3 so no padding lands mid-stream
+
+MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+# data is None when the original file at path is sent unchanged
+ProcessedImage = namedtuple(
+    "ProcessedImage", ["data", "mime_type", "width", "height", "bytes_before", "bytes_after", "path"]
+)
+
+
+def resize_image(image, max_side=MAX_SIDE, shortest_side=SHORTEST_SIDE):
+    """Downscale the image to the configured sides, never upscaling.
+
+    Based on resize_image in finetune_pixtral/create_dataset.py: the shortest
+    side is scaled to shortest_side and the longest side is capped at max_side.
+    """
+    width, height = image.size
+    scale = 1.0
+    if shortest_side:
+        scale = min(scale, shortest_side / min(width, height))
+    if max_side:
+        scale = min(scale, max_side / max(width, height))
+    if scale >= 1.0:
+        return image
+    new_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return image.resize(new_size, Image.LANCZOS)
+
+
+def is_grayscale(image):
+    """Check whether an image only carries gray levels, as X-ray and CT scans do."""
+    if image.mode in ("1", "L", "LA", "I", "I;16", "F"):
+        return True
+    sample = image.convert("RGB")
+    sample.thumbnail((128, 128))
+    red, green, blue = sample.split()
+    difference = ImageChops.add(ImageChops.difference(red, green), ImageChops.difference(green, blue))
+    return ImageStat.Stat(difference).mean[0] <= GRAYSCALE_TOLERANCE
+
+
+def _flatten(image):
+    # JPEG has no alpha channel; composite transparent screenshots onto white
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        return background
+    return image
+
+
+def _to_8bit(image):
+    # convert("L") clips 16-bit and float gray levels (the usual X-ray export) at 255;
+    # stretch the range the image actually uses over 0..255 instead
+    if image.mode not in ("I", "F") and not image.mode.startswith("I;16"):
+        return image
+    image = image.convert("F")
+    low, high = image.getextrema()
+    scale = 255.0 / (high - low) if high > low else 0.0
+    return image.point(lambda value: (value - low) * scale).convert("L")
+
+
+def preprocess_image(file_path, output_format=OUTPUT_FORMAT, quality=QUALITY, max_side=MAX_SIDE, shortest_side=SHORTEST_SIDE):
+    """Decode an uploaded image once, downscale and re-encode it for the vision model.
+
+    Grayscale content (X-ray/CT) is stored as a single channel. When re-encoding
+    would not make the payload smaller the original file is kept; it is not
+    read here but encoded from disk by encode_base64.
+    """
+    bytes_before = os.path.getsize(file_path)
+    with Image.open(file_path) as image:
+        source_format = image.format
+        source_size = image.size
+        target = max_side or shortest_side
+        if target and source_format == "JPEG":
+            # Let libjpeg decode at a reduced scale instead of decoding full size then resizing
+            image.draft(None, (target, target))
+        # In place: otherwise exif_transpose copies the full-size image even when it is upright
+        ImageOps.exif_transpose(image, in_place=True)
+        image = resize_image(_to_8bit(_flatten(image)), max_side=max_side, shortest_side=shortest_side)
+        image = image.convert("L") if is_grayscale(image) else image.convert("RGB")
+
+        buffer = io.BytesIO()
+        options = {"quality": quality}
+        if output_format == "JPEG":
+            options.update(optimize=True, progressive=True)
+        elif output_format == "WEBP":
+            options.update(method=4)
+        image.save(buffer, format=output_format, **options)
+        width, height = image.size
+
+    data = buffer.getvalue()
+    bytes_after = len(data)
+    mime_type = MIME_TYPES[output_format]
+    if bytes_after >= bytes_before and source_format in ("JPEG", "PNG", "WEBP"):
+        data, bytes_after = None, bytes_before
+        mime_type = MIME_TYPES[source_format]
+        width, height = source_size
+
+    logging.info(f"Preprocessed {os.path.basename(file_path)}: {bytes_before} -> {bytes_after} bytes ({width}x{height})")
+    return ProcessedImage(data, mime_type, width, height, bytes_before, bytes_after, file_path)
+
+
+def encode_base64(image):
+    """Return the base64 text of a preprocessed image for the data URL sent to the model.
+
+    An original file is encoded from a memory map a chunk at a time, and the
+    pages of each chunk are released once encoded, so the file is never in
+    memory next to its encoding.
+    """
+    if image.data is not None:
+        return base64.b64encode(image.data).decode("ascii")
+    with open(image.path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return ""
+        encoded = bytearray(4 * ((size + 2) // 3))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            for start in range(0, size, BASE64_CHUNK):
+                chunk = base64.b64encode(mapped[start:start + BASE64_CHUNK])
+                offset = start // 3 * 4
+                encoded[offset:offset + len(chunk)] = chunk
+                if hasattr(mmap, "MADV_DONTNEED"):
+                    mapped.madvise(mmap.MADV_DONTNEED, start, min(BASE64_CHUNK, size - start))
+    return encoded.decode("ascii")
+
+
+def make_thumbnail(file_path, thumbnail_path, size=THUMBNAIL_SIZE, quality=QUALITY):
+    """Write a JPEG thumbnail of an image once; later calls reuse the file on disk."""
+    if os.path.exists(thumbnail_path):
+        return thumbnail_path
+    with Image.open(file_path) as image:
+        image.draft(None, (size, size))
+        ImageOps.exif_transpose(image, in_place=True)
+        image = _to_8bit(_flatten(image))
+        image.thumbnail((size, size), Image.LANCZOS)
+        image = image.convert("L") if is_grayscale(image) else image.convert("RGB")
+        os.makedirs(os.path.dirname(thumbnail_path), exist_ok=True)
+        tmp_path = f"{thumbnail_path}.{os.getpid()}.tmp"
+        image.save(tmp_path, format="JPEG", quality=quality, optimize=True)
+    # Atomic rename so a concurrent request never serves a half-written thumbnail
+    os.replace(tmp_path, thumbnail_path)
+    return thumbnail_path
+
+
+def sniff_mime_type(file_path):
+    """Return the MIME type of an image file from its header."""
+    try:
+        with Image.open(file_path) as image:
+            return image.get_format_mimetype() or "application/octet-stream"
+    except OSError:
+        return "application/octet-stream"
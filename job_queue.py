@@ -0,0 +1,177 @@
+import os
+import time
+import uuid
+import logging
+import sqlite3
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+# Background analysis jobs, persisted so a restart picks up where it left off
+DEFAULT_PATH = os.path.join("instance", "jobs.db")
+WORKERS = int(os.getenv("JOB_WORKERS", 4))
+RETENTION = int(os.getenv("JOB_RETENTION", 7 * 24 * 3600))  # seconds finished jobs are kept
+MAX_ATTEMPTS = 3  # a job interrupted by restarts this often is marked failed
+
+Job = namedtuple("Job", [
+    "id", "user", "sid", "persona", "sha256", "filename", "status",
+    "response", "error", "attempts", "created_at", "started_at", "finished_at",
+])
+FINISHED = ("done", "failed")
+
+
+class JobQueue:
+    """SQLite-backed job table worked off by a thread pool.
+
+    Each job row records who asked for what and moves queued -> running ->
+    done/failed. Jobs still queued or running when the process stopped are
+    picked up again by start(). Waiters in this process are woken on every
+    status change; other processes see it on their next poll of the table.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, workers=WORKERS):
+        self.path = path
+        self.workers = workers
+        self.handler = None
+        self._executor = None
+        self._local = threading.local()
+        self._changed = threading.Condition()
+        self._start_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    user TEXT NOT NULL,
+                    sid TEXT,
+                    persona TEXT NOT NULL,
+                    sha256 TEXT NOT NULL,
+                    filename TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    response TEXT,
+                    error TEXT,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    started_at REAL,
+                    finished_at REAL
+                );
+                CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+            """)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def start(self, handler, recover=True):
+        """Start the workers with handler(job) -> response and pick up queued jobs.
+
+        With recover, jobs left running by a stopped process are requeued
+        first; a multi-process server does that once in its master instead,
+        since another worker may still be running them.
+        """
+        with self._start_lock:
+            if self._executor is not None:
+                return
+            self.handler = handler
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="job-worker")
+        if recover:
+            self.recover()
+        pending = [row[0] for row in self._connection().execute(
+            "SELECT id FROM jobs WHERE status = 'queued' ORDER BY created_at"
+        )]
+        if pending:
+            logging.info(f"Picked up {len(pending)} queued jobs")
+        for job_id in pending:
+            self._executor.submit(self._run, job_id)
+
+    def recover(self):
+        """Purge old jobs and requeue the ones interrupted while running."""
+        self.purge()
+        with self._connection() as conn:
+            requeued = conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'").rowcount
+        if requeued:
+            logging.info(f"Requeued {requeued} unfinished jobs")
+        return requeued
+
+    def shutdown(self, wait=True, cancel_pending=False):
+        """Stop the workers; with cancel_pending, queued jobs stay queued for the next start."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=cancel_pending)
+            self._executor = None
+
+    def submit(self, user, sid, persona, sha256, filename):
+        """Persist a new job and hand it to the workers; returns the job id."""
+        job_id = uuid.uuid4().hex
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT INTO jobs (id, user, sid, persona, sha256, filename, status, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, 'queued', ?)",
+                (job_id, user, sid, persona, sha256, filename, time.time()),
+            )
+        self._executor.submit(self._run, job_id)
+        return job_id
+
+    def get(self, job_id):
+        row = self._connection().execute(f"SELECT {', '.join(Job._fields)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(*row) if row else None
+
+    def wait(self, job_id, status, timeout):
+        """Block until the job's status differs from status, or the timeout passes; return the job."""
+        deadline = time.monotonic() + timeout
+        while True:
+            job = self.get(job_id)
+            remaining = deadline - time.monotonic()
+            if job is None or job.status != status or remaining <= 0:
+                return job
+            with self._changed:
+                # Woken by local workers; the 1s cap covers jobs run by other processes
+                self._changed.wait(min(remaining, 1.0))
+
+    def _set(self, job_id, **fields):
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        with self._connection() as conn:
+            conn.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*fields.values(), job_id))
+        with self._changed:
+            self._changed.notify_all()
+
+    def _run(self, job_id):
+        with self._connection() as conn:
+            # Claim the job, so a job requeued twice only runs once
+            claimed = conn.execute(
+                "UPDATE jobs SET status = 'running', started_at = ?, attempts = attempts + 1 "
+                "WHERE id = ? AND status = 'queued'", (time.time(), job_id)
+            ).rowcount
+        if not claimed:
+            return
+        with self._changed:
+            self._changed.notify_all()
+
+        job = self.get(job_id)
+        if job.attempts > MAX_ATTEMPTS:
+            self._set(job_id, status="failed", error="Job was interrupted too many times", finished_at=time.time())
+            return
+        try:
+            response = self.handler(job)
+        except Exception as e:
+            logging.error(f"Job {job_id} failed: {e}")
+            self._set(job_id, status="failed", error=str(e), finished_at=time.time())
+            return
+        self._set(job_id, status="done", response=response, finished_at=time.time())
+
+    def purge(self, retention=RETENTION):
+        """Delete finished jobs older than retention seconds."""
+        with self._connection() as conn:
+            return conn.execute(
+                "DELETE FROM jobs WHERE status IN ('done', 'failed') AND finished_at < ?", (time.time() - retention,)
+            ).rowcount
+
+    def stats(self):
+        rows = self._connection().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        return dict(rows)
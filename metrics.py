@@ -0,0 +1,199 @@
+import os
+import math
+import time
+import threading
+import contextvars
+from bisect import bisect_left
+from contextlib import contextmanager
+import tracing
+
+# In-process metrics, served in the Prometheus text format on /metrics.
+# Every thread updates its own shard without locks; a scrape merges the shards.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BYTES_BUCKETS = (1024, 16 * 1024, 64 * 1024, 256 * 1024, 1024 ** 2, 4 * 1024 ** 2, 16 * 1024 ** 2, 64 * 1024 ** 2)
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")  # when set, /metrics needs "Authorization: Bearer <token>"
+
+# Route template of the current request, or "background" on workers
+current_route = contextvars.ContextVar("current_route", default="background")
+
+_metrics = []
+_collectors = []
+_local = threading.local()
+_shards = []  # (thread, values) for every thread that has recorded something
+_retired = {}  # values of threads that have exited
+_lock = threading.Lock()
+
+
+def _values():
+    values = getattr(_local, "values", None)
+    if values is None:
+        values = _local.values = {}
+        with _lock:
+            _shards.append((threading.current_thread(), values))
+    return values
+
+
+def _merge(into, values):
+    for key, value in values.items():
+        if isinstance(value, list):
+            merged = into.setdefault(key, [0] * len(value))
+            for i, count in enumerate(value):
+                merged[i] += count
+        else:
+            into[key] = into.get(key, 0) + value
+
+
+def _snapshot():
+    """Sum of all shards; shards of exited threads are folded into _retired."""
+    with _lock:
+        totals = {}
+        _merge(totals, _retired)
+        live = []
+        for thread, values in _shards:
+            # Copies are made under the GIL, so they never see a half-applied update
+            copy = {key: list(value) if isinstance(value, list) else value for key, value in dict(values).items()}
+            if thread.is_alive():
+                live.append((thread, values))
+            else:
+                _merge(_retired, copy)
+            _merge(totals, copy)
+        _shards[:] = live
+    return totals
+
+
+class Counter:
+    """Monotonic counter with fixed label names."""
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        _metrics.append(self)
+
+    def inc(self, *labels, amount=1):
+        values = _values()
+        key = (self.name, labels)
+        values[key] = values.get(key, 0) + amount
+
+    def samples(self, totals):
+        for (name, labels), value in sorted(totals.items()):
+            if name == self.name:
+                yield self.name, dict(zip(self.labelnames, labels)), value
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets and label names."""
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        _metrics.append(self)
+
+    def observe(self, value, *labels):
+        values = _values()
+        key = (self.name, labels)
+        counts = values.get(key)
+        if counts is None:
+            # One slot per bucket, then +Inf, sum and count
+            counts = values[key] = [0] * (len(self.buckets) + 3)
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-2] += value
+        counts[-1] += 1
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def samples(self, totals):
+        for (name, labels), counts in sorted(totals.items()):
+            if name != self.name:
+                continue
+            labels = dict(zip(self.labelnames, labels))
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield f"{self.name}_bucket", dict(labels, le=_format_value(bound)), cumulative
+            yield f"{self.name}_sum", labels, counts[-2]
+            yield f"{self.name}_count", labels, counts[-1]
+
+
+REQUEST_SECONDS = Histogram("pixtalogy_request_seconds", "Time to the response headers per route", ("route", "method", "status"))
+STAGE_SECONDS = Histogram("pixtalogy_stage_seconds", "Time spent per request stage", ("route", "stage"))
+UPLOAD_BYTES = Histogram("pixtalogy_upload_bytes", "Size of uploaded files", ("route",), BYTES_BUCKETS)
+UPSTREAM_SECONDS = Histogram("pixtalogy_upstream_seconds", "Mistral API call latency, to the last token for streams", ("persona", "model", "mode", "outcome"))
+UPSTREAM_FIRST_TOKEN_SECONDS = Histogram("pixtalogy_upstream_first_token_seconds", "Time to the first streamed token", ("persona", "model"))
+UPSTREAM_TOKENS = Counter("pixtalogy_upstream_tokens_total", "Tokens reported in the API usage field", ("persona", "model", "kind"))
+UPSTREAM_PAYLOAD_BYTES = Counter("pixtalogy_upstream_payload_bytes_total", "Prompt bytes sent to the Mistral API", ("persona", "kind"))
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of the current request (or background work) into STAGE_SECONDS and the current trace."""
+    started = time.perf_counter()
+    try:
+        with tracing.span(name):
+            yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - started, current_route.get(), name)
+
+
+def register_collector(collect):
+    """Add a function called on every scrape; it returns (name, type, help, [(labels, value)]) families."""
+    _collectors.append(collect)
+
+
+def stats_samples(stats, labels=None):
+    """Samples of a stats() dict, one per numeric field with the field name in a "field" label."""
+    return [(dict(labels or {}, field=field), value) for field, value in stats.items()
+            if isinstance(value, (int, float)) and not isinstance(value, bool)]
+
+
+def stats_family(name, help, stats, labels=None, type="gauge"):
+    """A gauge family from a stats() dict, for register_collector."""
+    return name, type, help, stats_samples(stats, labels)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value)) if abs(value) < 1e15 else repr(value)
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in labels.items()) + "}"
+
+
+def render():
+    """Return every metric in the Prometheus text exposition format."""
+    totals = _snapshot()
+    lines = []
+    for metric in _metrics:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        for name, labels, value in metric.samples(totals):
+            lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    for collect in _collectors:
+        for name, type, help, samples in collect():
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {type}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+    return "\n".join(lines) + "\n"
@@ -1,21 +1,6 @@
-import os
 import base64
-import requests
-from dotenv import load_dotenv
-from mistralai import Mistral
-
-# Load the API key from the .env file
-load_dotenv()
-api_key = os.getenv("MISTRAL_API_KEY")
-
-# Check if the API key is loaded properly
-if api_key is None:
-    print("Error: API key not found. Please set MISTRAL_API_KEY in your .env file.")
-else:
-    print(f"Mistral API Key loaded: {api_key}")
-
-# Initialize the Mistral client
-client = Mistral(api_key=api_key)
+from models.client_factory import get_client
+from models.resilience import call_upstream
 
 
 def encode_file(file, is_image=False):
@@ -83,21 +68,9 @@ def get_mistral_response(content, is_image=False, medical_data=None, conversatio
         })
 
     try:
-        # Example call to the Mistral API (adjust as per actual API details)
-        response = requests.post(
-            'https://api.mistral.ai/chat',  # Replace with the actual Mistral API endpoint
-            json={
-                "model": model,
-                "messages": messages
-            },
-            headers={'Authorization': f'Bearer {api_key}'},  # Replace with your actual auth header
-            verify=False  # Temporary bypass of SSL verification (remove for production)
-        )
-        response.raise_for_status()  # Raise an error for bad HTTP status codes
-        return response.json().get('choices')[0]['message']['content']
-    except requests.exceptions.SSLError as e:
-        print(f"Mistral API SSL Error: {e}")
-        return None
+        # Go through the shared, pooled client instead of a one-off HTTP request
+        chat_response = call_upstream(get_client().chat.complete, model=model, messages=messages)
+        return chat_response.choices[0].message.content
     except Exception as e:
         print(f"Mistral API Error: {e}")
         return None
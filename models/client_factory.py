@@ -0,0 +1,95 @@
+import os
+import logging
+import threading
+from dotenv import load_dotenv
+
+# Connection pool settings, overridable from the environment or the .env file
+DEFAULT_POOL_SIZE = 20
+DEFAULT_KEEPALIVE_CONNECTIONS = 10
+DEFAULT_KEEPALIVE_EXPIRY = 30.0  # seconds an idle connection is kept open
+DEFAULT_TIMEOUT = 60.0  # seconds
+DEFAULT_CONNECT_TIMEOUT = 5.0  # seconds
+
+_client = None
+_lock = threading.Lock()
+
+
+def _env_number(name, default, cast=float):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    try:
+        return cast(value)
+    except ValueError:
+        logging.error(f"Invalid value for {name}: {value!r}, using {default}.")
+        return default
+
+
+def client_settings():
+    """Return the pool and timeout settings used to build the shared client."""
+    return {
+        "pool_size": _env_number("MISTRAL_POOL_SIZE", DEFAULT_POOL_SIZE, int),
+        "keepalive_connections": _env_number("MISTRAL_KEEPALIVE_CONNECTIONS", DEFAULT_KEEPALIVE_CONNECTIONS, int),
+        "keepalive_expiry": _env_number("MISTRAL_KEEPALIVE_EXPIRY", DEFAULT_KEEPALIVE_EXPIRY),
+        "timeout": _env_number("MISTRAL_TIMEOUT", DEFAULT_TIMEOUT),
+        "connect_timeout": _env_number("MISTRAL_CONNECT_TIMEOUT", DEFAULT_CONNECT_TIMEOUT),
+        # Point the client at another server, e.g. a local fake for failure testing
+        "server_url": os.getenv("MISTRAL_SERVER_URL") or None,
+    }
+
+
+def _build_client():
+    # Imported here, the SDK takes most of a second to import and is only needed once
+    import httpx
+    from mistralai import Mistral
+
+    # Load the API key from the .env file
+    load_dotenv()
+    api_key = os.getenv("MISTRAL_API_KEY")
+
+    # Check if the API key is loaded properly
+    if api_key is None:
+        logging.error("Error: API key not found. Please set MISTRAL_API_KEY in your .env file.")
+    else:
+        logging.info("Mistral API Key loaded successfully.")
+
+    settings = client_settings()
+    limits = httpx.Limits(
+        max_connections=settings["pool_size"],
+        max_keepalive_connections=settings["keepalive_connections"],
+        keepalive_expiry=settings["keepalive_expiry"],
+    )
+    timeout = httpx.Timeout(settings["timeout"], connect=settings["connect_timeout"])
+
+    # One sync and one async pool, shared by every persona
+    return Mistral(
+        api_key=api_key,
+        server_url=settings["server_url"],
+        client=httpx.Client(limits=limits, timeout=timeout),
+        async_client=httpx.AsyncClient(limits=limits, timeout=timeout),
+        timeout_ms=int(settings["timeout"] * 1000),
+    )
+
+
+def get_client():
+    """Return the shared Mistral client, building it on first use.
+
+    The same instance serves blocking calls (client.chat.complete/stream) and
+    asyncio code (client.chat.complete_async/stream_async).
+    """
+    global _client
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = _build_client()
+    return _client
+
+
+def close_client():
+    """Close the shared client's connection pools, e.g. on worker shutdown."""
+    global _client
+    with _lock:
+        if _client is not None:
+            _client.sdk_configuration.client.close()
+            # The async pool belongs to whichever event loop used it; it is released with the client
+            _client = None
@@ -0,0 +1,236 @@
+import os
+import re
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+# History token budgets per persona, filled from models/personas.json and
+# overridable with HISTORY_TOKEN_BUDGET_<PERSONA>
+DEFAULT_HISTORY_TOKEN_BUDGET = 1024
+HISTORY_TOKEN_BUDGETS = {}
+SUMMARY_TOKEN_BUDGET = int(os.getenv("HISTORY_SUMMARY_TOKEN_BUDGET", 256))
+SUMMARY_LINE_CHARS = 160  # each folded turn is reduced to its first sentence, at most this long
+IMAGE_TOKEN_ESTIMATE = 1024  # flat cost assumed for an image part when counting prompt tokens
+MESSAGE_OVERHEAD_TOKENS = 4  # role and control tokens around every message
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+
+def _get_tokenizer():
+    global _tokenizer
+    if _tokenizer is None:
+        with _tokenizer_lock:
+            if _tokenizer is None:
+                try:
+                    # Imported on first use, mistral_common is slow to import and optional
+                    from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
+                    # Tekken is the tokenizer used by pixtral-12b-2409, bundled with mistral_common
+                    _tokenizer = MistralTokenizer.v3(is_tekken=True).instruct_tokenizer.tokenizer
+                except ImportError:  # optional, falls back to a character-based estimate
+                    _tokenizer = False
+                except Exception as e:
+                    logging.error(f"Could not load the Mistral tokenizer, estimating token counts: {e}")
+                    _tokenizer = False
+    return _tokenizer or None
+
+
+@lru_cache(maxsize=4096)
+def count_tokens(text):
+    """Count the tokens of a text with the local Mistral tokenizer (or an estimate)."""
+    if not text:
+        return 0
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return max(1, len(text) // 4)
+    return len(tokenizer.encode(text, bos=False, eos=False))
+
+
+def truncate_tokens(text, max_tokens):
+    """Cut text down to at most max_tokens tokens."""
+    text = str(text)
+    if count_tokens(text) <= max_tokens:
+        return text
+    tokenizer = _get_tokenizer()
+    if tokenizer is None:
+        return text[:max_tokens * 4]
+    return tokenizer.decode(tokenizer.encode(text, bos=False, eos=False)[:max_tokens])
+
+
+def message_tokens(message):
+    """Count the tokens of one chat message, including multimodal content parts."""
+    content = message.get("content", "")
+    if isinstance(content, str):
+        return MESSAGE_OVERHEAD_TOKENS + count_tokens(content)
+    tokens = MESSAGE_OVERHEAD_TOKENS
+    for part in content:
+        if part.get("type") == "text":
+            tokens += count_tokens(part.get("text", ""))
+        else:
+            tokens += IMAGE_TOKEN_ESTIMATE
+    return tokens
+
+
+def history_budget(persona):
+    override = os.getenv(f"HISTORY_TOKEN_BUDGET_{persona.upper()}")
+    if override:
+        return int(override)
+    return HISTORY_TOKEN_BUDGETS.get(persona, DEFAULT_HISTORY_TOKEN_BUDGET)
+
+
+class ContextStats:
+    """Per-persona prompt-size counters for tuning the history budgets."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._personas = {}
+
+    def record_window(self, persona, kept_turns, folded_turns, history_tokens):
+        with self._lock:
+            stats = self._persona(persona)
+            stats["windows"] += 1
+            stats["kept_turns"] += kept_turns
+            stats["folded_turns"] += folded_turns
+            stats["history_tokens"] += history_tokens
+
+    def record_summary(self, persona):
+        with self._lock:
+            self._persona(persona)["summary_recomputes"] += 1
+
+    def record_prompt(self, persona, prompt_tokens):
+        with self._lock:
+            stats = self._persona(persona)
+            stats["requests"] += 1
+            stats["prompt_tokens"] += prompt_tokens
+            stats["last_prompt_tokens"] = prompt_tokens
+            stats["max_prompt_tokens"] = max(stats["max_prompt_tokens"], prompt_tokens)
+
+    def _persona(self, persona):
+        if persona not in self._personas:
+            self._personas[persona] = dict.fromkeys((
+                "requests", "prompt_tokens", "last_prompt_tokens", "max_prompt_tokens", "windows",
+                "kept_turns", "folded_turns", "history_tokens", "summary_recomputes",
+            ), 0)
+        return self._personas[persona]
+
+    def snapshot(self):
+        with self._lock:
+            return {persona: dict(stats, budget=history_budget(persona)) for persona, stats in self._personas.items()}
+
+
+context_stats = ContextStats()
+
+
+class SummaryCache:
+    """LRU of rolling summaries keyed by the exact run of folded turns."""
+
+    def __init__(self, max_entries=512):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            summary = self._entries.get(key)
+            if summary is not None:
+                self._entries.move_to_end(key)
+            return summary
+
+    def set(self, key, summary):
+        with self._lock:
+            self._entries[key] = summary
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+summary_cache = SummaryCache()
+
+
+@lru_cache(maxsize=4096)
+def _summary_line(role, content):
+    first_sentence = re.split(r"(?<=[.!?])\s", " ".join(content.split()), maxsplit=1)[0]
+    if len(first_sentence) > SUMMARY_LINE_CHARS:
+        first_sentence = first_sentence[:SUMMARY_LINE_CHARS].rsplit(" ", 1)[0] + "..."
+    speaker = "User" if role == "user" else "Assistant"
+    return f"{speaker}: {first_sentence}"
+
+
+def summarize_turns(turns, max_tokens=SUMMARY_TOKEN_BUDGET):
+    """Fold older turns into a short extractive summary that fits max_tokens.
+
+    Built locally from the first sentence of each turn, so no extra upstream
+    call is needed; the newest folded turns win when the summary is too long.
+    """
+    lines = []
+    tokens = count_tokens("Summary of the earlier conversation:")
+    for turn in reversed(turns):
+        line = _summary_line(turn.get("role", "user"), str(turn.get("content", "")))
+        line_tokens = count_tokens(line) + 1
+        if tokens + line_tokens > max_tokens:
+            break
+        lines.append(line)
+        tokens += line_tokens
+    return "Summary of the earlier conversation:\n" + "\n".join(reversed(lines))
+
+
+def _turns_key(persona, turns):
+    digest = hashlib.sha256(persona.encode("utf-8"))
+    for turn in turns:
+        digest.update(b"\x1e" + str(turn.get("role")).encode("utf-8") + b"\x1f" + str(turn.get("content")).encode("utf-8"))
+    return digest.hexdigest()
+
+
+def _newest_turns(conversation_history, budget):
+    kept = []
+    used = 0
+    for message in reversed(conversation_history):
+        tokens = message_tokens(message)
+        if used + tokens > budget:
+            break
+        kept.append(message)
+        used += tokens
+    kept.reverse()
+    return kept, used
+
+
+def build_history(persona, conversation_history, budget=None, record=True):
+    """Select the history to send for a persona within its token budget.
+
+    Turns are taken newest first until the budget is spent; anything older is
+    folded into a cached rolling summary placed at the start. The summary is
+    only recomputed when the window slides and new turns fall out of it.
+    """
+    if not conversation_history:
+        return []
+    budget = history_budget(persona) if budget is None else budget
+
+    kept, used = _newest_turns(conversation_history, budget)
+    folded = []
+    messages = []
+    if len(kept) < len(conversation_history):
+        # Make room for the summary inside the same budget
+        summary_budget = min(SUMMARY_TOKEN_BUDGET, budget // 4)
+        kept, used = _newest_turns(conversation_history, budget - summary_budget)
+        folded = conversation_history[:len(conversation_history) - len(kept)]
+        key = _turns_key(persona, folded)
+        summary = summary_cache.get(key)
+        if summary is None:
+            summary = summarize_turns(folded, summary_budget - MESSAGE_OVERHEAD_TOKENS)
+            summary_cache.set(key, summary)
+            context_stats.record_summary(persona)
+        messages.append({"role": "system", "content": summary})
+        used += count_tokens(summary) + MESSAGE_OVERHEAD_TOKENS
+
+    if record:
+        context_stats.record_window(persona, len(kept), len(folded), used)
+    return messages + kept
+
+
+def record_prompt(persona, messages):
+    """Record the prompt size of a request that is about to be sent upstream."""
+    prompt_tokens = sum(message_tokens(message) for message in messages)
+    context_stats.record_prompt(persona, prompt_tokens)
+    return prompt_tokens
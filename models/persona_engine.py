@@ -0,0 +1,208 @@
+import os
+import json
+import string
+import time
+import logging
+import metrics
+import tracing
+from models.client_factory import get_client
+from models.context_builder import HISTORY_TOKEN_BUDGETS, build_history, count_tokens, record_prompt, truncate_tokens
+from models.response_cache import cached_response
+from models.scheduler import scheduled
+from models.resilience import call_upstream
+
+# Declarative persona registry: prompts, token limits, history budgets and model per persona
+REGISTRY_PATH = os.getenv("PERSONA_REGISTRY", os.path.join(os.path.dirname(os.path.abspath(__file__)), "personas.json"))
+
+ERROR_RESPONSE = "Error occurred while communicating with the Mistral API."
+NO_RESPONSE = "No response from the model."
+
+
+def compile_template(template):
+    """Parse a prompt template once; the returned function only joins the pieces."""
+    pieces = []
+    for literal, field, _, _ in string.Formatter().parse(template):
+        if literal:
+            pieces.append((literal, None))
+        if field is not None:
+            pieces.append((None, field))
+    if all(field is None for _, field in pieces):
+        text = "".join(literal for literal, _ in pieces)
+        return lambda **values: text
+
+    def render(**values):
+        return "".join(literal if field is None else str(values[field]) for literal, field in pieces)
+    return render
+
+
+class Persona:
+    """One chat persona from the registry and its model calls.
+
+    get_mistral_response(content, is_image, medical_data, conversation_history,
+    mime_type) goes through the response cache, the scheduler and the
+    resilience layer; stream_mistral_response(content, conversation_history)
+    yields text tokens.
+    """
+
+    def __init__(self, name, prompts, model, title=None, template=None, max_tokens=None,
+                 history_token_budget=None, truncate=None, accept=None):
+        self.name = name
+        self.title = title or name.replace("_", " ").title()
+        self.template = template or "persona_chat.html"
+        self.accept = accept or "image/*, .pdf, .docx"  # file types the chat page offers to upload
+        self.model = model
+        self.max_tokens = max_tokens
+        self.truncate = truncate or {}
+        if history_token_budget:
+            HISTORY_TOKEN_BUDGETS[name] = history_token_budget
+
+        self._text_prompt = compile_template(prompts["text"])
+        self._data_prompt = compile_template(prompts["data"])
+        self._image_prompt = {"type": "text", "text": prompts["image"]}
+        self._options = {"model": model}
+        if max_tokens:
+            self._options["max_tokens"] = max_tokens  # Limit output tokens
+
+        self.get_mistral_response = cached_response(name, model)(scheduled(self._complete))
+        self.stream_mistral_response = scheduled(self._stream)
+
+    def _truncated(self, value, field):
+        limit = self.truncate.get(field)
+        return truncate_tokens(value, limit) if limit else value
+
+    def build_messages(self, content, is_image=False, medical_data=None, conversation_history=None, mime_type="image/jpeg"):
+        """Build the message list sent to the Mistral API."""
+        messages = []
+
+        # Include conversation history if provided, newest turns first within the persona's token budget
+        if conversation_history:
+            messages.extend(build_history(self.name, conversation_history))
+
+        # Construct the user message based on the input type
+        if medical_data:
+            messages.append({"role": "user", "content": self._data_prompt(data=self._truncated(medical_data, "data"))})
+        elif is_image:
+            messages.append({
+                "role": "user",
+                "content": [
+                    self._image_prompt,
+                    {"type": "image_url", "image_url": f"data:{mime_type};base64,{content}"}
+                ]
+            })
+        else:
+            messages.append({"role": "user", "content": self._text_prompt(content=self._truncated(content, "content"))})
+
+        record_prompt(self.name, messages)
+        return messages
+
+    def _complete(self, content, is_image=False, medical_data=None, conversation_history=None, mime_type="image/jpeg"):
+        """Send content to the Mistral API and return the response text."""
+        messages = self.build_messages(content, is_image=is_image, medical_data=medical_data, conversation_history=conversation_history, mime_type=mime_type)
+        self._count_payload(messages, is_image)
+
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with tracing.span("mistral.complete", persona=self.name, model=self.model, image=is_image):
+                chat_response = call_upstream(get_client().chat.complete, messages=messages, hedge=not is_image, **self._options)
+            logging.info(f"Successful Mistral API Response: {chat_response}")
+            outcome = "ok"
+            self._count_usage(getattr(chat_response, "usage", None))
+
+            # Ensure choices are available before accessing
+            if chat_response.choices:
+                return chat_response.choices[0].message.content
+            logging.error("No response choices available from Mistral API.")
+            return NO_RESPONSE
+        except Exception as e:
+            logging.error(f"Mistral API Error: {e}")
+            return ERROR_RESPONSE
+        finally:
+            metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name, self.model, "complete", outcome)
+
+    def _stream(self, content, conversation_history=None):
+        """Stream the Mistral API response, yielding text tokens as they arrive."""
+        messages = self.build_messages(content, conversation_history=conversation_history)
+        self._count_payload(messages, False)
+
+        started = time.perf_counter()
+        first_token = None
+        outcome = "error"
+        try:
+            with tracing.span("mistral.stream", persona=self.name, model=self.model):
+                chat_stream = call_upstream(get_client().chat.stream, messages=messages, **self._options)
+            for chunk in chat_stream:
+                # The usage field comes with the last chunk
+                self._count_usage(getattr(chunk.data, "usage", None))
+                if not chunk.data.choices:
+                    continue
+                token = chunk.data.choices[0].delta.content
+                if isinstance(token, str) and token:
+                    if first_token is None:
+                        first_token = time.perf_counter() - started
+                        metrics.UPSTREAM_FIRST_TOKEN_SECONDS.observe(first_token, self.name, self.model)
+                    yield token
+            outcome = "ok"
+        except GeneratorExit:
+            outcome = "cancelled"  # the client went away mid-stream
+            raise
+        except Exception as e:
+            logging.error(f"Mistral API Error: {e}")
+            yield ERROR_RESPONSE
+        finally:
+            metrics.UPSTREAM_SECONDS.observe(time.perf_counter() - started, self.name, self.model, "stream", outcome)
+
+    def _count_payload(self, messages, is_image):
+        size = 0
+        for message in messages:
+            content = message["content"]
+            if isinstance(content, str):
+                size += len(content)
+            else:
+                size += sum(len(part.get("text") or part.get("image_url") or "") for part in content)
+        metrics.UPSTREAM_PAYLOAD_BYTES.inc(self.name, "image" if is_image else "text", amount=size)
+
+    def _count_usage(self, usage):
+        if usage:
+            metrics.UPSTREAM_TOKENS.inc(self.name, self.model, "prompt", amount=usage.prompt_tokens or 0)
+            metrics.UPSTREAM_TOKENS.inc(self.name, self.model, "completion", amount=usage.completion_tokens or 0)
+
+
+def load_registry(path=REGISTRY_PATH):
+    """Build the personas of a registry file, keyed by name in file order."""
+    with open(path, encoding="utf-8") as f:
+        registry = json.load(f)
+    defaults = registry.get("defaults", {})
+    personas = {}
+    for entry in registry["personas"]:
+        settings = {**defaults, **entry}
+        settings["truncate"] = {**defaults.get("truncate", {}), **entry.get("truncate", {})}
+        personas[entry["name"]] = Persona(**settings)
+    return personas
+
+
+PERSONAS = load_registry()
+
+
+def warm_up(connect=False):
+    """Do the slow first-call work before traffic arrives: build the client and load the tokenizer.
+
+    With connect, also make one free API call (listing models), so the
+    connection pool holds an open TLS connection.
+    """
+    started = time.perf_counter()
+    client = get_client()
+    count_tokens("warm up")  # loads the tokenizer
+    if connect:
+        try:
+            client.models.list()
+        except Exception as e:
+            logging.warning(f"Warm-up call to the Mistral API failed: {e}")
+    logging.info(f"Warmed up {len(PERSONAS)} personas in {time.perf_counter() - started:.2f}s")
+
+
+if __name__ == "__main__":
+    # Example usage: python -m models.persona_engine radiologist "What does a hairline fracture look like?"
+    import sys
+    persona = PERSONAS[sys.argv[1]]
+    print(persona.get_mistral_response(" ".join(sys.argv[2:])))
@@ -0,0 +1,262 @@
+import os
+import time
+import random
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import httpx
+from models.scheduler import upstream_scheduler
+
+# Resilience settings, overridable from the environment
+CALL_DEADLINE = float(os.getenv("MISTRAL_CALL_DEADLINE", 45))  # seconds for a call including all retries
+MAX_ATTEMPTS = int(os.getenv("MISTRAL_MAX_ATTEMPTS", 3))
+BACKOFF_BASE = float(os.getenv("MISTRAL_BACKOFF_BASE", 0.5))  # seconds before the first retry
+BACKOFF_MAX = float(os.getenv("MISTRAL_BACKOFF_MAX", 8))
+BREAKER_FAILURE_THRESHOLD = int(os.getenv("MISTRAL_BREAKER_FAILURES", 5))  # consecutive failures that open the breaker
+BREAKER_RESET_TIMEOUT = float(os.getenv("MISTRAL_BREAKER_RESET", 30))  # seconds open before a trial call
+# Hedge text-only calls: a number of seconds, "auto" for the observed p95 latency, or 0 to disable
+HEDGE_AFTER = os.getenv("MISTRAL_HEDGE_AFTER", "0")
+HEDGE_MIN_SAMPLES = 20  # latencies needed before "auto" hedging starts
+MIN_ATTEMPT_TIMEOUT = 1.0  # seconds; no attempt is started with less time than this left
+
+RETRYABLE_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class CircuitOpen(Exception):
+    """Raised without calling upstream while the circuit breaker is open."""
+
+
+class DeadlineExceeded(Exception):
+    """Raised when a call runs out of its overall time budget."""
+
+
+def is_retryable(error):
+    if isinstance(error, (httpx.TimeoutException, httpx.TransportError)):
+        return True
+    # mistralai raises SDKError (and subclasses) carrying the HTTP status code
+    return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+
+def _retry_after(error):
+    headers = getattr(error, "headers", None)
+    try:
+        return float(headers.get("retry-after")) if headers else None
+    except (TypeError, ValueError):
+        return None
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets one trial call through after a cool-down."""
+
+    def __init__(self, failure_threshold=BREAKER_FAILURE_THRESHOLD, reset_timeout=BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+            self._trial_in_flight = False
+
+    def record_neutral(self):
+        # Upstream answered but refused the request itself: neither healthy nor failing
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            self._trial_in_flight = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    logging.warning(f"Mistral circuit breaker opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+
+class ResilientCaller:
+    """Deadline, jittered exponential retry, circuit breaker and hedging around upstream calls.
+
+    The wrapped function must accept a timeout_ms keyword (all mistralai
+    chat methods do); each attempt gets whatever is left of the deadline.
+    Calls run inside a slot of the scheduler; a hedge is an extra upstream
+    request, so it is only sent when slots can give it one of its own.
+    """
+
+    def __init__(self, deadline=CALL_DEADLINE, max_attempts=MAX_ATTEMPTS, backoff_base=BACKOFF_BASE,
+                 backoff_max=BACKOFF_MAX, breaker=None, hedge_after=HEDGE_AFTER, slots=None):
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        self.hedge_after = hedge_after
+        self.slots = slots
+        self._latencies = deque(maxlen=512)  # recent successful attempt latencies
+        self._hedge_pool = None
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys((
+            "calls", "successes", "failures", "attempts", "retries", "timeouts",
+            "deadline_exceeded", "breaker_rejections", "hedges", "hedge_wins", "hedges_skipped",
+        ), 0)
+
+    def _count(self, name, amount=1):
+        with self._lock:
+            self.counters[name] += amount
+
+    def call(self, fn, *args, hedge=False, **kwargs):
+        """Call fn(*args, timeout_ms=..., **kwargs) with retries; raise the last error on failure."""
+        self._count("calls")
+        deadline = time.monotonic() + self.deadline
+        attempt = 0
+        while True:
+            attempt += 1
+            if not self.breaker.allow():
+                self._count("breaker_rejections")
+                self._count("failures")
+                raise CircuitOpen("Mistral API circuit breaker is open")
+            try:
+                if hedge and self._hedge_delay() is not None:
+                    result = self._hedged_attempt(fn, args, kwargs, deadline)
+                else:
+                    result = self._attempt(fn, args, kwargs, deadline)
+            except DeadlineExceeded:
+                # Nothing was sent, but a half-open trial granted by allow() has to be given back
+                self.breaker.record_neutral()
+                self._count("failures")
+                raise
+            except Exception as e:
+                if isinstance(e, httpx.TimeoutException):
+                    self._count("timeouts")
+                if not is_retryable(e):
+                    # The request itself was bad (e.g. 400/422), which says nothing about upstream's health
+                    self.breaker.record_neutral()
+                    self._count("failures")
+                    raise
+                self.breaker.record_failure()
+                delay = self._backoff(attempt, e)
+                if attempt >= self.max_attempts or time.monotonic() + delay + MIN_ATTEMPT_TIMEOUT > deadline:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                logging.warning(f"Mistral call failed ({e}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+                continue
+            self.breaker.record_success()
+            self._count("successes")
+            return result
+
+    def _attempt(self, fn, args, kwargs, deadline):
+        remaining = deadline - time.monotonic()
+        if remaining < MIN_ATTEMPT_TIMEOUT:
+            self._count("deadline_exceeded")
+            raise DeadlineExceeded(f"No time left for another Mistral call ({remaining:.2f}s)")
+        self._count("attempts")
+        started = time.monotonic()
+        result = fn(*args, timeout_ms=int(remaining * 1000), **kwargs)
+        with self._lock:
+            self._latencies.append(time.monotonic() - started)
+        return result
+
+    def _hedged_attempt(self, fn, args, kwargs, deadline):
+        # Start a second identical request if the first is slower than the hedge delay;
+        # whichever answers first wins, the other one's result is discarded
+        pool = self._pool()
+        primary = pool.submit(self._attempt, fn, args, kwargs, deadline)
+        done, _ = wait([primary], timeout=self._hedge_delay())
+        if done:
+            return primary.result()
+        if self.slots is not None and not self.slots.try_acquire():
+            # Every slot is busy (or wanted), a hedge would go past the in-flight cap
+            self._count("hedges_skipped")
+            return primary.result()
+        self._count("hedges")
+        secondary = pool.submit(self._attempt, fn, args, kwargs, deadline)
+        if self.slots is not None:
+            # The loser keeps running upstream after the caller returns, so the
+            # extra slot is held until both requests are done
+            finished = []
+
+            def release_when_both_done(future):
+                with self._lock:
+                    finished.append(future)
+                    last = len(finished) == 2
+                if last:
+                    self.slots.release()
+
+            primary.add_done_callback(release_when_both_done)
+            secondary.add_done_callback(release_when_both_done)
+        pending = {primary, secondary}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is secondary:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _pool(self):
+        if self._hedge_pool is None:
+            with self._lock:
+                if self._hedge_pool is None:
+                    self._hedge_pool = ThreadPoolExecutor(max_workers=16, thread_name_prefix="mistral-hedge")
+        return self._hedge_pool
+
+    def _hedge_delay(self):
+        if self.hedge_after == "auto":
+            with self._lock:
+                if len(self._latencies) < HEDGE_MIN_SAMPLES:
+                    return None
+                latencies = sorted(self._latencies)
+            return latencies[int(len(latencies) * 0.95)]
+        delay = float(self.hedge_after or 0)
+        return delay if delay > 0 else None
+
+    def _backoff(self, attempt, error):
+        retry_after = _retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.backoff_max)
+        # Full jitter, so retries from many workers do not arrive together
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def stats(self):
+        """Return outcome counters, breaker state and recent latency figures."""
+        with self._lock:
+            latencies = sorted(self._latencies)
+            stats = dict(self.counters)
+        stats.update(
+            breaker_state=self.breaker.state,
+            latency_p50=latencies[len(latencies) // 2] if latencies else 0.0,
+            latency_p95=latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            hedge_after=self._hedge_delay(),
+        )
+        return stats
+
+
+# Shared by every persona, so the breaker sees the health of the whole upstream
+upstream = ResilientCaller(slots=upstream_scheduler)
+
+
+def call_upstream(fn, *args, hedge=False, **kwargs):
+    """Call a mistralai client method through the shared resilience layer."""
+    return upstream.call(fn, *args, hedge=hedge, **kwargs)
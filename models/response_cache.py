@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import base64
+import hashlib
+import inspect
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict
+from functools import wraps
+from models.context_builder import build_history
+from models.singleflight import upstream_calls
+
+# Cache settings, overridable from the environment
+DEFAULT_BACKEND = "memory"  # "memory" or "sqlite"
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL = 3600  # seconds
+DEFAULT_SQLITE_PATH = os.path.join("instance", "response_cache.db")
+
+# Persona modules return these strings instead of raising; they must never be cached
+UNCACHEABLE_RESPONSES = {
+    None,
+    "",
+    "No response from the model.",
+    "Error occurred while communicating with the Mistral API.",
+}
+
+
+def normalize_message(text):
+    """Collapse whitespace and case so trivially different prompts share a cache entry."""
+    return " ".join(str(text).split()).casefold()
+
+
+def image_digest(encoded_image):
+    """Return the SHA-256 of the raw image bytes behind a base64 payload."""
+    try:
+        image_bytes = base64.b64decode(encoded_image, validate=True)
+    except (ValueError, TypeError):
+        image_bytes = str(encoded_image).encode("utf-8")
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def history_fingerprint(conversation_history):
+    """Hash the windowed history that is actually sent upstream."""
+    if not conversation_history:
+        return ""
+    turns = [
+        [message.get("role"), normalize_message(message.get("content", ""))]
+        for message in conversation_history
+    ]
+    return hashlib.sha256(json.dumps(turns).encode("utf-8")).hexdigest()
+
+
+def make_key(persona, model, content, is_image=False, conversation_history=None, extra=None):
+    """Build the cache key for one persona completion.
+
+    conversation_history should already be windowed the way the persona sends it.
+    """
+    if is_image:
+        message, image = "", image_digest(content)
+    else:
+        message, image = normalize_message(content), ""
+    parts = [
+        persona,
+        model,
+        message,
+        image,
+        history_fingerprint(conversation_history),
+        json.dumps(extra or {}, sort_keys=True, default=str),
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()
+
+
+class MemoryBackend:
+    """In-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (value, expired) for a key; value is None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, False
+            value, expires_at = entry
+            if expires_at < time.time():
+                del self._entries[key]
+                return None, True
+            self._entries.move_to_end(key)
+            return value, False
+
+    def set(self, key, value):
+        """Store a value and return how many entries were evicted to make room."""
+        with self._lock:
+            self._entries[key] = (value, time.time() + self.ttl)
+            self._entries.move_to_end(key)
+            evicted = 0
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                evicted += 1
+            return evicted
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteBackend:
+    """On-disk LRU cache with a TTL, shareable between worker processes on one host."""
+
+    def __init__(self, path=DEFAULT_SQLITE_PATH, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS response_cache ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS response_cache_accessed ON response_cache (accessed_at)")
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        with self._connection() as conn:
+            row = conn.execute("SELECT value, expires_at FROM response_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, False
+            value, expires_at = row
+            if expires_at < now:
+                conn.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+                return None, True
+            conn.execute("UPDATE response_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            return value, False
+
+    def set(self, key, value):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO response_cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, value, now + self.ttl, now),
+            )
+            conn.execute("DELETE FROM response_cache WHERE expires_at < ?", (now,))
+            cursor = conn.execute(
+                "DELETE FROM response_cache WHERE key IN ("
+                "SELECT key FROM response_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+            return max(cursor.rowcount, 0)
+
+    def clear(self):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM response_cache")
+
+    def __len__(self):
+        return self._connection().execute("SELECT COUNT(*) FROM response_cache").fetchone()[0]
+
+
+class ResponseCache:
+    """Counts hits, misses and evictions in front of a cache backend."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        try:
+            value, expired = self.backend.get(key)
+        except sqlite3.Error as e:
+            logging.error(f"Response cache read failed: {e}")
+            value, expired = None, False
+        with self._lock:
+            if value is None:
+                self.misses += 1
+                self.expirations += int(expired)
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        try:
+            evicted = self.backend.set(key, value)
+        except sqlite3.Error as e:
+            logging.error(f"Response cache write failed: {e}")
+            return
+        with self._lock:
+            self.evictions += evicted
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        """Return the cache counters, e.g. for logging or a metrics endpoint."""
+        with self._lock:
+            return {
+                "backend": type(self.backend).__name__,
+                "entries": len(self.backend),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+def _build_cache():
+    max_entries = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES))
+    ttl = float(os.getenv("RESPONSE_CACHE_TTL", DEFAULT_TTL))
+    if os.getenv("RESPONSE_CACHE_BACKEND", DEFAULT_BACKEND) == "sqlite":
+        path = os.getenv("RESPONSE_CACHE_PATH", DEFAULT_SQLITE_PATH)
+        return ResponseCache(SQLiteBackend(path, max_entries=max_entries, ttl=ttl))
+    return ResponseCache(MemoryBackend(max_entries=max_entries, ttl=ttl))
+
+
+response_cache = _build_cache()
+
+
+def cached_response(persona, model):
+    """Serve repeated persona completions from the response cache.
+
+    Concurrent misses for the same key are coalesced into one upstream call.
+
+    The wrapped function keeps its get_mistral_response(content, is_image, ...,
+    conversation_history) signature; any other arguments become part of the key.
+    """
+    def decorator(get_mistral_response):
+        signature = inspect.signature(get_mistral_response)
+
+        def cache_key(*args, **kwargs):
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            arguments = dict(arguments.arguments)
+            content = arguments.pop("content")
+            is_image = arguments.pop("is_image", False)
+            # Only the turns inside the persona's token window affect the answer
+            history = build_history(persona, arguments.pop("conversation_history", None), record=False)
+            return make_key(persona, model, content, is_image, history, extra=arguments)
+
+        def fetch(key, args, kwargs):
+            # A call that finished while we were queuing for the leader slot may have filled the cache
+            response = response_cache.backend.get(key)[0]
+            if response is not None:
+                return response
+            response = get_mistral_response(*args, **kwargs)
+            if response not in UNCACHEABLE_RESPONSES:
+                response_cache.set(key, response)
+            return response
+
+        @wraps(get_mistral_response)
+        def wrapper(*args, **kwargs):
+            key = cache_key(*args, **kwargs)
+            response = response_cache.get(key)
+            if response is not None:
+                return response
+            # Identical requests already in flight (double clicks, retries) share one upstream call
+            return upstream_calls.do(key, fetch, key, args, kwargs)
+
+        wrapper.cache_key = cache_key
+        return wrapper
+    return decorator
@@ -0,0 +1,296 @@
+import os
+import time
+import inspect
+import logging
+import sqlite3
+import threading
+import contextvars
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from functools import wraps
+
+# Admission settings, overridable from the environment
+MAX_IN_FLIGHT = int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", 8))  # concurrent upstream calls across all users
+USER_RATE = float(os.getenv("UPSTREAM_USER_RATE", 0.5))  # cost units refilled per user per second
+USER_BURST = float(os.getenv("UPSTREAM_USER_BURST", 8))  # token bucket size per user
+MAX_QUEUE_WAIT = float(os.getenv("UPSTREAM_MAX_QUEUE_WAIT", 15))  # seconds before a queued call is rejected
+# SQLite file holding the per-user buckets, so worker processes share one rate limit; in memory when unset
+RATE_LIMIT_PATH = os.getenv("UPSTREAM_RATE_LIMIT_PATH")
+QUANTUM = 1.0  # deficit round-robin credit per visit
+TEXT_COST = 1.0
+IMAGE_COST = 4.0  # an image analysis is slower and costlier upstream than a text turn
+
+# The user a persona call is made for; set by the web layer for each request
+current_user = contextvars.ContextVar("current_user", default=None)
+# Set when the user's bucket was charged for the whole request when it was admitted (a batch upload)
+prepaid = contextvars.ContextVar("prepaid", default=False)
+
+
+class UpstreamRejected(Exception):
+    """Raised when a call cannot be admitted in time; maps to HTTP 429."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(f"Upstream call rejected: {reason}")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def wait_time(self, cost, now):
+        """Refill, then return how long until cost tokens are available (0 if now)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= cost:
+            return 0.0
+        return (cost - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def take(self, cost):
+        self.tokens -= cost
+
+
+class SharedTokenBuckets:
+    """Per-user token buckets in SQLite, shared by every process using the same file."""
+
+    def __init__(self, path, rate, burst):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS buckets (user TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL)")
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def reserve(self, user, cost, max_wait):
+        """Take cost units unless the refill would take longer than max_wait; return the wait in seconds."""
+        conn = self._connection()
+        now = time.time()  # wall clock, monotonic clocks are not comparable across processes
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute("SELECT tokens, updated_at FROM buckets WHERE user = ?", (user,)).fetchone()
+            tokens = self.burst if row is None else min(self.burst, row[0] + max(0.0, now - row[1]) * self.rate)
+            wait = 0.0 if tokens >= cost else (cost - tokens) / self.rate if self.rate > 0 else float("inf")
+            if wait <= max_wait:
+                tokens -= cost
+            conn.execute("INSERT OR REPLACE INTO buckets (user, tokens, updated_at) VALUES (?, ?, ?)", (user, tokens, now))
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return wait
+
+
+class _Ticket:
+    __slots__ = ("user", "cost", "granted", "enqueued_at")
+
+    def __init__(self, user, cost):
+        self.user = user
+        self.cost = cost
+        self.granted = threading.Event()
+        self.enqueued_at = time.monotonic()
+
+
+class FairScheduler:
+    """Global in-flight cap with per-user token buckets and a deficit round-robin queue.
+
+    A call first spends cost units from its user's bucket, then takes an
+    in-flight slot. When all slots are busy, waiting calls are queued per user
+    and freed slots are handed out round-robin by deficit, so one user's
+    burst of uploads cannot starve everyone else. Calls that cannot start
+    within max_queue_wait raise UpstreamRejected with a Retry-After hint.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT, user_rate=USER_RATE, user_burst=USER_BURST,
+                 max_queue_wait=MAX_QUEUE_WAIT, quantum=QUANTUM, rate_limit_path=RATE_LIMIT_PATH):
+        self.max_in_flight = max_in_flight
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.max_queue_wait = max_queue_wait
+        self.quantum = quantum
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._queues = OrderedDict()  # user -> deque of tickets, in round-robin order
+        self._deficits = {}
+        self._buckets = {}
+        self._shared_buckets = SharedTokenBuckets(rate_limit_path, user_rate, user_burst) if rate_limit_path else None
+        self._waits = deque(maxlen=1024)  # recent queue waits in seconds
+        self.admitted = 0
+        self.rejected = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def charge(self, user, cost=TEXT_COST):
+        """Take cost units from the user's bucket, waiting for a refill if it is short."""
+        user = user or "anonymous"
+        cost = min(cost, self.user_burst)
+        if self._shared_buckets is not None:
+            rate_wait = self._shared_buckets.reserve(user, cost, self.max_queue_wait)
+        else:
+            with self._lock:
+                bucket = self._buckets.get(user)
+                if bucket is None:
+                    bucket = self._buckets[user] = TokenBucket(self.user_rate, self.user_burst)
+                rate_wait = bucket.wait_time(cost, time.monotonic())
+                if rate_wait <= self.max_queue_wait:
+                    bucket.take(cost)
+        if rate_wait > self.max_queue_wait:
+            with self._lock:
+                self.rejected += 1
+            logging.warning(f"Rejected upstream call for {user}: rate limit, retry in {rate_wait:.1f}s")
+            raise UpstreamRejected("per-user rate limit", rate_wait)
+        if rate_wait:
+            time.sleep(rate_wait)
+
+    def acquire(self, user, cost=TEXT_COST, charge=True):
+        """Block until the call may start; raise UpstreamRejected if it cannot start in time.
+
+        With charge=False the bucket is left alone, the call only waits for a slot.
+        """
+        user = user or "anonymous"
+        started = time.monotonic()
+        if charge:
+            self.charge(user, cost)
+
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._queues:
+                self._in_flight += 1
+                self._admit(time.monotonic() - started)
+                return
+            ticket = _Ticket(user, cost)
+            self._queues.setdefault(user, deque()).append(ticket)
+            self._deficits.setdefault(user, 0.0)
+
+        remaining = self.max_queue_wait - (time.monotonic() - started)
+        if ticket.granted.wait(max(0.0, remaining)):
+            with self._lock:
+                self._admit(time.monotonic() - started)
+            return
+
+        with self._lock:
+            if ticket.granted.is_set():  # granted just as the wait timed out
+                self._admit(time.monotonic() - started)
+                return
+            queue = self._queues.get(user)
+            if queue is not None:
+                queue.remove(ticket)
+                if not queue:
+                    self._drop_user(user)
+            self.rejected += 1
+            depth = sum(len(q) for q in self._queues.values())
+        logging.warning(f"Rejected upstream call for {user} after waiting {self.max_queue_wait}s in the queue")
+        # Rough estimate of when a slot is likely to free up for this user
+        raise UpstreamRejected("upstream queue full", max(1.0, self.max_queue_wait * depth / max(1, self.max_in_flight)))
+
+    def try_acquire(self):
+        """Take a slot if one is free and nobody is queued for it; never waits or charges anyone.
+
+        For extra requests on behalf of a call that already holds a slot,
+        such as a hedge. Returns whether a slot was taken; release it as usual.
+        """
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._queues:
+                self._in_flight += 1
+                return True
+        return False
+
+    def release(self):
+        """Free an in-flight slot and hand it to the next queued call."""
+        with self._lock:
+            self._in_flight -= 1
+            self._dispatch()
+
+    def _dispatch(self):
+        # Deficit round robin: each visit credits a user one quantum; a user is
+        # served when their credit covers the cost of their oldest call
+        while self._in_flight < self.max_in_flight and self._queues:
+            user, queue = next(iter(self._queues.items()))
+            self._deficits[user] += self.quantum
+            ticket = queue[0]
+            if self._deficits[user] >= ticket.cost:
+                self._deficits[user] -= ticket.cost
+                queue.popleft()
+                self._in_flight += 1
+                ticket.granted.set()
+                if not queue:
+                    self._drop_user(user)
+                    continue
+            self._queues.move_to_end(user)
+
+    def _drop_user(self, user):
+        del self._queues[user]
+        self._deficits.pop(user, None)
+
+    def _admit(self, waited):
+        self.admitted += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        self._waits.append(waited)
+
+    @contextmanager
+    def slot(self, user=None, cost=TEXT_COST):
+        self.acquire(user if user is not None else current_user.get(), cost, charge=not prepaid.get())
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """Return queue depth, in-flight calls and queue wait figures."""
+        with self._lock:
+            waits = sorted(self._waits)
+            return {
+                "in_flight": self._in_flight,
+                "max_in_flight": self.max_in_flight,
+                "queue_depth": sum(len(q) for q in self._queues.values()),
+                "queued_users": len(self._queues),
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "wait_seconds_total": self.wait_total,
+                "wait_seconds_max": self.wait_max,
+                "wait_seconds_p95": waits[int(len(waits) * 0.95)] if waits else 0.0,
+            }
+
+
+upstream_scheduler = FairScheduler()
+
+
+def scheduled(get_mistral_response):
+    """Run a persona call inside an upstream slot for the current user.
+
+    Works for plain functions and for generators (streaming), which hold the
+    slot until the stream is exhausted or closed.
+    """
+    signature = inspect.signature(get_mistral_response)
+
+    def call_cost(args, kwargs):
+        arguments = signature.bind(*args, **kwargs).arguments
+        return IMAGE_COST if arguments.get("is_image") else TEXT_COST
+
+    if inspect.isgeneratorfunction(get_mistral_response):
+        @wraps(get_mistral_response)
+        def stream_wrapper(*args, **kwargs):
+            with upstream_scheduler.slot(cost=call_cost(args, kwargs)):
+                yield from get_mistral_response(*args, **kwargs)
+        return stream_wrapper
+
+    @wraps(get_mistral_response)
+    def wrapper(*args, **kwargs):
+        with upstream_scheduler.slot(cost=call_cost(args, kwargs)):
+            return get_mistral_response(*args, **kwargs)
+    return wrapper
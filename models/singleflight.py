@@ -0,0 +1,80 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+
+class Group:
+    """Collapse concurrent calls that share a key into a single execution.
+
+    The first caller for a key (the leader) runs the function; callers that
+    arrive while it is in flight wait for the leader and receive the same
+    result or exception. Each in-flight call is a concurrent.futures.Future,
+    so threads block on it and asyncio code awaits it, whichever side leads.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.executions = 0
+        self.collapsed = 0
+
+    def _join(self, key):
+        with self._lock:
+            self.calls += 1
+            future = self._calls.get(key)
+            if future is not None:
+                self.collapsed += 1
+                return future, False
+            future = Future()
+            self._calls[key] = future
+            self.executions += 1
+            return future, True
+
+    def _finish(self, key, future, result=None, error=None):
+        with self._lock:
+            del self._calls[key]
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key, fn, *args, **kwargs):
+        """Run fn(*args, **kwargs) once for all concurrent callers with this key."""
+        future, leader = self._join(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """Await fn(*args, **kwargs) (a coroutine function) once for all concurrent callers."""
+        future, leader = self._join(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn(*args, **kwargs)
+        except BaseException as e:
+            self._finish(key, future, error=e)
+            raise
+        self._finish(key, future, result=result)
+        return result
+
+    def stats(self):
+        """Return how many calls were made, executed upstream and collapsed."""
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "executions": self.executions,
+                "collapsed": self.collapsed,
+                "in_flight": len(self._calls),
+            }
+
+
+# Shared by every persona; keys are response cache keys
+upstream_calls = Group()
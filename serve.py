@@ -0,0 +1,138 @@
+import os
+import sys
+import logging
+import argparse
+import tracing
+import static_assets
+from session_backend import load_secret_key
+from job_queue import JobQueue
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError:  # optional, falls back to a single threaded process
+    BaseApplication = None
+
+# Production entry point: N worker processes (gunicorn), shared state in instance/, graceful drain.
+#   python serve.py --workers 4 --bind 0.0.0.0:8000
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+INSTANCE_PATH = os.path.join(REPO_ROOT, "instance")
+DEFAULT_BIND = os.getenv("BIND", f"0.0.0.0:{os.getenv('PORT', 8000)}")
+DEFAULT_WORKERS = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+DEFAULT_THREADS = int(os.getenv("WEB_THREADS", 8))  # per worker; streamed answers hold a thread each
+# Seconds a stopping worker gets to finish its requests; covers one Mistral call with all retries
+DEFAULT_GRACEFUL_TIMEOUT = int(os.getenv("GRACEFUL_TIMEOUT", int(float(os.getenv("MISTRAL_CALL_DEADLINE", 45))) + 15))
+
+
+def clamp_workers(workers):
+    """At most UPSTREAM_MAX_IN_FLIGHT workers, since each one needs an upstream slot of its own."""
+    total_in_flight = int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", 8))
+    if workers > total_in_flight:
+        # Otherwise every worker would still get one slot and the server would exceed the cap
+        logging.warning(f"Starting {total_in_flight} workers instead of {workers}: UPSTREAM_MAX_IN_FLIGHT={total_in_flight} "
+                        "is shared between the workers; raise it to run more")
+        return total_in_flight
+    return workers
+
+
+def configure(workers):
+    """Set the environment every worker inherits, so the workers share state through instance/.
+
+    The response cache and the per-user rate limit move to SQLite, the
+    upstream in-flight cap is split between the workers, and the session key
+    is created once here rather than raced for by the workers. Static assets
+    are built here too; only changed sources are rebuilt.
+    """
+    os.environ.setdefault("RESPONSE_CACHE_BACKEND", "sqlite")
+    os.environ.setdefault("RESPONSE_CACHE_PATH", os.path.join(INSTANCE_PATH, "response_cache.db"))
+    os.environ.setdefault("UPSTREAM_RATE_LIMIT_PATH", os.path.join(INSTANCE_PATH, "rate_limits.db"))
+    # UPSTREAM_MAX_IN_FLIGHT stays the cap for the whole server
+    total_in_flight = int(os.getenv("UPSTREAM_MAX_IN_FLIGHT", 8))
+    os.environ["UPSTREAM_MAX_IN_FLIGHT"] = str(max(1, total_in_flight // workers))
+    if not os.getenv("PIXTALOGY_SECRET_KEY"):
+        load_secret_key(os.getenv("SECRET_KEY_FILE", os.path.join(INSTANCE_PATH, "secret_key")))
+    # Jobs left running by the previous server are requeued here, once; workers only pick up queued jobs
+    os.environ["JOB_RECOVER"] = "0"
+    JobQueue(os.path.join(INSTANCE_PATH, "jobs.db")).recover()
+    static_assets.build(os.path.join(REPO_ROOT, "static"))
+
+
+def warm_up(connect):
+    from models.persona_engine import warm_up as warm_up_personas
+    warm_up_personas(connect=connect)
+
+
+def drain():
+    """Let background jobs that are running finish; queued ones stay queued for the next start."""
+    from app import jobs
+    from models.scheduler import upstream_scheduler
+    in_flight = upstream_scheduler.stats()["in_flight"]
+    if in_flight:
+        logging.info(f"Draining {in_flight} upstream calls")
+    jobs.shutdown(wait=True, cancel_pending=True)
+
+
+if BaseApplication is not None:
+    class Server(BaseApplication):
+        """gunicorn with the app loaded in each worker, warmed up before it accepts requests."""
+
+        def __init__(self, options, warm_connect=False):
+            self.options = options
+            self.warm_connect = warm_connect
+            super().__init__()
+
+        def load_config(self):
+            for name, value in self.options.items():
+                self.cfg.set(name, value)
+            self.cfg.set("post_worker_init", lambda worker: warm_up(self.warm_connect))
+            self.cfg.set("worker_exit", lambda server, worker: drain())
+
+        def load(self):
+            from app import app
+            return app
+
+
+def run_single(host, port, warm_connect):
+    """Without gunicorn: one threaded process, still with the stable key and warm-up."""
+    from werkzeug.serving import run_simple
+    logging.warning("gunicorn is not installed, serving from a single process (pip install gunicorn)")
+    configure(1)
+    from app import app
+    warm_up(warm_connect)
+    try:
+        run_simple(host, port, app, threaded=True)
+    finally:
+        drain()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the app with several worker processes")
+    parser.add_argument("--bind", default=DEFAULT_BIND)
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS)
+    parser.add_argument("--threads", type=int, default=DEFAULT_THREADS)
+    parser.add_argument("--graceful-timeout", type=int, default=DEFAULT_GRACEFUL_TIMEOUT)
+    parser.add_argument("--warm-connect", action="store_true", default=os.getenv("WARMUP_CONNECT") == "1",
+                        help="open a connection to the Mistral API in each worker before it takes traffic")
+    parser.add_argument("--access-log", action="store_true")
+    args = parser.parse_args()
+
+    tracing.install_logging(os.getenv("LOG_LEVEL", "INFO"))
+    os.chdir(REPO_ROOT)  # the app keeps uploads and user data relative to the working directory
+    if BaseApplication is None:
+        host, _, port = args.bind.rpartition(":")
+        run_single(host or "0.0.0.0", int(port), args.warm_connect)
+        sys.exit(0)
+
+    args.workers = clamp_workers(args.workers)
+    configure(args.workers)
+    options = {
+        "bind": args.bind,
+        "workers": args.workers,
+        "worker_class": "gthread",
+        "threads": args.threads,
+        "graceful_timeout": args.graceful_timeout,
+        "timeout": max(60, args.graceful_timeout),
+        "keepalive": 5,
+        "accesslog": "-" if args.access_log else None,
+        "chdir": REPO_ROOT,
+    }
+    Server(options, warm_connect=args.warm_connect).run()
@@ -0,0 +1,240 @@
+import os
+import time
+import logging
+import secrets
+import sqlite3
+import threading
+import metrics
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SessionInterface, SessionMixin
+from itsdangerous import BadSignature, Signer
+from werkzeug.datastructures import CallbackDict
+
+# Session settings, overridable from the environment
+DEFAULT_PATH = os.path.join("instance", "sessions.db")
+IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT", 2 * 3600))  # seconds before an unused session expires
+SWEEP_INTERVAL = int(os.getenv("SESSION_SWEEP_INTERVAL", 300))  # seconds between expiry sweeps
+MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", 40))  # conversation turns kept per session
+TOUCH_INTERVAL = 60  # seconds, limits last-seen updates on read-only requests
+
+
+def load_secret_key(path):
+    """Return the session signing key stored at path, creating it on first use.
+
+    Keeping the key on disk means restarts and every worker process accept
+    the same session cookies.
+    """
+    try:
+        with open(path, "rb") as f:
+            key = f.read()
+        if key:
+            return key
+    except FileNotFoundError:
+        pass
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    key = secrets.token_bytes(32)
+    # Written to a private temporary file and linked into place, so no process reads a partial key
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as f:
+        f.write(key)
+    try:
+        os.link(temporary, path)
+    except FileExistsError:
+        # Another process created it first
+        with open(path, "rb") as f:
+            key = f.read()
+    finally:
+        os.remove(temporary)
+    logging.info(f"Created a new session signing key in {path}")
+    return key
+
+
+class ServerSideSession(CallbackDict, SessionMixin):
+    """Session whose data lives in SQLite; the cookie only carries the signed id."""
+
+    def __init__(self, initial=None, sid=None, new=False, accessed_at=None):
+        def on_update(session):
+            session.modified = True
+
+        super().__init__(initial, on_update)
+        self.sid = sid
+        self.new = new
+        self.accessed_at = accessed_at or time.time()
+        self.modified = False
+
+
+class SQLiteSessionInterface(SessionInterface):
+    """Flask session backend on SQLite in WAL mode, shared by all workers on a host.
+
+    The small cookie-session dict and the conversation history are stored
+    separately: a chat turn appends one row to session_turns instead of
+    rewriting the whole session. History is capped at MAX_TURNS per session
+    and idle sessions are removed by a background sweeper thread.
+    """
+
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, path=DEFAULT_PATH, idle_timeout=IDLE_TIMEOUT, sweep_interval=SWEEP_INTERVAL, max_turns=MAX_TURNS):
+        self.path = path
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.max_turns = max_turns
+        self._local = threading.local()
+        self._sweeper = None
+        self._sweeper_lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connection() as conn:
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS sessions (
+                    sid TEXT PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    accessed_at REAL NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS sessions_accessed ON sessions (accessed_at);
+                CREATE TABLE IF NOT EXISTS session_turns (
+                    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sid TEXT NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS session_turns_sid ON session_turns (sid, seq);
+            """)
+
+    def _connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=10)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="sqlite-session", key_derivation="hmac")
+
+    # Cookie session
+
+    def open_session(self, app, request):
+        started = time.perf_counter()
+        session = self._load_session(app, request)
+        # Reported by the app once the request is matched to a route
+        session.load_seconds = time.perf_counter() - started
+        return session
+
+    def _load_session(self, app, request):
+        self._start_sweeper()
+        signed_sid = request.cookies.get(self.get_cookie_name(app))
+        if signed_sid:
+            try:
+                sid = self._signer(app).unsign(signed_sid).decode("utf-8")
+            except BadSignature:
+                sid = None
+            if sid:
+                row = self._connection().execute(
+                    "SELECT data, accessed_at FROM sessions WHERE sid = ?", (sid,)
+                ).fetchone()
+                if row and row[1] + self.idle_timeout > time.time():
+                    return ServerSideSession(self.serializer.loads(row[0]), sid=sid, accessed_at=row[1])
+        return ServerSideSession(sid=secrets.token_urlsafe(32), new=True)
+
+    def save_session(self, app, session, response):
+        with metrics.stage("session_save"):
+            self._save_session(app, session, response)
+
+    def _save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+
+        if not session:
+            if session.modified:
+                self.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+
+        now = time.time()
+        if session.modified or session.new:
+            with self._connection() as conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO sessions (sid, data, accessed_at) VALUES (?, ?, ?)",
+                    (session.sid, self.serializer.dumps(dict(session)), now),
+                )
+        elif now - session.accessed_at > TOUCH_INTERVAL:
+            self._touch(session.sid, now)
+
+        if self.should_set_cookie(app, session):
+            response.set_cookie(
+                name,
+                self._signer(app).sign(session.sid).decode("utf-8"),
+                expires=self.get_expiration_time(app, session),
+                httponly=self.get_cookie_httponly(app),
+                domain=domain,
+                path=path,
+                secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+    def delete(self, sid):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM sessions WHERE sid = ?", (sid,))
+            conn.execute("DELETE FROM session_turns WHERE sid = ?", (sid,))
+
+    def _touch(self, sid, now):
+        with self._connection() as conn:
+            conn.execute("UPDATE sessions SET accessed_at = ? WHERE sid = ?", (now, sid))
+
+    # Conversation history
+
+    def load_history(self, sid):
+        """Return the session's conversation history, oldest turn first."""
+        rows = self._connection().execute(
+            "SELECT role, content FROM session_turns WHERE sid = ? ORDER BY seq", (sid,)
+        ).fetchall()
+        return [{"role": role, "content": content} for role, content in rows]
+
+    def append_turn(self, sid, role, content):
+        """Append one turn, dropping the oldest ones beyond max_turns."""
+        with self._connection() as conn:
+            conn.execute("INSERT INTO session_turns (sid, role, content) VALUES (?, ?, ?)", (sid, role, content))
+            conn.execute(
+                "DELETE FROM session_turns WHERE sid = ? AND seq <= ("
+                "SELECT seq FROM session_turns WHERE sid = ? ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                (sid, sid, self.max_turns),
+            )
+            conn.execute("UPDATE sessions SET accessed_at = ? WHERE sid = ?", (time.time(), sid))
+
+    def clear_history(self, sid):
+        with self._connection() as conn:
+            conn.execute("DELETE FROM session_turns WHERE sid = ?", (sid,))
+
+    # Expiry
+
+    def sweep(self):
+        """Delete sessions idle for longer than idle_timeout, with their history."""
+        cutoff = time.time() - self.idle_timeout
+        with self._connection() as conn:
+            expired = conn.execute("DELETE FROM sessions WHERE accessed_at < ?", (cutoff,)).rowcount
+            conn.execute("DELETE FROM session_turns WHERE sid NOT IN (SELECT sid FROM sessions)")
+        if expired:
+            logging.info(f"Expired {expired} idle sessions")
+        return expired
+
+    def _start_sweeper(self):
+        if self._sweeper is not None:
+            return
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_forever, name="session-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            try:
+                self.sweep()
+            except sqlite3.Error as e:
+                logging.error(f"Session sweep failed: {e}")
+            time.sleep(self.sweep_interval)
@@ -0,0 +1,211 @@
+const chatBox = document.getElementById('chat-box');
+const chatInput = document.getElementById('chat-input');
+const fileInput = document.getElementById('file-input');
+const attachBtn = document.getElementById('attach-btn');
+const sendBtn = document.getElementById('send-btn');
+const resetBtn = document.getElementById('reset-btn');
+// The persona's endpoints come from the page, so every chat page shares this file
+const chatUrl = document.body.dataset.chatUrl;
+const uploadUrl = document.body.dataset.uploadUrl;
+let selectedFile = null;
+
+// Handle text message sending with Send button
+sendBtn.addEventListener('click', function () {
+    sendMessage();
+});
+
+// Handle text message sending on Enter key press
+chatInput.addEventListener('keypress', function (e) {
+    if (e.key === 'Enter') {
+        e.preventDefault();  // Prevent default behavior of Enter key (new line in input)
+        sendMessage();
+    }
+});
+
+function sendMessage() {
+    const userMessage = chatInput.value.trim();
+
+    if (userMessage) {
+        addMessageToChatBox(userMessage, 'user-message');
+        sendToBackend(userMessage);  // Send text message to backend
+        chatInput.value = '';  // Clear input field after sending
+    }
+
+    // Only send the file if it's selected and the user hasn't explicitly sent it before
+    if (selectedFile) {
+        sendFileToLLM(selectedFile);  // Send image to the backend
+        selectedFile = null;  // Clear the selected file after uploading
+    }
+}
+
+// Attach file functionality
+attachBtn.addEventListener('click', function () {
+    fileInput.click();
+});
+
+fileInput.addEventListener('change', function () {
+    const file = fileInput.files[0];
+    if (file) {
+        selectedFile = file; // Set the selected file
+        addMessageToChatBox("Image ready to be uploaded, please press 'Send' to upload.", 'bot-message');
+    }
+});
+
+function sendToBackend(message) {
+    fetch(`${chatUrl}?stream=true`, {
+        method: 'POST',
+        headers: {
+            'Content-Type': 'application/json',
+            'Accept': 'text/event-stream',
+        },
+        body: JSON.stringify({ message: message }),
+    })
+    .then(response => {
+        // Validation errors still come back as plain JSON
+        if (!(response.headers.get('Content-Type') || '').startsWith('text/event-stream')) {
+            return response.json().then(data => {
+                addMessageToChatBox(`Error: ${data.error}`, 'bot-message');
+            });
+        }
+        return readEventStream(response, addMessageToChatBox('', 'bot-message'));
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        addMessageToChatBox('Error: Could not send message to LLM.', 'bot-message');
+    });
+}
+
+// Render Server-Sent Events from the streaming chat endpoint as tokens arrive
+function readEventStream(response, bubble) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+
+    function handleEvent(rawEvent) {
+        let eventName = 'message';
+        let data = '';
+        rawEvent.split('\n').forEach(line => {
+            if (line.startsWith('event:')) {
+                eventName = line.slice(6).trim();
+            } else if (line.startsWith('data:')) {
+                data += line.slice(5).trim();
+            }
+        });
+        if (!data) {
+            return;
+        }
+        const payload = JSON.parse(data);
+        if (eventName === 'error') {
+            bubble.textContent = `Error: ${payload.error}`;
+        } else if (eventName === 'done') {
+            bubble.textContent = payload.response;
+        } else {
+            bubble.textContent += payload.token;
+        }
+        chatBox.scrollTop = chatBox.scrollHeight;
+    }
+
+    function pump() {
+        return reader.read().then(({ done, value }) => {
+            if (done) {
+                return;
+            }
+            buffer += decoder.decode(value, { stream: true });
+            const events = buffer.split('\n\n');
+            buffer = events.pop();
+            events.forEach(handleEvent);
+            return pump();
+        });
+    }
+
+    return pump();
+}
+
+// Send file to Flask backend
+function sendFileToLLM(file) {
+    const formData = new FormData();
+    formData.append('file', file);
+
+    // Images are analysed in the background; the reply arrives over the job's event stream
+    fetch(uploadUrl, {
+        method: 'POST',
+        body: formData
+    })
+    .then(response => response.json())
+    .then(data => {
+        // Display the uploaded image in the chat before the LLM response
+        if (data.thumbnail_url) {
+            displayImageInChat(data.thumbnail_url, 'user-message', data.image_url);
+        }
+        if (data.job_id) {
+            waitForJob(data.events_url, addMessageToChatBox('Analysing...', 'bot-message'));
+        } else if (data.response) {
+            // Display LLM's response in the chat box
+            addMessageToChatBox(data.response, 'bot-message');
+        } else if (data.error) {
+            addMessageToChatBox(`Error: ${data.error}`, 'bot-message');
+        }
+    })
+    .catch(error => {
+        console.error('Error:', error);
+        addMessageToChatBox('Error: Could not upload file.', 'bot-message');
+    });
+}
+
+// Follow an analysis job until it is done or has failed
+function waitForJob(eventsUrl, bubble) {
+    const events = new EventSource(eventsUrl);
+    events.addEventListener('done', event => {
+        bubble.textContent = JSON.parse(event.data).response;
+        events.close();
+    });
+    events.addEventListener('failed', event => {
+        bubble.textContent = `Error: ${JSON.parse(event.data).error}`;
+        events.close();
+    });
+    events.onerror = () => {
+        // EventSource reconnects by itself; give up only once the server has closed the stream
+        if (events.readyState === EventSource.CLOSED) {
+            bubble.textContent = 'Error: Lost connection while waiting for the analysis.';
+        }
+    };
+}
+
+// Add message to the chat box
+function addMessageToChatBox(message, className) {
+    const messageDiv = document.createElement('div');
+    messageDiv.classList.add('message', className);
+    messageDiv.innerHTML = `<p>${message}</p>`;
+    chatBox.appendChild(messageDiv);
+    chatBox.scrollTop = chatBox.scrollHeight;
+    return messageDiv.querySelector('p');
+}
+
+// Display image in chat
+function displayImageInChat(thumbnailUrl, className, imageUrl) {
+    const messageDiv = document.createElement('div');
+    messageDiv.classList.add('message', className);
+    messageDiv.innerHTML = `<a href="${imageUrl}" target="_blank"><img src="${thumbnailUrl}" loading="lazy" /></a>`;
+    chatBox.appendChild(messageDiv);
+    chatBox.scrollTop = chatBox.scrollHeight;
+}
+
+// Handle conversation reset
+resetBtn.addEventListener('click', function () {
+    fetch('/reset', { method: 'POST' })
+    .then(response => response.json())
+    .then(data => {
+        chatBox.innerHTML = ''; // Clear chat box
+        addMessageToChatBox('Conversation has been reset.', 'bot-message');
+    });
+});
+
+// Logout functionality
+function logout() {
+    fetch('/logout', { method: 'POST' })
+    .then(response => {
+        if (response.ok) {
+            window.location.href = '/login';  // Redirect to login page
+        }
+    });
+}
@@ -0,0 +1,232 @@
+import io
+import os
+import re
+import sys
+import json
+import hashlib
+import logging
+import argparse
+import mimetypes
+from PIL import Image, ImageOps, features
+from compression import accepts, available_encodings, compress
+
+# Static asset build: fingerprinted copies of static/ in static/build/, smaller WebP/AVIF variants
+# of the images, gzip/brotli copies of text assets, and a manifest the app serves them from.
+#   python static_assets.py build
+STATIC_ROOT = "static"
+BUILD_DIR = "build"  # inside STATIC_ROOT
+MANIFEST_NAME = "manifest.json"
+SKIP_DIRS = {BUILD_DIR, "uploads"}  # uploads is user content, not an asset
+MAX_SIDE = int(os.getenv("ASSET_MAX_SIDE", 1920))  # cap for images without an entry in DISPLAY_SIDES
+WEBP_QUALITY = int(os.getenv("ASSET_WEBP_QUALITY", 80))
+AVIF_QUALITY = int(os.getenv("ASSET_AVIF_QUALITY", 60))
+FINGERPRINT_LENGTH = 12
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp")
+TEXT_EXTENSIONS = (".css", ".js", ".html", ".svg", ".json", ".txt", ".map")
+
+# Largest side an image is shown at, in device pixels (twice its CSS size in the templates)
+DISPLAY_SIDES = {
+    "logo3.png": 120,
+    "radiologist.png": 300,
+    "mental_health.png": 300,
+    "report.png": 300,
+    "general_doctor.png": 300,
+    "dietitian.png": 300,
+}
+
+# Variant suffixes in order of preference, with what the client has to accept for each
+IMAGE_VARIANTS = (("avif", "image/avif"), ("webp", "image/webp"))
+ENCODINGS = (("br", "br"), ("gz", "gzip"))
+
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+)\1\s*\)""")
+
+
+def _fingerprinted(name, data):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.sha256(data).hexdigest()[:FINGERPRINT_LENGTH]}{ext}"
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _encode(image, format, **options):
+    buffer = io.BytesIO()
+    image.save(buffer, format=format, **options)
+    return buffer.getvalue()
+
+
+def _image_outputs(name, source):
+    """Return (type, fallback bytes, {suffix: variant bytes}) for an image.
+
+    The fallback keeps the source format, so every browser can show it; it is
+    the source file unchanged unless the image is larger than it is shown
+    and the downscaled copy is also smaller in bytes.
+    Variants are only kept when they are smaller than the fallback.
+    """
+    with Image.open(io.BytesIO(source)) as image:
+        format = image.format
+        icc_profile = image.info.get("icc_profile")
+        image = ImageOps.exif_transpose(image)
+        if getattr(image, "is_animated", False):
+            return Image.MIME.get(format), source, {}
+        max_side = DISPLAY_SIDES.get(name, MAX_SIDE)
+        fallback = source
+        if max(image.size) > max_side:
+            image.thumbnail((max_side, max_side), Image.LANCZOS)
+            options = {"optimize": True}
+            if format == "JPEG":
+                image = image.convert("RGB")
+                options.update(quality=85, progressive=True)
+            resized = _encode(image, format, icc_profile=icc_profile, **options)
+            if len(resized) < len(source):
+                fallback = resized
+
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "PA") else "RGB")
+        variants = {}
+        if features.check("webp"):
+            variants["webp"] = _encode(image, "WEBP", quality=WEBP_QUALITY, method=6, icc_profile=icc_profile)
+        if features.check("avif"):
+            variants["avif"] = _encode(image, "AVIF", quality=AVIF_QUALITY, icc_profile=icc_profile)
+    return Image.MIME.get(format), fallback, {suffix: data for suffix, data in variants.items() if len(data) < len(fallback)}
+
+
+def _rewrite_css(name, source, files):
+    """Point url() references in a stylesheet at the fingerprinted files."""
+    directory = os.path.dirname(name)
+
+    def replace(match):
+        url = match.group(2)
+        if "://" in url or url.startswith(("data:", "/", "#")):
+            return match.group(0)
+        # A cache-busting query is dropped, the fingerprint replaces it
+        target = os.path.normpath(os.path.join(directory, url.split("?")[0])).replace(os.sep, "/")
+        if target not in files:
+            return match.group(0)
+        # The stylesheet moves into build/ along with the files it points at
+        return f"url({match.group(1)}{os.path.relpath(files[target], os.path.join(BUILD_DIR, directory))}{match.group(1)})"
+
+    return _CSS_URL.sub(replace, source.decode("utf-8")).encode("utf-8")
+
+
+def _compressed(data):
+    # Built once, so at the slowest levels; brotli copies need the optional brotli package
+    compressed = {"gz": compress(data, "gzip", level=9)}
+    if "br" in available_encodings():
+        compressed["br"] = compress(data, "br", level=11)
+    return {suffix: body for suffix, body in compressed.items() if len(body) < len(data)}
+
+
+def _sources(static_root):
+    for directory, dirs, names in os.walk(static_root):
+        relative_dir = os.path.relpath(directory, static_root)
+        if relative_dir == ".":
+            dirs[:] = [d for d in dirs if d not in SKIP_DIRS]
+            relative_dir = ""
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in sorted(names):
+            if not name.startswith(".") and name.lower().endswith(IMAGE_EXTENSIONS + TEXT_EXTENSIONS):
+                yield os.path.join(relative_dir, name).replace(os.sep, "/")
+
+
+def load_manifest(static_root=STATIC_ROOT):
+    """Return the manifest of the last build, or an empty one when nothing was built."""
+    path = os.path.join(static_root, BUILD_DIR, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {"files": {}, "assets": {}}
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def build(static_root=STATIC_ROOT, force=False):
+    """Build every asset under static_root into static_root/build and write the manifest.
+
+    Assets whose source did not change since the last build are kept as
+    they are. Outputs of earlier builds are left in place, so pages that
+    still point at them keep working. Returns (built, unchanged).
+    """
+    previous = load_manifest(static_root)
+    previous_assets = {asset["source"]: asset for asset in previous["assets"].values()}
+    files, assets = {}, {}
+    built = unchanged = 0
+    # Images first, so stylesheets can be pointed at their fingerprinted names
+    names = sorted(_sources(static_root), key=lambda name: name.lower().endswith(TEXT_EXTENSIONS))
+    for name in names:
+        with open(os.path.join(static_root, name), "rb") as f:
+            source = f.read()
+        source_hash = hashlib.sha256(source).hexdigest()
+        asset = previous_assets.get(name)
+        # Stylesheets are always rebuilt, the fingerprints they point at may have changed
+        reuse = (not force and asset and asset["source_sha256"] == source_hash and not name.lower().endswith(".css")
+                 and all(os.path.exists(os.path.join(static_root, path)) for path in _outputs(asset)))
+        if reuse:
+            unchanged += 1
+        else:
+            asset = _build_asset(static_root, name, source, source_hash, files)
+            built += 1
+        files[name] = asset["path"]
+        assets[asset["path"]] = asset
+
+    manifest = {"files": files, "assets": assets}
+    _write(os.path.join(static_root, BUILD_DIR, MANIFEST_NAME), json.dumps(manifest, indent=2, sort_keys=True).encode("utf-8"))
+    logging.info(f"Built {built} static assets, {unchanged} unchanged")
+    return built, unchanged
+
+
+def _build_asset(static_root, name, source, source_hash, files):
+    if name.lower().endswith(IMAGE_EXTENSIONS):
+        content_type, data, variants = _image_outputs(os.path.basename(name), source)
+        encodings = {}
+    else:
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        data = _rewrite_css(name, source, files) if name.lower().endswith(".css") else source
+        variants, encodings = {}, _compressed(data)
+    path = f"{BUILD_DIR}/{_fingerprinted(name, data)}"
+    _write(os.path.join(static_root, path), data)
+    for suffix, body in {**variants, **encodings}.items():
+        _write(os.path.join(static_root, f"{path}.{suffix}"), body)
+    sizes = {suffix: len(body) for suffix, body in {**variants, **encodings}.items()}
+    logging.info(f"{name}: {len(source)} -> {len(data)} bytes" + "".join(f", {suffix} {size}" for suffix, size in sizes.items()))
+    return {
+        "source": name,
+        "source_sha256": source_hash,
+        "path": path,
+        "type": content_type,
+        "variants": sorted(variants),
+        "encodings": sorted(encodings),
+    }
+
+
+def _outputs(asset):
+    return [asset["path"]] + [f"{asset['path']}.{suffix}" for suffix in asset["variants"] + asset["encodings"]]
+
+
+def negotiate(asset, accept_mimetypes, accept_encodings):
+    """Pick the file to send for a built asset: (path, content type, content encoding or None)."""
+    for suffix, content_type in IMAGE_VARIANTS:
+        if suffix in asset["variants"] and accepts(accept_mimetypes, content_type):
+            return f"{asset['path']}.{suffix}", content_type, None
+    for suffix, encoding in ENCODINGS:
+        if suffix in asset["encodings"] and accepts(accept_encodings, encoding):
+            return f"{asset['path']}.{suffix}", asset["type"], encoding
+    return asset["path"], asset["type"], None
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Static asset build")
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    build_parser = subcommands.add_parser("build", help="fingerprint, resize and precompress static/ into static/build")
+    build_parser.add_argument("--static", default=STATIC_ROOT)
+    build_parser.add_argument("--force", action="store_true", help="rebuild assets whose source did not change")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == "build":
+        built, unchanged = build(args.static, force=args.force)
+        print(f"Built {built} assets ({unchanged} unchanged) into {os.path.join(args.static, BUILD_DIR)}")
+        sys.exit(0)
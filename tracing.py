@@ -0,0 +1,245 @@
+import os
+import re
+import sys
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+import contextvars
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+
+# Request tracing: a trace id on every log line, spans per stage, slow or sampled traces written as JSON lines.
+# Everything is off unless TRACE_SLOW_SECONDS, TRACE_SAMPLE_RATE or PROFILE_SAMPLE_RATE is set.
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", 0))  # record spans and keep traces slower than this
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))  # fraction of traces kept regardless of duration
+TRACE_PATH = os.getenv("TRACE_PATH", os.path.join("instance", "traces.jsonl"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", 0))  # fraction of requests run under the sampling profiler
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", 0.005))  # seconds between stack samples
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join("instance", "profiles"))
+LOG_LEVEL = os.getenv("LOG_LEVEL", "WARNING")
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(trace_id)s] %(name)s: %(message)s"
+
+_trace = contextvars.ContextVar("trace", default=None)
+_span = contextvars.ContextVar("span", default=None)
+_write_lock = threading.Lock()
+_NULL_SPAN = nullcontext()
+
+
+class Trace:
+    """Spans of one request or background job.
+
+    Spans are only recorded when recording is set; the id is always there
+    for log lines. Threads started with a copy of the context (batch
+    workers) add their spans to the same trace.
+    """
+
+    def __init__(self, name, trace_id=None, recording=False, **attributes):
+        self.id = trace_id or uuid.uuid4().hex[:16]
+        self.name = name
+        self.recording = recording
+        self.attributes = attributes
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.spans = []
+        self.profile = None
+        self.token = None
+        self.finished = False
+
+    def to_dict(self, duration):
+        return {
+            "trace_id": self.id,
+            "name": self.name,
+            "started_at": self.started_at,
+            "duration": round(duration, 6),
+            "attributes": self.attributes,
+            "spans": self.spans,
+        }
+
+
+def current_trace_id():
+    trace = _trace.get()
+    return trace.id if trace else None
+
+
+def set_attributes(**attributes):
+    trace = _trace.get()
+    if trace is not None:
+        trace.attributes.update(attributes)
+
+
+@contextmanager
+def _recorded_span(trace, name, attributes):
+    parent = _span.get()
+    span = {"id": uuid.uuid4().hex[:8], "parent": parent, "name": name, "thread": threading.current_thread().name}
+    if attributes:
+        span["attributes"] = attributes
+    token = _span.set(span["id"])
+    started = time.perf_counter()
+    try:
+        yield span
+    except BaseException as e:
+        span["error"] = type(e).__name__
+        raise
+    finally:
+        span["start"] = round(started - trace.started, 6)
+        span["duration"] = round(time.perf_counter() - started, 6)
+        _span.reset(token)
+        trace.spans.append(span)
+
+
+def span(name, **attributes):
+    """Time a block as a span of the current trace; a shared no-op when nothing is recorded."""
+    trace = _trace.get()
+    if trace is None or not trace.recording:
+        return _NULL_SPAN
+    return _recorded_span(trace, name, attributes)
+
+
+def start(name, trace_id=None, **attributes):
+    """Begin a trace in the current context; returns it for finish()."""
+    recording = TRACE_SLOW_SECONDS > 0 or TRACE_SAMPLE_RATE > 0
+    trace = Trace(name, trace_id, recording, **attributes)
+    trace.token = _trace.set(trace)
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE:
+        trace.profile = profiler.add(threading.get_ident())
+    return trace
+
+
+def finish(trace):
+    """End a trace; it is written out when slow or sampled, and its profile is dumped."""
+    if trace.finished:
+        return
+    trace.finished = True
+    duration = time.perf_counter() - trace.started
+    try:
+        if trace.profile is not None:
+            profiler.remove(threading.get_ident())
+            _dump_profile(trace, trace.profile)
+        if trace.recording:
+            slow = TRACE_SLOW_SECONDS > 0 and duration >= TRACE_SLOW_SECONDS
+            if slow or (TRACE_SAMPLE_RATE and random.random() < TRACE_SAMPLE_RATE):
+                record = trace.to_dict(duration)
+                record["slow"] = slow
+                _write_trace(record)
+                if slow:
+                    logging.warning(f"Slow {trace.name} took {duration:.3f}s, {len(trace.spans)} spans written to {TRACE_PATH}")
+    finally:
+        try:
+            _trace.reset(trace.token)
+        except ValueError:
+            _trace.set(None)  # finished from another context, e.g. after a streamed response
+
+
+@contextmanager
+def trace(name, trace_id=None, **attributes):
+    """Run a block (e.g. a background job) as its own trace."""
+    current = start(name, trace_id, **attributes)
+    try:
+        yield current
+    finally:
+        finish(current)
+
+
+def _write_trace(record):
+    directory = os.path.dirname(TRACE_PATH)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    line = json.dumps(record, default=str) + "\n"
+    with _write_lock, open(TRACE_PATH, "a", encoding="utf-8") as f:
+        f.write(line)
+
+
+# Sampling profiler
+
+class SamplingProfiler:
+    """Samples the stacks of registered threads from one background thread.
+
+    Each registered thread gets a Counter of collapsed stacks
+    ("module:function;module:function ..." -> samples), the input format of
+    flamegraph.pl and speedscope.
+    """
+
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self._threads = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._sampler = None
+
+    def add(self, thread_id):
+        stacks = Counter()
+        with self._lock:
+            self._threads[thread_id] = stacks
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample_forever, name="sampling-profiler", daemon=True)
+                self._sampler.start()
+        self._wake.set()
+        return stacks
+
+    def remove(self, thread_id):
+        with self._lock:
+            return self._threads.pop(thread_id, None)
+
+    def _sample_forever(self):
+        while True:
+            with self._lock:
+                threads = dict(self._threads)
+            if not threads:
+                self._wake.wait()
+                self._wake.clear()
+                continue
+            frames = sys._current_frames()
+            for thread_id, stacks in threads.items():
+                frame = frames.get(thread_id)
+                if frame is not None:
+                    stacks[_collapse(frame)] += 1
+            del frames
+            time.sleep(self.interval)
+
+
+def _collapse(frame):
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        module = frame.f_globals.get("__name__", os.path.basename(code.co_filename))
+        names.append(f"{module}:{code.co_name}")
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def _dump_profile(trace, stacks):
+    if not stacks:
+        return
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = re.sub(r"[^A-Za-z0-9_.-]+", "_", trace.name).strip("_") or "root"
+    path = os.path.join(PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{trace.id}.folded")
+    with open(path, "w", encoding="utf-8") as f:
+        for stack, count in stacks.most_common():
+            f.write(f"{stack} {count}\n")
+    logging.info(f"Wrote {sum(stacks.values())} stack samples of {trace.name} to {path}")
+
+
+profiler = SamplingProfiler()
+
+
+# Logging
+
+def install_logging(level=LOG_LEVEL):
+    """Put the current trace id on every log record and log with LOG_FORMAT unless logging is already set up."""
+    factory = logging.getLogRecordFactory()
+    if getattr(factory, "adds_trace_id", False):
+        return
+
+    def record_factory(*args, **kwargs):
+        record = factory(*args, **kwargs)
+        trace = _trace.get()
+        record.trace_id = trace.id if trace else "-"
+        return record
+
+    record_factory.adds_trace_id = True
+    logging.setLogRecordFactory(record_factory)
+    if not logging.getLogger().handlers:
+        logging.basicConfig(level=level, format=LOG_FORMAT)